@@ -0,0 +1,428 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=W0603, C0325
+import asyncio
+import http.client
+import io
+import json
+import random
+import ssl
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import zlib
+
+from bs4 import BeautifulSoup
+
+import PixivBrowserFactory
+import PixivHelper
+import PixivHtmlParser
+import PixivModelWhiteCube
+from PixivException import PixivException
+from PixivModelFanbox import FanboxArtist
+
+_asyncBrowser = None
+_proxyWarned = False
+
+
+class AsyncResponse(object):
+    '''Minimal response object, compatible with what cookielib and the parser need.'''
+    code = 0
+    msg = ''
+    headers = None
+    _url = ''
+    _data = None
+
+    def __init__(self, url, code, msg, headers, data):
+        self._url = url
+        self.code = code
+        self.msg = msg
+        self.headers = headers
+        self._data = data
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self._url
+
+    def getcode(self):
+        return self.code
+
+    def read(self):
+        return self._data
+
+
+class PixivAsyncBrowser(object):
+    '''asyncio based transport with the same surface as PixivBrowser.
+
+    All methods are coroutines, requests are limited by maxConnection and spaced by random delay up to
+    downloadDelay, and share the cookie jar and the response cache with the mechanize browser.
+    Proxy is not supported, see getAsyncBrowser().
+    '''
+    _config = None
+    _cookieJar = None
+    _sslContext = None
+    _semaphore = None
+    _syncBrowser = None
+    _nextRequest = 0
+    maxConnection = 100
+    maxRedirect = 5
+
+    def __init__(self, config, cookie_jar, sync_browser=None, max_connection=100):
+        self._config = config
+        self._cookieJar = cookie_jar
+        self._syncBrowser = sync_browser
+        self.maxConnection = max(1, int(max_connection))
+
+        self._sslContext = ssl.create_default_context()
+        if config is not None and not config.enableSSLVerification:
+            self._sslContext.check_hostname = False
+            self._sslContext.verify_mode = ssl.CERT_NONE
+
+    def _get_semaphore(self):
+        # semaphore is bound to the running loop.
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore[0] is not loop:
+            self._semaphore = (loop, asyncio.Semaphore(self.maxConnection))
+        return self._semaphore[1]
+
+    async def _throttle(self):
+        '''Wait for the next request slot, each request is delayed up to downloadDelay from the previous one.'''
+        if self._config is None or self._config.downloadDelay <= 0:
+            return
+        now = time.monotonic()
+        start = max(now, self._nextRequest)
+        self._nextRequest = start + random.random() * self._config.downloadDelay
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    def _get_from_cache(self, key):
+        if self._syncBrowser is not None:
+            return self._syncBrowser._get_from_cache(key)
+        return None
+
+    def _put_to_cache(self, key, item, expiration=3600):
+        if self._syncBrowser is not None:
+            self._syncBrowser._put_to_cache(key, item, expiration)
+
+    def fixUrl(self, url):
+        if not url.startswith("http"):
+            if not url.startswith("/"):
+                url = "/" + url
+            return "https://www.pixiv.net" + url
+        return url
+
+    async def _send(self, req):
+        parsed = urllib.parse.urlsplit(req.full_url)
+        is_https = parsed.scheme == 'https'
+        port = parsed.port or (443 if is_https else 80)
+        path = parsed.path or '/'
+        if parsed.query:
+            path = path + '?' + parsed.query
+
+        headers = dict()
+        if self._config is not None:
+            headers['User-Agent'] = self._config.useragent
+        headers['Accept-Charset'] = 'utf-8'
+        headers['Accept-Encoding'] = 'gzip, deflate'
+        headers.update(req.header_items())
+        headers['Host'] = parsed.netloc
+        headers['Connection'] = 'close'
+        data = req.data
+        if data is not None:
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            headers['Content-Length'] = str(len(data))
+
+        lines = ['{0} {1} HTTP/1.1'.format(req.get_method(), path)]
+        lines.extend('{0}: {1}'.format(k, v) for (k, v) in headers.items())
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+        timeout = self._config.timeout if self._config is not None else 60
+        (reader, writer) = await asyncio.wait_for(asyncio.open_connection(parsed.hostname,
+                                                                          port,
+                                                                          ssl=self._sslContext if is_https else None),
+                                                  timeout)
+        try:
+            writer.write(head)
+            if data is not None:
+                writer.write(data)
+            await writer.drain()
+
+            status_line = await asyncio.wait_for(reader.readline(), timeout)
+            (_, code, msg) = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+            raw_headers = list()
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout)
+                raw_headers.append(line)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            response_headers = http.client.parse_headers(io.BytesIO(b''.join(raw_headers)))
+
+            if req.get_method() == 'HEAD':
+                body = b''
+            elif response_headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                chunks = list()
+                while True:
+                    size = int((await reader.readline()).split(b';')[0].strip(), 16)
+                    if size == 0:
+                        await reader.readline()
+                        break
+                    chunks.append(await reader.readexactly(size))
+                    await reader.readline()
+                body = b''.join(chunks)
+            elif response_headers.get('Content-Length') is not None:
+                body = await asyncio.wait_for(reader.readexactly(int(response_headers['Content-Length'])), timeout)
+            else:
+                body = await asyncio.wait_for(reader.read(), timeout)
+        finally:
+            writer.close()
+
+        encoding = response_headers.get('Content-Encoding', '').lower()
+        if encoding == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            body = zlib.decompress(body)
+
+        return AsyncResponse(req.full_url, int(code), msg, response_headers, body)
+
+    async def open(self, url):
+        '''Open url or urllib.request.Request, follow redirect and raise HTTPError like urllib.'''
+        req = url if isinstance(url, urllib.request.Request) else urllib.request.Request(url)
+        redirect = 0
+        await self._throttle()
+        async with self._get_semaphore():
+            while True:
+                self._cookieJar.add_cookie_header(req)
+                response = await self._send(req)
+                self._cookieJar.extract_cookies(response, req)
+
+                location = response.headers.get('Location')
+                if response.code in (301, 302, 303, 307, 308) and location is not None and redirect < self.maxRedirect:
+                    redirect = redirect + 1
+                    new_url = urllib.parse.urljoin(req.full_url, location)
+                    headers = dict((k, v) for (k, v) in req.header_items() if k.lower() != 'cookie')
+                    data = req.data if response.code in (307, 308) else None
+                    req = urllib.request.Request(new_url, data=data, headers=headers)
+                    continue
+
+                if response.code >= 400:
+                    raise urllib.error.HTTPError(response.geturl(), response.code, response.msg, response.headers, io.BytesIO(response.read()))
+                return response
+
+    async def open_with_retry(self, url, retry=0):
+        retry_count = 0
+        if retry == 0 and self._config is not None:
+            retry = self._config.retry
+
+        while True:
+            try:
+                return await self.open(url)
+            except urllib.error.HTTPError:
+                raise
+            except BaseException:
+                if retry_count < retry:
+                    await asyncio.sleep(self._config.retryWait)
+                    retry_count = retry_count + 1
+                else:
+                    PixivHelper.print_and_log('error', 'Error at open_with_retry(): {0}'.format(url))
+                    raise PixivException("Failed to get page: {0}, please check your internet connection/firewall/antivirus.".format(url), errorCode=PixivException.SERVER_ERROR)
+
+    def _getParser(self):
+        return self._config.htmlParser if self._config is not None else 'fast'
+
+    async def getPixivPage(self, url, referer="https://www.pixiv.net", returnParsed=True):
+        ''' get page from pixiv and return as parsed BeautifulSoup object or response object.
+
+            throw PixivException as server error
+        '''
+        url = self.fixUrl(url)
+        req = urllib.request.Request(url)
+        req.add_header('Referer', referer)
+        try:
+            page = await self.open_with_retry(req)
+        except urllib.error.HTTPError as ex:
+            if ex.code in [403, 404, 503]:
+                return BeautifulSoup(ex.read(), features=PixivHtmlParser.getFeatures(self._getParser()))
+            raise PixivException("Failed to get page: {0}".format(url), errorCode=PixivException.SERVER_ERROR)
+        if returnParsed:
+            parser = self._getParser()
+            return BeautifulSoup(page.read(), features=PixivHtmlParser.getFeatures(parser))
+        return page
+
+    async def getImagePage(self, image_id, parent=None, from_bookmark=False,
+                           bookmark_count=-1, image_response_count=-1):
+        url = "https://www.pixiv.net/member_illust.php?mode=medium&illust_id={0}".format(image_id)
+        response = (await self.getPixivPage(url, returnParsed=False)).read()
+
+        _tzInfo = None
+        if self._config.useLocalTimezone:
+            _tzInfo = PixivHelper.LocalUTCOffsetTimezone()
+
+        image = PixivModelWhiteCube.PixivImage(image_id,
+                                               response,
+                                               parent,
+                                               from_bookmark,
+                                               bookmark_count,
+                                               image_response_count,
+                                               dateFormat=self._config.dateFormat,
+                                               tzInfo=_tzInfo)
+
+        if image.imageMode == "ugoira_view":
+            ugoira_meta_url = "https://www.pixiv.net/ajax/illust/{0}/ugoira_meta".format(image_id)
+            meta_response = (await self.open_with_retry(ugoira_meta_url)).read()
+            image.ParseUgoira(meta_response)
+
+        if parent is None:
+            if from_bookmark:
+                image.originalArtist.reference_image_id = image_id
+                await self.getMemberInfoWhitecube(image.originalArtist.artistId, image.originalArtist)
+            else:
+                image.artist.reference_image_id = image_id
+                await self.getMemberInfoWhitecube(image.artist.artistId, image.artist)
+
+        return (image, response)
+
+    async def getMemberInfoWhitecube(self, member_id, artist, bookmark=False):
+        ''' get artist information using Ajax, OAuth request is delegated to the mechanize browser '''
+        if artist.reference_image_id <= 0:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self._syncBrowser.getMemberInfoWhitecube, member_id, artist, bookmark)
+
+        try:
+            url = "https://www.pixiv.net/rpc/get_work.php?id={0}".format(artist.reference_image_id)
+            info = self._get_from_cache(url)
+            if info is None:
+                info = json.loads((await self.open_with_retry(url)).read())
+                self._put_to_cache(url, info)
+            artist.ParseInfo(info, False, bookmark=bookmark)
+
+            url_ajax = 'https://www.pixiv.net/ajax/user/{0}'.format(member_id)
+            info_ajax = self._get_from_cache(url_ajax)
+            if info_ajax is None:
+                info_ajax = json.loads((await self.open_with_retry(url_ajax)).read())
+                self._put_to_cache(url_ajax, info_ajax)
+            artist.ParseBackground(info_ajax)
+
+            return artist
+        except urllib.error.HTTPError as error:
+            errorMessage = error.read()
+            PixivHelper.GetLogger().error("Error data: \r\n %s", errorMessage)
+            payload = json.loads(errorMessage)
+            msg = payload.get("message", str(error))
+            if error.code == 401:
+                raise PixivException(msg, errorCode=PixivException.NOT_LOGGED_IN, htmlPage=errorMessage)
+            elif error.code == 403:
+                raise PixivException(msg, errorCode=PixivException.USER_ID_SUSPENDED, htmlPage=errorMessage)
+            else:
+                raise PixivException(msg, errorCode=PixivException.OTHER_MEMBER_ERROR, htmlPage=errorMessage)
+
+    async def getMemberPage(self, member_id, page=1, bookmark=False, tags=None, last_image_id=0):
+        if tags is not None:
+            tags = PixivHelper.encode_tags(tags)
+        else:
+            tags = ''
+
+        limit = 48
+        offset = (page - 1) * limit
+        need_to_slice = False
+        if bookmark:
+            url = 'https://www.pixiv.net/ajax/user/{0}/illusts/bookmarks?tag={1}&offset={2}&limit={3}&rest=show'.format(member_id, tags, offset, limit)
+        elif len(tags) > 0:
+            url = 'https://www.pixiv.net/ajax/user/{0}/illustmanga/tag?tag={1}&offset={2}&limit={3}'.format(member_id, tags, offset, limit)
+        elif self._config.r18mode:
+            url = 'https://www.pixiv.net/ajax/user/{0}/illustmanga/tag?tag={1}&offset={2}&limit={3}'.format(member_id, 'R-18', offset, limit)
+        else:
+            url = 'https://www.pixiv.net/ajax/user/{0}/profile/all'.format(member_id)
+            need_to_slice = True
+
+        response = self._get_from_cache(url)
+        if response is None:
+            try:
+                response = (await self.open_with_retry(url)).read()
+            except urllib.error.HTTPError as ex:
+                if ex.code != 404:
+                    raise
+                response = ex.read()
+            self._put_to_cache(url, response)
+
+        artist = PixivModelWhiteCube.PixivArtist(member_id, response, False, offset, limit, last_image_id if need_to_slice else 0)
+        artist.reference_image_id = artist.imageList[0] if len(artist.imageList) > 0 else 0
+        await self.getMemberInfoWhitecube(member_id, artist, bookmark)
+
+        if artist.haveImages and need_to_slice:
+            artist.imageList = artist.imageList[offset:offset + limit]
+
+        return (artist, response)
+
+    async def fanboxGetPostsFromArtist(self, artist_id, next_url=""):
+        if next_url is None or next_url == "":
+            url = "https://www.pixiv.net/ajax/fanbox/creator?userId={0}".format(artist_id)
+        elif next_url.startswith("https://"):
+            url = next_url
+        else:
+            url = "https://www.pixiv.net" + next_url
+
+        req = urllib.request.Request(url)
+        req.add_header('Accept', 'application/json, text/plain, */*')
+        req.add_header('Referer', "https://www.pixiv.net/fanbox/creator/{0}".format(artist_id))
+        req.add_header('Origin', 'https://www.pixiv.net')
+
+        response = (await self.open_with_retry(req)).read()
+        _tzInfo = None
+        if self._config.useLocalTimezone:
+            _tzInfo = PixivHelper.LocalUTCOffsetTimezone()
+        result = FanboxArtist(artist_id, response, tzInfo=_tzInfo)
+
+        pixivArtist = PixivModelWhiteCube.PixivArtist(artist_id)
+        await self.getMemberInfoWhitecube(artist_id, pixivArtist)
+        result.artistName = pixivArtist.artistName
+        result.artistToken = pixivArtist.artistToken
+
+        return result
+
+    def prefetchImagePages(self, image_ids, expiration=600):
+        '''Fetch the medium pages concurrently and put them into the browser cache, used by getImagePage().'''
+        async def fetch(image_id):
+            url = "https://www.pixiv.net/member_illust.php?mode=medium&illust_id={0}".format(image_id)
+            if self._get_from_cache(url) is not None:
+                return
+            try:
+                response = await self.getPixivPage(url, returnParsed=False)
+                self._put_to_cache(url, response.read(), expiration)
+            except BaseException:
+                # leave it to the normal path to report the error.
+                PixivHelper.GetLogger().debug("Failed to prefetch %s", url)
+
+        async def fetch_all():
+            await asyncio.gather(*[fetch(image_id) for image_id in image_ids])
+
+        if len(image_ids) > 0:
+            asyncio.run(fetch_all())
+
+
+def getAsyncBrowser(config=None):
+    '''Return the asyncio browser if enabled from config (httpBackend = asyncio), otherwise None.
+
+    The asyncio transport connects directly, so it is disabled when useProxy is set.
+    '''
+    global _asyncBrowser
+    global _proxyWarned
+    if config is None:
+        config = PixivBrowserFactory.defaultConfig
+    if config is None or config.httpBackend != 'asyncio':
+        return None
+    if config.useProxy:
+        if not _proxyWarned:
+            PixivHelper.print_and_log('info', 'httpBackend = asyncio does not support proxy, using mechanize.')
+            _proxyWarned = True
+        return None
+
+    if _asyncBrowser is None or _asyncBrowser._config is not config:
+        sync_browser = PixivBrowserFactory.getBrowser()
+        _asyncBrowser = PixivAsyncBrowser(config,
+                                          PixivBrowserFactory.defaultCookieJar,
+                                          sync_browser,
+                                          config.asyncMaxConnection)
+    return _asyncBrowser
@@ -9,16 +9,18 @@ import mechanize
 import re
 import socket
 import sys
+import threading
 import time
 import urllib.request, urllib.parse, urllib.error
 import urllib.request, urllib.error, urllib.parse
 import urllib.parse
 from bs4 import BeautifulSoup
 
-import demjson
 import socks
 
+import PixivCache
 import PixivHelper
+import PixivHtmlParser
 import PixivModel
 import PixivModelWhiteCube
 from PixivException import PixivException
@@ -28,6 +30,7 @@ from PixivOAuth import PixivOAuth
 defaultCookieJar = None
 defaultConfig = None
 _browser = None
+_threadBrowser = threading.local()
 
 
 # pylint: disable=E1101
@@ -35,7 +38,6 @@ class PixivBrowser(mechanize.Browser):
     _config = None
     _isWhitecube = False
     _whitecubeToken = ""
-    _cache = dict()
     _myId = 0
     _isPremium = False
 
@@ -44,18 +46,44 @@ class PixivBrowser(mechanize.Browser):
     _oauth_manager = None
 
     def _put_to_cache(self, key, item, expiration=3600):
-        expiry = time.time() + expiration
-        self._cache[key] = (item, expiry)
+        PixivCache.getMemoryCache(self._config).put(key, item, expiration)
 
     def _get_from_cache(self, key):
-        if key in list(self._cache.keys()):
-            (item, expiry) = self._cache[key]
-            if expiry - time.time() > 0:
-                return item
-            else:
-                del item
-                self._cache.pop(key)
-        return None
+        return PixivCache.getMemoryCache(self._config).get(key)
+
+    def _open_with_cache(self, url, expiration=3600):
+        ''' Return the response body from the persistent cache if still fresh, otherwise revalidate it using
+            ETag/Last-Modified (HTTP 304) or download and store it.
+        '''
+        cache = PixivCache.getCache(self._config)
+        if cache is None:
+            return self.open_with_retry(url).read()
+
+        if self._config is not None:
+            expiration = self._config.persistentCacheExpiration
+        entry = cache.get(url)
+        if entry is not None and entry.isFresh:
+            PixivHelper.GetLogger().debug("Persistent cache hit: %s", url)
+            return entry.content
+
+        request = urllib.request.Request(url)
+        if entry is not None:
+            if entry.etag is not None:
+                request.add_header('If-None-Match', entry.etag)
+            if entry.lastModified is not None:
+                request.add_header('If-Modified-Since', entry.lastModified)
+        try:
+            response = self.open_with_retry(request)
+        except urllib.error.HTTPError as ex:
+            if ex.code == 304 and entry is not None:
+                PixivHelper.GetLogger().debug("Persistent cache revalidated: %s", url)
+                cache.touch(url, expiration)
+                return entry.content
+            raise
+
+        content = response.read()
+        cache.put(url, content, response.info()['ETag'], response.info()['Last-Modified'], expiration)
+        return content
 
     def __init__(self, config, cookie_jar):
         # fix #218
@@ -170,7 +198,7 @@ class PixivBrowser(mechanize.Browser):
             try:
                 page = self.open_with_retry(req)
                 if returnParsed:
-                    parsedPage = BeautifulSoup(page.read())
+                    parsedPage = BeautifulSoup(page.read(), features=PixivHtmlParser.getFeatures(self._config.htmlParser))
                     return parsedPage
                 else:
                     return page
@@ -342,8 +370,10 @@ class PixivBrowser(mechanize.Browser):
         response = None
         PixivHelper.GetLogger().debug("Getting image page: %s", image_id)
         url = "https://www.pixiv.net/member_illust.php?mode=medium&illust_id={0}".format(image_id)
-        # response = self.open(url).read()
-        response = self.getPixivPage(url, returnParsed=False).read()
+        # prefetched by PixivAsyncBrowser
+        response = self._get_from_cache(url)
+        if response is None:
+            response = self.getPixivPage(url, returnParsed=False).read()
         self.handleDebugMediumPage(response, image_id)
 
         # Issue #355 new ui handler
@@ -402,8 +432,7 @@ class PixivBrowser(mechanize.Browser):
                 PixivHelper.GetLogger().debug("using webrpc: %s", url)
                 info = self._get_from_cache(url)
                 if info is None:
-                    request = urllib.request.Request(url)
-                    infoStr = self.open_with_retry(request).read()
+                    infoStr = self._open_with_cache(url)
                     info = json.loads(infoStr)
                     self._put_to_cache(url, info)
             else:
@@ -419,6 +448,12 @@ class PixivBrowser(mechanize.Browser):
 
                 url = 'https://app-api.pixiv.net/v1/user/detail?user_id={0}'.format(member_id)
                 info = self._get_from_cache(url)
+                cache = PixivCache.getCache(self._config)
+                if info is None and cache is not None:
+                    entry = cache.get(url)
+                    if entry is not None and entry.isFresh:
+                        info = json.loads(entry.content)
+                        self._put_to_cache(url, info)
                 if info is None:
                     PixivHelper.GetLogger().debug("Getting member information: %s", member_id)
                     login_response = self._oauth_manager.login()
@@ -430,6 +465,8 @@ class PixivBrowser(mechanize.Browser):
                     response = self._oauth_manager.get_user_info(member_id)
                     info = json.loads(response.text)
                     self._put_to_cache(url, info)
+                    if cache is not None:
+                        cache.put(url, response.text, expiration=self._config.persistentCacheExpiration)
                     PixivHelper.GetLogger().debug("reply: %s", response.text)
 
             artist.ParseInfo(info, False, bookmark=bookmark)
@@ -438,7 +475,7 @@ class PixivBrowser(mechanize.Browser):
             url_ajax = 'https://www.pixiv.net/ajax/user/{0}'.format(member_id)
             info_ajax = self._get_from_cache(url_ajax)
             if info_ajax is None:
-                info_ajax_str = self.open_with_retry(url_ajax).read()
+                info_ajax_str = self._open_with_cache(url_ajax)
                 info_ajax = json.loads(info_ajax_str)
                 self._put_to_cache(url_ajax, info_ajax)
             # 2nd pass to get the background
@@ -449,7 +486,7 @@ class PixivBrowser(mechanize.Browser):
             errorCode = error.getcode()
             errorMessage = error.get_data()
             PixivHelper.GetLogger().error("Error data: \r\n %s", errorMessage)
-            payload = demjson.decode(errorMessage)
+            payload = PixivHelper.parseJson(errorMessage)
             # Issue #432
             if "message" in payload:
                 msg = payload["message"]
@@ -466,7 +503,8 @@ class PixivBrowser(mechanize.Browser):
             else:
                 raise PixivException(msg, errorCode=PixivException.OTHER_MEMBER_ERROR, htmlPage=errorMessage)
 
-    def getMemberPage(self, member_id, page=1, bookmark=False, tags=None):
+    def getMemberPage(self, member_id, page=1, bookmark=False, tags=None, last_image_id=0):
+        '''last_image_id is used to skip older images, only for profile/all (no tags/bookmark/r18mode).'''
         artist = None
         response = None
         if tags is not None:
@@ -501,14 +539,14 @@ class PixivBrowser(mechanize.Browser):
             response = self._get_from_cache(url)
             if response is None:
                 try:
-                    response = self.open_with_retry(url).read()
+                    response = self._open_with_cache(url)
                 except urllib.error.HTTPError as ex:
                     if ex.code == 404:
                         response = ex.read()
                 self._put_to_cache(url, response)
 
             PixivHelper.GetLogger().debug(response)
-            artist = PixivModelWhiteCube.PixivArtist(member_id, response, False, offset, limit)
+            artist = PixivModelWhiteCube.PixivArtist(member_id, response, False, offset, limit, last_image_id if need_to_slice else 0)
             artist.reference_image_id = artist.imageList[0] if len(artist.imageList) > 0 else 0
             self.getMemberInfoWhitecube(member_id, artist, bookmark)
 
@@ -553,7 +591,8 @@ class PixivBrowser(mechanize.Browser):
             response = self.getPixivPage(url, returnParsed=False).read()
             self.handleDebugTagSearchPage(response, url)
 
-            parse_search_page = BeautifulSoup(response)
+            # only extract the search result when htmlParser = fast
+            parse_search_page = PixivHtmlParser.parseHtml(response, self._config.htmlParser)
 
             result = PixivModel.PixivTags()
             if member_id is not None:
@@ -642,6 +681,22 @@ def getBrowser(config=None, cookieJar=None):
     return _browser
 
 
+def getDownloadBrowser():
+    '''Return the browser for the current thread.
+
+    Download worker threads get their own browser instance sharing the same cookie jar and config,
+    as mechanize.Browser is not thread safe.
+    '''
+    if threading.current_thread() is threading.main_thread():
+        return getBrowser()
+
+    browser = getattr(_threadBrowser, 'browser', None)
+    if browser is None:
+        browser = PixivBrowser(defaultConfig, defaultCookieJar)
+        _threadBrowser.browser = browser
+    return browser
+
+
 def getExistingBrowser():
     global _browser
     if _browser is None:
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=W0603
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+import PixivHelper
+
+script_path = PixivHelper.module_path()
+_cache = None
+_memoryCache = None
+
+
+class MemoryCache(object):
+    '''In-memory LRU cache with expiry, bounded by number of entries and estimated size in bytes.
+
+    get/put are O(1), expired entries are also removed by a background thread every purgeInterval seconds.
+    '''
+    maxEntries = 10000
+    maxSize = 64 * 1024 * 1024
+    purgeInterval = 60
+
+    hits = 0
+    misses = 0
+    evictions = 0
+    expired = 0
+    currentSize = 0
+
+    _items = None
+    _lock = None
+    _stop = None
+    _thread = None
+
+    def __init__(self, max_entries=10000, max_size=64 * 1024 * 1024, purge_interval=60):
+        self.maxEntries = max_entries
+        self.maxSize = max_size
+        self.purgeInterval = purge_interval
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        if purge_interval > 0:
+            self._thread = threading.Thread(target=self._purge_loop, name="MemoryCachePurge")
+            self._thread.daemon = True
+            self._thread.start()
+
+    @staticmethod
+    def estimateSize(item):
+        if isinstance(item, (bytes, str)):
+            return len(item)
+        try:
+            return len(json.dumps(item))
+        except (TypeError, ValueError):
+            return sys.getsizeof(item)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                self.misses = self.misses + 1
+                return None
+            (item, expiry, size) = entry
+            if expiry <= time.time():
+                del self._items[key]
+                self.currentSize = self.currentSize - size
+                self.expired = self.expired + 1
+                self.misses = self.misses + 1
+                return None
+            self._items.move_to_end(key)
+            self.hits = self.hits + 1
+            return item
+
+    def put(self, key, item, expiration=3600):
+        size = self.estimateSize(item)
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.currentSize = self.currentSize - old[2]
+            if size > self.maxSize:
+                # never fit, don't flush everything else for it.
+                return
+            self._items[key] = (item, time.time() + expiration, size)
+            self.currentSize = self.currentSize + size
+            while len(self._items) > self.maxEntries or self.currentSize > self.maxSize:
+                (_, (_, _, old_size)) = self._items.popitem(last=False)
+                self.currentSize = self.currentSize - old_size
+                self.evictions = self.evictions + 1
+
+    def purge(self):
+        '''Remove all expired entries, return the number of removed entries.'''
+        now = time.time()
+        with self._lock:
+            keys = [key for (key, (_, expiry, _)) in self._items.items() if expiry <= now]
+            for key in keys:
+                (_, _, size) = self._items.pop(key)
+                self.currentSize = self.currentSize - size
+            self.expired = self.expired + len(keys)
+        return len(keys)
+
+    def _purge_loop(self):
+        while not self._stop.wait(self.purgeInterval):
+            if self.purge() > 0:
+                PixivHelper.GetLogger().debug(str(self))
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.currentSize = 0
+
+    def close(self):
+        self._stop.set()
+        self.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __str__(self):
+        return "Memory cache: {0} entries, {1}, hits: {2}, misses: {3}, evictions: {4}, expired: {5}".format(len(self._items),
+                                                                                                            PixivHelper.sizeInStr(self.currentSize),
+                                                                                                            self.hits,
+                                                                                                            self.misses,
+                                                                                                            self.evictions,
+                                                                                                            self.expired)
+
+
+class PixivCache(object):
+    '''Persistent HTTP response cache stored in SQLite, keyed by url.
+
+    - entry is fresh until expiry, after that it need to be revalidated using ETag/Last-Modified.
+    - content is compressed, the total size is capped to maxSize bytes, least recently used is evicted first.
+    '''
+    maxSize = 100 * 1024 * 1024
+    conn = None
+    _lock = None
+
+    def __init__(self, target='', max_size=100 * 1024 * 1024):
+        if target is None or len(target) == 0:
+            target = script_path + os.sep + "cache.sqlite"
+        self.maxSize = max_size
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(target, check_same_thread=False)
+        self.createCache()
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    def createCache(self):
+        with self._lock:
+            c = self.conn.cursor()
+            try:
+                c.execute('''CREATE TABLE IF NOT EXISTS http_cache (
+                                url TEXT PRIMARY KEY,
+                                content BLOB,
+                                etag TEXT,
+                                last_modified TEXT,
+                                expiry REAL,
+                                last_access REAL,
+                                size INTEGER
+                                )''')
+                c.execute('''CREATE INDEX IF NOT EXISTS http_cache_last_access ON http_cache (last_access)''')
+                self.conn.commit()
+            finally:
+                c.close()
+
+    def get(self, url):
+        '''Return CacheEntry or None if not available, update the access time.'''
+        with self._lock:
+            c = self.conn.cursor()
+            try:
+                c.execute('''SELECT content, etag, last_modified, expiry FROM http_cache WHERE url = ?''', (url,))
+                row = c.fetchone()
+                if row is None:
+                    return None
+                c.execute('''UPDATE http_cache SET last_access = ? WHERE url = ?''', (time.time(), url))
+                self.conn.commit()
+            finally:
+                c.close()
+        return CacheEntry(url, zlib.decompress(row[0]), row[1], row[2], row[3])
+
+    def put(self, url, content, etag=None, last_modified=None, expiration=3600):
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        data = zlib.compress(content)
+        now = time.time()
+        with self._lock:
+            c = self.conn.cursor()
+            try:
+                c.execute('''INSERT OR REPLACE INTO http_cache (url, content, etag, last_modified, expiry, last_access, size)
+                             VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                          (url, sqlite3.Binary(data), etag, last_modified, now + expiration, now, len(data)))
+                self.conn.commit()
+            finally:
+                c.close()
+            self.evict()
+
+    def touch(self, url, expiration=3600):
+        '''Extend the expiry after successful revalidation (HTTP 304).'''
+        now = time.time()
+        with self._lock:
+            c = self.conn.cursor()
+            try:
+                c.execute('''UPDATE http_cache SET expiry = ?, last_access = ? WHERE url = ?''', (now + expiration, now, url))
+                self.conn.commit()
+            finally:
+                c.close()
+
+    def totalSize(self):
+        with self._lock:
+            c = self.conn.cursor()
+            try:
+                c.execute('''SELECT COALESCE(SUM(size), 0) FROM http_cache''')
+                return c.fetchone()[0]
+            finally:
+                c.close()
+
+    def evict(self):
+        '''Remove least recently used entries until the total size is under maxSize.'''
+        with self._lock:
+            total = self.totalSize()
+            if total <= self.maxSize:
+                return 0
+            c = self.conn.cursor()
+            removed = list()
+            try:
+                c.execute('''SELECT url, size FROM http_cache ORDER BY last_access ASC''')
+                for (url, size) in c.fetchall():
+                    if total <= self.maxSize:
+                        break
+                    removed.append((url,))
+                    total = total - size
+                c.executemany('''DELETE FROM http_cache WHERE url = ?''', removed)
+                self.conn.commit()
+            finally:
+                c.close()
+            PixivHelper.GetLogger().debug("Evicted %d entries from http cache.", len(removed))
+            return len(removed)
+
+    def clear(self):
+        with self._lock:
+            c = self.conn.cursor()
+            try:
+                c.execute('''DELETE FROM http_cache''')
+                self.conn.commit()
+            finally:
+                c.close()
+
+
+class CacheEntry(object):
+    url = ''
+    content = None
+    etag = None
+    lastModified = None
+    expiry = 0
+
+    def __init__(self, url, content, etag, last_modified, expiry):
+        self.url = url
+        self.content = content
+        self.etag = etag
+        self.lastModified = last_modified
+        self.expiry = expiry
+
+    @property
+    def isFresh(self):
+        return self.expiry > time.time()
+
+
+def getCache(config):
+    '''Return the shared persistent cache, or None if disabled (usePersistentCache = False).'''
+    global _cache
+    if config is None or not config.usePersistentCache:
+        return None
+    if _cache is None:
+        _cache = PixivCache(config.persistentCachePath, config.persistentCacheSize * 1024 * 1024)
+    return _cache
+
+
+def getMemoryCache(config=None):
+    '''Return the shared in-memory cache, the budget is from memoryCacheSize (MB) and memoryCacheEntries.'''
+    global _memoryCache
+    if _memoryCache is None:
+        if config is not None:
+            _memoryCache = MemoryCache(config.memoryCacheEntries, config.memoryCacheSize * 1024 * 1024)
+        else:
+            _memoryCache = MemoryCache()
+    elif config is not None:
+        _memoryCache.maxEntries = config.memoryCacheEntries
+        _memoryCache.maxSize = config.memoryCacheSize * 1024 * 1024
+    return _memoryCache
+
+
+def closeCache():
+    global _cache
+    global _memoryCache
+    if _cache is not None:
+        _cache.close()
+        _cache = None
+    if _memoryCache is not None:
+        PixivHelper.GetLogger().info(str(_memoryCache))
+        _memoryCache.close()
+        _memoryCache = None
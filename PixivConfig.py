@@ -32,6 +32,21 @@ class PixivConfig(object):
     downloadDelay = 2
     checkNewVersion = True
     enableSSLVerification = True
+    downloadWorkers = 1
+    downloadMaxPerHost = 2
+    downloadQueueSize = 16
+    httpBackend = "mechanize"
+    asyncMaxConnection = 100
+    conditionalDownload = False
+    resumeDownload = True
+    usePersistentCache = False
+    persistentCachePath = ''
+    persistentCacheSize = 100
+    persistentCacheExpiration = 3600
+    memoryCacheSize = 64
+    memoryCacheEntries = 10000
+    htmlParser = "fast"
+    downloadWriterThread = False
 
     # Authentication related
     username = ''
@@ -52,6 +67,7 @@ class PixivConfig(object):
     dayLastUpdated = 7
     alwaysCheckFileSize = False
     checkUpdatedLimit = 0
+    incrementalMemberUpdate = False
     downloadAvatar = True
     useBlacklistTags = False
     useSuppressTags = False
@@ -65,6 +81,10 @@ class PixivConfig(object):
     writeUrlInDescription = False
     urlBlacklistRegex = ""
     dbPath = ''
+    dbJournalMode = 'WAL'
+    dbSynchronous = 'NORMAL'
+    dbWriterThread = False
+    dedupeMode = 'none'
     useBlacklistMembers = False
     setLastModified = True
     alwaysCheckFileExists = False
@@ -85,10 +105,12 @@ class PixivConfig(object):
     createUgoira = False
     deleteZipFile = False
     createGif = False
+    gifSharedPalette = False
     createApng = False
     deleteUgoira = False
     createWebm = False
     createWebp = False
+    conversionWorkers = 0
 
     # IrfanView
     createDownloadLists = False
@@ -598,6 +620,170 @@ class PixivConfig(object):
                 self.enableSSLVerification = False
                 haveError = True
 
+            try:
+                self.downloadWorkers = config.getint('Network', 'downloadWorkers')
+            except ValueError:
+                print("downloadWorkers = 1")
+                self.downloadWorkers = 1
+                haveError = True
+
+            try:
+                self.downloadMaxPerHost = config.getint('Network', 'downloadMaxPerHost')
+            except ValueError:
+                print("downloadMaxPerHost = 2")
+                self.downloadMaxPerHost = 2
+                haveError = True
+
+            try:
+                self.downloadQueueSize = config.getint('Network', 'downloadQueueSize')
+            except ValueError:
+                print("downloadQueueSize = 16")
+                self.downloadQueueSize = 16
+                haveError = True
+
+            try:
+                self.httpBackend = config.get('Network', 'httpBackend')
+                if self.httpBackend not in ('mechanize', 'asyncio'):
+                    raise ValueError('Invalid httpBackend: {0}'.format(self.httpBackend))
+            except ValueError:
+                print("httpBackend = mechanize")
+                self.httpBackend = "mechanize"
+                haveError = True
+
+            try:
+                self.asyncMaxConnection = config.getint('Network', 'asyncMaxConnection')
+            except ValueError:
+                print("asyncMaxConnection = 100")
+                self.asyncMaxConnection = 100
+                haveError = True
+
+            try:
+                self.conditionalDownload = config.getboolean('Network', 'conditionalDownload')
+            except ValueError:
+                print("conditionalDownload = False")
+                self.conditionalDownload = False
+                haveError = True
+
+            try:
+                self.resumeDownload = config.getboolean('Network', 'resumeDownload')
+            except ValueError:
+                print("resumeDownload = True")
+                self.resumeDownload = True
+                haveError = True
+
+            try:
+                self.usePersistentCache = config.getboolean('Network', 'usePersistentCache')
+            except ValueError:
+                print("usePersistentCache = False")
+                self.usePersistentCache = False
+                haveError = True
+
+            try:
+                self.persistentCachePath = config.get('Network', 'persistentCachePath')
+            except ValueError:
+                print("persistentCachePath = ''")
+                self.persistentCachePath = ''
+                haveError = True
+
+            try:
+                self.persistentCacheSize = config.getint('Network', 'persistentCacheSize')
+            except ValueError:
+                print("persistentCacheSize = 100")
+                self.persistentCacheSize = 100
+                haveError = True
+
+            try:
+                self.persistentCacheExpiration = config.getint('Network', 'persistentCacheExpiration')
+            except ValueError:
+                print("persistentCacheExpiration = 3600")
+                self.persistentCacheExpiration = 3600
+                haveError = True
+
+            try:
+                self.memoryCacheSize = config.getint('Network', 'memoryCacheSize')
+            except ValueError:
+                print("memoryCacheSize = 64")
+                self.memoryCacheSize = 64
+                haveError = True
+
+            try:
+                self.memoryCacheEntries = config.getint('Network', 'memoryCacheEntries')
+            except ValueError:
+                print("memoryCacheEntries = 10000")
+                self.memoryCacheEntries = 10000
+                haveError = True
+
+            try:
+                self.htmlParser = config.get('Network', 'htmlParser')
+                if self.htmlParser not in ('fast', 'lxml', 'html.parser'):
+                    raise ValueError('Invalid htmlParser: {0}'.format(self.htmlParser))
+            except ValueError:
+                print("htmlParser = fast")
+                self.htmlParser = "fast"
+                haveError = True
+
+            try:
+                self.downloadWriterThread = config.getboolean('Network', 'downloadWriterThread')
+            except ValueError:
+                print("downloadWriterThread = False")
+                self.downloadWriterThread = False
+                haveError = True
+
+            try:
+                self.incrementalMemberUpdate = config.getboolean('Settings', 'incrementalMemberUpdate')
+            except ValueError:
+                self.incrementalMemberUpdate = False
+                print("incrementalMemberUpdate = False")
+                haveError = True
+
+            try:
+                self.dbJournalMode = config.get('Settings', 'dbJournalMode').upper()
+                if self.dbJournalMode not in ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'):
+                    raise ValueError("Invalid dbJournalMode: " + self.dbJournalMode)
+            except ValueError:
+                print("dbJournalMode = WAL")
+                self.dbJournalMode = 'WAL'
+                haveError = True
+
+            try:
+                self.dbSynchronous = config.get('Settings', 'dbSynchronous').upper()
+                if self.dbSynchronous not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+                    raise ValueError("Invalid dbSynchronous: " + self.dbSynchronous)
+            except ValueError:
+                print("dbSynchronous = NORMAL")
+                self.dbSynchronous = 'NORMAL'
+                haveError = True
+
+            try:
+                self.dbWriterThread = config.getboolean('Settings', 'dbWriterThread')
+            except ValueError:
+                print("dbWriterThread = False")
+                self.dbWriterThread = False
+                haveError = True
+
+            try:
+                self.dedupeMode = config.get('Settings', 'dedupeMode').lower()
+                if self.dedupeMode not in ('none', 'hardlink', 'reflink', 'skip'):
+                    raise ValueError('Invalid dedupeMode: {0}'.format(self.dedupeMode))
+            except ValueError:
+                print("dedupeMode = none")
+                self.dedupeMode = 'none'
+                haveError = True
+
+            try:
+                self.gifSharedPalette = config.getboolean('Ugoira', 'gifSharedPalette')
+            except ValueError:
+                print("gifSharedPalette = False")
+                self.gifSharedPalette = False
+                haveError = True
+
+            try:
+                self.conversionWorkers = config.getint('Ugoira', 'conversionWorkers')
+            except ValueError:
+                print("conversionWorkers = 0")
+                self.conversionWorkers = 0
+                haveError = True
+
         except BaseException:
             print('Error at loadConfig():', sys.exc_info())
             self.__logger.exception('Error at loadConfig()')
@@ -626,6 +812,21 @@ class PixivConfig(object):
         config.set('Network', 'downloadDelay', self.downloadDelay)
         config.set('Network', 'checkNewVersion', self.checkNewVersion)
         config.set('Network', 'enableSSLVerification', self.enableSSLVerification)
+        config.set('Network', 'downloadWorkers', self.downloadWorkers)
+        config.set('Network', 'downloadMaxPerHost', self.downloadMaxPerHost)
+        config.set('Network', 'downloadQueueSize', self.downloadQueueSize)
+        config.set('Network', 'httpBackend', self.httpBackend)
+        config.set('Network', 'asyncMaxConnection', self.asyncMaxConnection)
+        config.set('Network', 'conditionalDownload', self.conditionalDownload)
+        config.set('Network', 'resumeDownload', self.resumeDownload)
+        config.set('Network', 'usePersistentCache', self.usePersistentCache)
+        config.set('Network', 'persistentCachePath', self.persistentCachePath)
+        config.set('Network', 'persistentCacheSize', self.persistentCacheSize)
+        config.set('Network', 'persistentCacheExpiration', self.persistentCacheExpiration)
+        config.set('Network', 'memoryCacheSize', self.memoryCacheSize)
+        config.set('Network', 'memoryCacheEntries', self.memoryCacheEntries)
+        config.set('Network', 'htmlParser', self.htmlParser)
+        config.set('Network', 'downloadWriterThread', self.downloadWriterThread)
 
         config.add_section('Debug')
         config.set('Debug', 'logLevel', self.logLevel)
@@ -650,6 +851,7 @@ class PixivConfig(object):
         config.set('Settings', 'rootdirectory', self.rootDirectory)
         config.set('Settings', 'alwaysCheckFileSize', self.alwaysCheckFileSize)
         config.set('Settings', 'checkUpdatedLimit', self.checkUpdatedLimit)
+        config.set('Settings', 'incrementalMemberUpdate', self.incrementalMemberUpdate)
         config.set('Settings', 'downloadAvatar', self.downloadAvatar)
         config.set('Settings', 'useBlacklistTags', self.useBlacklistTags)
         config.set('Settings', 'useSuppressTags', self.useSuppressTags)
@@ -663,6 +865,10 @@ class PixivConfig(object):
         config.set('Settings', 'writeUrlInDescription', self.writeUrlInDescription)
         config.set('Settings', 'urlBlacklistRegex', self.urlBlacklistRegex)
         config.set('Settings', 'dbPath', self.dbPath)
+        config.set('Settings', 'dbJournalMode', self.dbJournalMode)
+        config.set('Settings', 'dbSynchronous', self.dbSynchronous)
+        config.set('Settings', 'dbWriterThread', self.dbWriterThread)
+        config.set('Settings', 'dedupeMode', self.dedupeMode)
         config.set('Settings', 'useBlacklistMembers', self.useBlacklistMembers)
         config.set('Settings', 'setLastModified', self.setLastModified)
         config.set('Settings', 'useLocalTimezone', self.useLocalTimezone)
@@ -700,10 +906,12 @@ class PixivConfig(object):
         config.set('Ugoira', 'createUgoira', self.createUgoira)
         config.set('Ugoira', 'deleteZipFile', self.deleteZipFile)
         config.set('Ugoira', 'createGif', self.createGif)
+        config.set('Ugoira', 'gifSharedPalette', self.gifSharedPalette)
         config.set('Ugoira', 'createApng', self.createApng)
         config.set('Ugoira', 'deleteUgoira', self.deleteUgoira)
         config.set('Ugoira', 'createWebm', self.createWebm)
         config.set('Ugoira', 'createWebp', self.createWebp)
+        config.set('Ugoira', 'conversionWorkers', self.conversionWorkers)
 
         if path is not None:
             configlocation = path
@@ -748,6 +956,21 @@ class PixivConfig(object):
         print(' - downloadDelay    =', self.downloadDelay)
         print(' - checkNewVersion  =', self.checkNewVersion)
         print(' - enableSSLVerification =', self.enableSSLVerification)
+        print(' - downloadWorkers  =', self.downloadWorkers)
+        print(' - downloadMaxPerHost    =', self.downloadMaxPerHost)
+        print(' - downloadQueueSize     =', self.downloadQueueSize)
+        print(' - httpBackend      =', self.httpBackend)
+        print(' - asyncMaxConnection    =', self.asyncMaxConnection)
+        print(' - conditionalDownload   =', self.conditionalDownload)
+        print(' - resumeDownload   =', self.resumeDownload)
+        print(' - usePersistentCache    =', self.usePersistentCache)
+        print(' - persistentCachePath   =', self.persistentCachePath)
+        print(' - persistentCacheSize   =', self.persistentCacheSize)
+        print(' - persistentCacheExpiration =', self.persistentCacheExpiration)
+        print(' - memoryCacheSize  =', self.memoryCacheSize)
+        print(' - memoryCacheEntries    =', self.memoryCacheEntries)
+        print(' - htmlParser       =', self.htmlParser)
+        print(' - downloadWriterThread =', self.downloadWriterThread)
 
         print(' [Debug]')
         print(' - logLevel         =', self.logLevel)
@@ -772,6 +995,7 @@ class PixivConfig(object):
         print(' - rootDirectory    =', self.rootDirectory)
         print(' - alwaysCheckFileSize   =', self.alwaysCheckFileSize)
         print(' - checkUpdatedLimit     =', self.checkUpdatedLimit)
+        print(' - incrementalMemberUpdate =', self.incrementalMemberUpdate)
         print(' - downloadAvatar   =', self.downloadAvatar)
         print(' - useBlacklistTags =', self.useBlacklistTags)
         print(' - useSuppressTags  =', self.useSuppressTags)
@@ -785,6 +1009,10 @@ class PixivConfig(object):
         print(' - writeUrlInDescription =', self.writeUrlInDescription)
         print(' - urlBlacklistRegex =', self.urlBlacklistRegex)
         print(' - dbPath           =', self.dbPath)
+        print(' - dbJournalMode    =', self.dbJournalMode)
+        print(' - dbSynchronous    =', self.dbSynchronous)
+        print(' - dbWriterThread   =', self.dbWriterThread)
+        print(' - dedupeMode       =', self.dedupeMode)
         print(' - useBlacklistMembers  =', self.useBlacklistMembers)
         print(' - setLastModified  =', self.setLastModified)
         print(' - useLocalTimezone =', self.useLocalTimezone)
@@ -816,8 +1044,10 @@ class PixivConfig(object):
         print(' - createUgoira     =', self.createUgoira)
         print(' - deleteZipFile    =', self.deleteZipFile)
         print(' - createGif        =', self.createGif)
+        print(' - gifSharedPalette =', self.gifSharedPalette)
         print(' - createApng       =', self.createApng)
         print(' - deleteUgoira     =', self.deleteUgoira)
         print(' - createWebm       =', self.createWebm)
         print(' - createWebp       =', self.createWebp)
+        print(' - conversionWorkers =', self.conversionWorkers)
         print('')
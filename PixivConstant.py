@@ -35,3 +35,10 @@ PIXIVUTIL_CHECK_DOWNLOAD = 6
 PIXIVUTIL_ABORTED = 9999
 
 BUFFER_SIZE = 8192
+# the download buffer grow from BUFFER_SIZE up to this size
+MAX_BUFFER_SIZE = 1048576
+# seconds between download progress update
+PROGRESS_INTERVAL = 0.5
+
+# hashlib algorithm for the downloaded file content hash
+CONTENT_HASH = 'sha256'
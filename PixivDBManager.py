@@ -5,9 +5,14 @@
 
 import codecs
 import os
+import queue
 import re
 import sqlite3
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 
 import PixivConfig
@@ -17,9 +22,133 @@ from PixivModel import PixivListItem
 script_path = PixivHelper.module_path()
 
 
+def applyPragma(conn, journal_mode='WAL', synchronous='NORMAL'):
+    '''Set the journal mode and synchronous level, WAL is not supported on some network drive.'''
+    try:
+        conn.execute('PRAGMA journal_mode = {0}'.format(journal_mode))
+        conn.execute('PRAGMA synchronous = {0}'.format(synchronous))
+    except sqlite3.Error:
+        PixivHelper.print_and_log('warn', 'Failed to set journal_mode={0}, synchronous={1}: {2}'.format(journal_mode, synchronous, sys.exc_info()[1]))
+
+
+class DBWriter(object):
+    '''Execute the queued write statements in a dedicated thread using its own connection.
+
+    Commit once the queue is empty or after batchSize statements,
+    the statements from submitBatch() are applied all or nothing.
+    '''
+    batchSize = 100
+
+    _queue = None
+    _thread = None
+
+    def __init__(self, target, timeout=5 * 60, journal_mode='WAL', synchronous='NORMAL', batch_size=100):
+        self.batchSize = batch_size
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, args=(target, timeout, journal_mode, synchronous), name="DBWriter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, query, params=()):
+        self._queue.put([(query, params)])
+
+    def submitBatch(self, statements):
+        '''Queue the list of (query, params), see PixivDBManager.transaction()'''
+        if len(statements) > 0:
+            self._queue.put(list(statements))
+
+    def flush(self):
+        '''Wait until all submitted statements are committed.'''
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self, target, timeout, journal_mode, synchronous):
+        conn = sqlite3.connect(target, timeout)
+        applyPragma(conn, journal_mode, synchronous)
+        pending = 0
+        while True:
+            item = self._queue.get()
+            if item is not None:
+                try:
+                    if len(item) == 1:
+                        conn.execute(item[0][0], item[0][1])
+                    else:
+                        self._executeBatch(conn, item)
+                except BaseException:
+                    PixivHelper.print_and_log('error', 'Error at DBWriter: {0} {1}'.format(item, sys.exc_info()))
+                pending = pending + 1
+            if item is None or pending >= self.batchSize or self._queue.empty():
+                try:
+                    conn.commit()
+                except BaseException:
+                    PixivHelper.print_and_log('error', 'Error at DBWriter commit: {0}'.format(sys.exc_info()))
+                for _ in range(pending):
+                    self._queue.task_done()
+                pending = 0
+            if item is None:
+                self._queue.task_done()
+                break
+        conn.close()
+
+    def _executeBatch(self, conn, statements):
+        # savepoint, so the failed batch does not roll back the other pending statements
+        conn.execute('SAVEPOINT batch')
+        try:
+            for (query, params) in statements:
+                conn.execute(query, params)
+        except BaseException:
+            conn.execute('ROLLBACK TO batch')
+            raise
+        finally:
+            conn.execute('RELEASE batch')
+
+
+# file extension checked by indexDownloadedFiles()
+DOWNLOADED_FILE_EXT = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.zip', '.ugoira', '.apng', '.webm', '.webp')
+
+# (schema version, description, statements), stored in PRAGMA user_version.
+# Append new migration at the end and never change the released ones.
+DB_MIGRATIONS = [
+    (1, 'add pixiv_master_member.is_deleted',
+     ['''ALTER TABLE pixiv_master_member ADD COLUMN is_deleted INTEGER DEFAULT 0''']),
+    (2, 'add pixiv_master_image.is_manga',
+     ['''ALTER TABLE pixiv_master_image ADD COLUMN is_manga TEXT''']),
+    (3, 'add indexes for member_id, save_name and last_update_date',
+     ['''CREATE INDEX IF NOT EXISTS pixiv_master_image_member_id ON pixiv_master_image (member_id, save_name)''',
+      # LIKE is case insensitive, the index need NOCASE to be used by replaceRootPath()
+      '''CREATE INDEX IF NOT EXISTS pixiv_master_image_save_name ON pixiv_master_image (save_name COLLATE NOCASE)''',
+      '''CREATE INDEX IF NOT EXISTS pixiv_manga_image_save_name ON pixiv_manga_image (save_name COLLATE NOCASE)''',
+      '''CREATE INDEX IF NOT EXISTS pixiv_master_member_last_update_date ON pixiv_master_member (last_update_date)''',
+      '''ANALYZE''']),
+    (4, 'add pixiv_file_hash for dedupeMode',
+     ['''CREATE TABLE IF NOT EXISTS pixiv_file_hash (
+            save_name TEXT PRIMARY KEY,
+            file_size INTEGER,
+            content_hash TEXT,
+            url TEXT,
+            last_update_date DATE
+            )''',
+      '''CREATE INDEX IF NOT EXISTS pixiv_file_hash_content_hash ON pixiv_file_hash (content_hash, file_size)''',
+      '''CREATE INDEX IF NOT EXISTS pixiv_file_hash_url ON pixiv_file_hash (url)''']),
+    # separate from last_image, it is the last processed image id of any download mode
+    (5, 'add pixiv_member_incremental for incrementalMemberUpdate',
+     ['''CREATE TABLE IF NOT EXISTS pixiv_member_incremental (
+            member_id INTEGER PRIMARY KEY,
+            image_id INTEGER,
+            last_update_date DATE
+            )''']),
+]
+
+
 class PixivDBManager(object):
     """Pixiv Database Manager"""
     __config__ = None
+    _batchDepth = 0
+    _batch = None
+    _writer = None
 
     def __init__(self, target='', config=None, timeout=5 * 60):
         if target is None or len(target) == 0:
@@ -35,9 +164,64 @@ class PixivDBManager(object):
             self.__config__ = PixivConfig.PixivConfig()
             self.__config__.loadConfig()
 
+        applyPragma(self.conn, self.__config__.dbJournalMode, self.__config__.dbSynchronous)
+        if self.__config__.dbWriterThread and target != ':memory:':
+            self._writer = DBWriter(target, timeout, self.__config__.dbJournalMode, self.__config__.dbSynchronous)
+
     def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
         self.conn.close()
 
+    def flush(self):
+        '''Wait for the writer thread, so the pending changes are visible.'''
+        if self._writer is not None:
+            self._writer.flush()
+
+    def _commit(self):
+        if self._batchDepth == 0:
+            self.conn.commit()
+
+    def _write(self, query, params=()):
+        if self._writer is not None:
+            if self._batchDepth > 0:
+                self._batch.append((query, params))
+            else:
+                self._writer.submit(query, params)
+            return
+        c = self.conn.cursor()
+        try:
+            c.execute(query, params)
+            self._commit()
+        finally:
+            c.close()
+
+    @contextmanager
+    def transaction(self):
+        '''Commit all the changes inside the block at once, e.g. per image instead of per statement.
+
+        With dbWriterThread the changes are queued to the writer as one batch when the block ends,
+        so they are not visible to the select inside the block.
+        '''
+        if self._batchDepth == 0:
+            self._batch = list()
+        self._batchDepth = self._batchDepth + 1
+        try:
+            yield self
+        except BaseException:
+            self._batchDepth = self._batchDepth - 1
+            if self._batchDepth == 0:
+                self.conn.rollback()
+                self._batch = None
+            raise
+        self._batchDepth = self._batchDepth - 1
+        if self._batchDepth == 0:
+            self.conn.commit()
+            if self._writer is not None:
+                self._writer.submitBatch(self._batch)
+            self._batch = None
+
 ##########################################
 ## I. Create/Drop Database              ##
 ##########################################
@@ -47,6 +231,7 @@ class PixivDBManager(object):
         try:
             c = self.conn.cursor()
 
+            # initial schema (version 0), the changes after this are in DB_MIGRATIONS
             c.execute('''CREATE TABLE IF NOT EXISTS pixiv_master_member (
                             member_id INTEGER PRIMARY KEY ON CONFLICT IGNORE,
                             name TEXT,
@@ -56,16 +241,6 @@ class PixivDBManager(object):
                             last_image INTEGER
                             )''')
 
-            self.conn.commit()
-
-            # add column isDeleted
-            # 0 = false, 1 = true
-            try:
-                c.execute('''ALTER TABLE pixiv_master_member ADD COLUMN is_deleted INTEGER DEFAULT 0''')
-                self.conn.commit()
-            except BaseException:
-                pass
-
             c.execute('''CREATE TABLE IF NOT EXISTS pixiv_master_image (
                             image_id INTEGER PRIMARY KEY,
                             member_id INTEGER,
@@ -74,11 +249,6 @@ class PixivDBManager(object):
                             created_date DATE,
                             last_update_date DATE
                             )''')
-            # add column isManga
-            try:
-                c.execute('''ALTER TABLE pixiv_master_image ADD COLUMN is_manga TEXT''')
-            except BaseException:
-                pass
 
             c.execute('''CREATE TABLE IF NOT EXISTS pixiv_manga_image (
                             image_id INTEGER,
@@ -88,9 +258,7 @@ class PixivDBManager(object):
                             last_update_date DATE,
                             PRIMARY KEY (image_id, page)
                             )''')
-            self.conn.commit()
-
-            print('done.')
+            self._commit()
         except BaseException:
             print('Error at createDatabase():', str(sys.exc_info()))
             print('failed.')
@@ -98,14 +266,53 @@ class PixivDBManager(object):
         finally:
             c.close()
 
+        self.upgradeDatabase()
+        print('done.')
+
+    def getSchemaVersion(self):
+        c = self.conn.cursor()
+        try:
+            c.execute('''PRAGMA user_version''')
+            return c.fetchone()[0]
+        finally:
+            c.close()
+
+    def upgradeDatabase(self):
+        '''Apply the migrations newer than the schema version stored in PRAGMA user_version, each in its own transaction.'''
+        version = self.getSchemaVersion()
+        for (target_version, description, statements) in DB_MIGRATIONS:
+            if target_version <= version:
+                continue
+            PixivHelper.print_and_log('info', 'Upgrading database to version {0}: {1}'.format(target_version, description))
+            try:
+                c = self.conn.cursor()
+                c.execute('''BEGIN''')
+                for statement in statements:
+                    try:
+                        c.execute(statement)
+                    except sqlite3.OperationalError as ex:
+                        # the column was added by older version without user_version
+                        if not str(ex).startswith('duplicate column name'):
+                            raise
+                c.execute('''PRAGMA user_version = {0:d}'''.format(target_version))
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                print('Error at upgradeDatabase():', str(sys.exc_info()))
+                print('failed.')
+                raise
+            finally:
+                c.close()
+            version = target_version
+
     def dropDatabase(self):
         try:
             c = self.conn.cursor()
             c.execute('''DROP IF EXISTS TABLE pixiv_master_member''')
-            self.conn.commit()
+            self._commit()
 
             c.execute('''DROP IF EXISTS TABLE pixiv_master_image''')
-            self.conn.commit()
+            self._commit()
         except BaseException:
             print('Error at dropDatabase():', str(sys.exc_info()))
             print('failed.')
@@ -119,7 +326,7 @@ class PixivDBManager(object):
         try:
             c = self.conn.cursor()
             c.execute('''VACUUM''')
-            self.conn.commit()
+            self._commit()
         except BaseException:
             print('Error at compactDatabase():', str(sys.exc_info()))
             raise
@@ -134,56 +341,54 @@ class PixivDBManager(object):
         print('Importing list...', end=' ')
         print('Found', len(listTxt), 'items', end=' ')
         try:
-            c = self.conn.cursor()
-
-            for item in listTxt:
-                c.execute('''INSERT OR IGNORE INTO pixiv_master_member VALUES(?, ?, ?, datetime('now'), '1-1-1', -1, 0)''',
-                                  (item.memberId, str(item.memberId), r'N\A'))
-                c.execute('''UPDATE pixiv_master_member
-                             SET save_folder = ?
-                             WHERE member_id = ? ''',
-                          (item.path, item.memberId))
-            self.conn.commit()
+            with self.transaction():
+                for item in listTxt:
+                    self._write('''INSERT OR IGNORE INTO pixiv_master_member VALUES(?, ?, ?, datetime('now'), '1-1-1', -1, 0)''',
+                                (item.memberId, str(item.memberId), r'N\A'))
+                    self._write('''UPDATE pixiv_master_member
+                                 SET save_folder = ?
+                                 WHERE member_id = ? ''',
+                                (item.path, item.memberId))
         except BaseException:
             print('Error at importList():', str(sys.exc_info()))
             print('failed')
             raise
-        finally:
-            c.close()
         print('done.')
         return 0
 
     def exportList(self, filename, include_artist_token=True):
         print('Exporting list...', end=' ')
+        if not filename.endswith(".txt"):
+            filename = filename + '.txt'
+        # the existing file is only replaced when the export is complete
+        temp_name = filename + '.tmp'
+        c = self.conn.cursor()
         try:
-            c = self.conn.cursor()
             c.execute('''SELECT member_id, save_folder, name
                          FROM pixiv_master_member
                          WHERE is_deleted = 0
                          ORDER BY member_id''')
-            if not filename.endswith(".txt"):
-                filename = filename + '.txt'
-
-            writer = codecs.open(filename, 'wb', encoding='utf-8')
-            writer.write('###Export date: ' + str(datetime.today()) + '###\r\n')
-            for row in c:
-                if include_artist_token:
-                    data = str(row[2])
-                    writer.write("# ")
-                    writer.write(data)
-                    writer.write("\r\n")
-                writer.write(str(row[0]))
-                if len(row[1]) > 0:
-                    writer.write(' ' + str(row[1]))
-                writer.write('\r\n')
-            writer.write('###END-OF-FILE###')
+            with codecs.open(temp_name, 'wb', encoding='utf-8') as writer:
+                writer.write('###Export date: ' + str(datetime.today()) + '###\r\n')
+                for row in c:
+                    if include_artist_token:
+                        data = str(row[2])
+                        writer.write("# ")
+                        writer.write(data)
+                        writer.write("\r\n")
+                    writer.write(str(row[0]))
+                    if len(row[1]) > 0:
+                        writer.write(' ' + str(row[1]))
+                    writer.write('\r\n')
+                writer.write('###END-OF-FILE###')
+            os.replace(temp_name, filename)
         except BaseException:
             print('Error at exportList():', str(sys.exc_info()))
             print('failed')
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
             raise
         finally:
-            if writer is not None:
-                writer.close()
             c.close()
         print('done.')
 
@@ -291,7 +496,6 @@ class PixivDBManager(object):
 ##########################################
     def insertNewMember(self):
         try:
-            c = self.conn.cursor()
             member_id = 0
             while True:
                 temp = input('Member ID: ')
@@ -302,14 +506,12 @@ class PixivDBManager(object):
                 if member_id > 0:
                     break
 
-            c.execute('''INSERT OR IGNORE INTO pixiv_master_member VALUES(?, ?, ?, datetime('now'), '1-1-1', -1, 0)''',
-                                  (member_id, str(member_id), r'N\A'))
+            self._write('''INSERT OR IGNORE INTO pixiv_master_member VALUES(?, ?, ?, datetime('now'), '1-1-1', -1, 0)''',
+                        (member_id, str(member_id), r'N\A'))
         except BaseException:
             print('Error at insertNewMember():', str(sys.exc_info()))
             print('failed')
             raise
-        finally:
-            c.close()
 
     def selectAllMember(self, isDeleted=False):
         l = list()
@@ -340,9 +542,11 @@ class PixivDBManager(object):
             except ValueError:
                 int_diff = 7
 
-            c.execute('''SELECT member_id, save_folder,  (julianday(Date('now')) - julianday(last_update_date)) as diff
+            # compare the column directly so the index on last_update_date can be used
+            c.execute('''SELECT member_id, save_folder
                          FROM pixiv_master_member
-                         WHERE is_deleted <> 1 AND ( last_image == -1 OR diff > ? ) ORDER BY member_id''', (int_diff, ))
+                         WHERE is_deleted <> 1 AND ( last_image == -1 OR last_update_date < datetime(date('now'), ?) ) ORDER BY member_id''',
+                      ('-{0} days'.format(int_diff), ))
             result = c.fetchall()
             for row in result:
                 item = PixivListItem(row[0], row[1])
@@ -358,6 +562,7 @@ class PixivDBManager(object):
         return l
 
     def selectMemberByMemberId(self, member_id):
+        self.flush()
         try:
             c = self.conn.cursor()
             c.execute('''SELECT * FROM pixiv_master_member WHERE member_id = ? ''', (member_id, ))
@@ -370,6 +575,7 @@ class PixivDBManager(object):
             c.close()
 
     def selectMemberByMemberId2(self, member_id):
+        self.flush()
         try:
             c = self.conn.cursor()
             c.execute('''SELECT member_id, save_folder FROM pixiv_master_member WHERE member_id = ? ''', (member_id, ))
@@ -396,140 +602,138 @@ class PixivDBManager(object):
 
     def updateMemberName(self, memberId, memberName):
         try:
-            c = self.conn.cursor()
-            c.execute('''UPDATE pixiv_master_member
+            self._write('''UPDATE pixiv_master_member
                             SET name = ?
                             WHERE member_id = ?
                             ''', (memberName, memberId))
-            self.conn.commit()
         except BaseException:
             print('Error at updateMemberId():', str(sys.exc_info()))
             print('failed')
             raise
-        finally:
-            c.close()
 
     def updateSaveFolder(self, memberId, saveFolder):
         try:
-            c = self.conn.cursor()
-            c.execute('''UPDATE pixiv_master_member
+            self._write('''UPDATE pixiv_master_member
                             SET save_folder = ?
                             WHERE member_id = ?
                             ''', (saveFolder, memberId))
-            self.conn.commit()
         except BaseException:
             print('Error at updateSaveFolder():', str(sys.exc_info()))
             print('failed')
             raise
-        finally:
-            c.close()
 
     def updateLastDownloadedImage(self, memberId, imageId):
         try:
-            c = self.conn.cursor()
-            c.execute('''UPDATE pixiv_master_member
+            self._write('''UPDATE pixiv_master_member
                             SET last_image = ?, last_update_date = datetime('now')
                             WHERE member_id = ?''',
                             (imageId, memberId))
-            self.conn.commit()
         except BaseException:
             print('Error at updateMemberId():', str(sys.exc_info()))
             print('failed')
             raise
+
+    def selectIncrementalImageId(self, memberId):
+        '''Return the newest image id of the member which all the older images are processed, 0 if not set.'''
+        self.flush()
+        try:
+            c = self.conn.cursor()
+            c.execute('''SELECT image_id FROM pixiv_member_incremental WHERE member_id = ?''', (memberId, ))
+            row = c.fetchone()
+            return int(row[0]) if row is not None and row[0] is not None else 0
+        except BaseException:
+            print('Error at selectIncrementalImageId():', str(sys.exc_info()))
+            print('failed')
+            raise
         finally:
             c.close()
 
+    def updateIncrementalImageId(self, memberId, imageId):
+        '''Only called after downloading the whole profile/all of the member, see incrementalMemberUpdate.'''
+        try:
+            self._write('''INSERT OR REPLACE INTO pixiv_member_incremental VALUES(?, ?, datetime('now'))''',
+                        (memberId, imageId))
+        except BaseException:
+            print('Error at updateIncrementalImageId():', str(sys.exc_info()))
+            print('failed')
+            raise
+
     def deleteMemberByMemberId(self, memberId):
         try:
-            c = self.conn.cursor()
-            c.execute('''DELETE FROM pixiv_master_member
-                            WHERE member_id = ?''',
-                            (memberId, ))
-            self.conn.commit()
+            with self.transaction():
+                self._write('''DELETE FROM pixiv_master_member
+                                WHERE member_id = ?''',
+                                (memberId, ))
+                self._write('''DELETE FROM pixiv_member_incremental
+                                WHERE member_id = ?''',
+                                (memberId, ))
         except BaseException:
             print('Error at deleteMemberByMemberId():', str(sys.exc_info()))
             print('failed')
             raise
-        finally:
-            c.close()
 
     def deleteCascadeMemberByMemberId(self, memberId):
         try:
-            c = self.conn.cursor()
-            c.execute('''DELETE FROM pixiv_master_image
-                            WHERE member_id = ?''',
-                            (memberId, ))
-            c.execute('''DELETE FROM pixiv_master_member
-                            WHERE member_id = ?''',
-                            (memberId, ))
-            self.conn.commit()
+            with self.transaction():
+                self._write('''DELETE FROM pixiv_master_image
+                                WHERE member_id = ?''',
+                                (memberId, ))
+                self._write('''DELETE FROM pixiv_master_member
+                                WHERE member_id = ?''',
+                                (memberId, ))
+                self._write('''DELETE FROM pixiv_member_incremental
+                                WHERE member_id = ?''',
+                                (memberId, ))
         except BaseException:
             print('Error at deleteCascadeMemberByMemberId():', str(sys.exc_info()))
             print('failed')
             raise
-        finally:
-            c.close()
 
     def setIsDeletedFlagForMemberId(self, memberId):
         try:
-            c = self.conn.cursor()
-            c.execute('''UPDATE pixiv_master_member
+            self._write('''UPDATE pixiv_master_member
                             SET is_deleted = 1, last_update_date = datetime('now')
                             WHERE member_id = ?''',
                             (memberId,))
-            self.conn.commit()
         except BaseException:
             print('Error at setIsDeletedMemberId():', str(sys.exc_info()))
             print('failed')
             raise
-        finally:
-            c.close()
 
 ##########################################
 ## V. CRUD Image Table                  ##
 ##########################################
     def insertImage(self, member_id, image_id, isManga=""):
         try:
-            c = self.conn.cursor()
             member_id = int(member_id)
             image_id = int(image_id)
-            c.execute('''INSERT OR IGNORE INTO pixiv_master_image VALUES(?, ?, 'N/A' ,'N/A' , datetime('now'), datetime('now'), ? )''',
+            self._write('''INSERT OR IGNORE INTO pixiv_master_image VALUES(?, ?, 'N/A' ,'N/A' , datetime('now'), datetime('now'), ? )''',
                       (image_id, member_id, isManga))
-            self.conn.commit()
         except BaseException:
             print('Error at insertImage():', str(sys.exc_info()))
             print('failed')
             raise
-        finally:
-            c.close()
 
     def insertMangaImage(self, imageId, page, filename):
         try:
-            c = self.conn.cursor()
-            c.execute('''INSERT OR IGNORE INTO pixiv_manga_image VALUES(?, ?, ?, datetime('now'), datetime('now'))''',
+            self._write('''INSERT OR IGNORE INTO pixiv_manga_image VALUES(?, ?, ?, datetime('now'), datetime('now'))''',
                               (imageId, page, filename))
-            self.conn.commit()
         except BaseException:
             print('Error at insertMangaImage():', str(sys.exc_info()))
             print('failed')
             raise
-        finally:
-            c.close()
 
     def blacklistImage(self, memberId, ImageId):
         try:
-            c = self.conn.cursor()
-            c.execute('''INSERT OR REPLACE INTO pixiv_master_image VALUES(?, ?, '**BLACKLISTED**' ,'**BLACKLISTED**' , datetime('now'), datetime('now') )''',
+            self._write('''INSERT OR REPLACE INTO pixiv_master_image VALUES(?, ?, '**BLACKLISTED**' ,'**BLACKLISTED**' , datetime('now'), datetime('now') )''',
                               (ImageId, memberId))
-            self.conn.commit()
         except BaseException:
             print('Error at insertImage():', str(sys.exc_info()))
             print('failed')
             raise
-        finally:
-            c.close()
 
     def selectImageByMemberId(self, member_id):
+        self.flush()
         try:
             c = self.conn.cursor()
             c.execute('''SELECT * FROM pixiv_master_image WHERE member_id = ? ''', (member_id,))
@@ -542,6 +746,7 @@ class PixivDBManager(object):
             c.close()
 
     def selectImageByMemberIdAndImageId(self, member_id, image_id):
+        self.flush()
         try:
             c = self.conn.cursor()
             c.execute('''SELECT image_id FROM pixiv_master_image WHERE image_id = ? AND save_name != 'N/A' AND member_id = ?''', (image_id, member_id))
@@ -554,6 +759,7 @@ class PixivDBManager(object):
             c.close()
 
     def selectImageByImageId(self, image_id, cols='*'):
+        self.flush()
         try:
             c = self.conn.cursor()
             c.execute('''SELECT %s FROM pixiv_master_image WHERE image_id = ? AND save_name != 'N/A' ''' % (cols,), (image_id,))
@@ -565,7 +771,31 @@ class PixivDBManager(object):
         finally:
             c.close()
 
+    def selectExistingImageIds(self, image_ids, member_id=None, chunk_size=500):
+        '''Return the set of image_ids already downloaded, queried in chunks to stay below the SQLite variable limit.'''
+        result = set()
+        image_ids = list(image_ids)
+        self.flush()
+        try:
+            c = self.conn.cursor()
+            for i in range(0, len(image_ids), chunk_size):
+                chunk = [int(x) for x in image_ids[i:i + chunk_size]]
+                query = '''SELECT image_id FROM pixiv_master_image WHERE save_name != 'N/A' AND image_id IN ({0})'''.format(','.join('?' * len(chunk)))
+                if member_id is not None:
+                    query = query + ''' AND member_id = ?'''
+                    chunk.append(member_id)
+                c.execute(query, chunk)
+                result.update(int(row[0]) for row in c.fetchall())
+            return result
+        except BaseException:
+            print('Error at selectExistingImageIds():', str(sys.exc_info()))
+            print('failed')
+            raise
+        finally:
+            c.close()
+
     def selectImageByImageIdAndPage(self, imageId, page):
+        self.flush()
         try:
             c = self.conn.cursor()
             c.execute('''SELECT * FROM pixiv_manga_image WHERE image_id = ? AND page = ? ''', (imageId, page))
@@ -579,33 +809,185 @@ class PixivDBManager(object):
 
     def updateImage(self, imageId, title, filename, isManga=""):
         try:
-            c = self.conn.cursor()
-            c.execute('''UPDATE pixiv_master_image
+            self._write('''UPDATE pixiv_master_image
                         SET title = ?, save_name = ?, last_update_date = datetime('now'), is_manga = ?
                         WHERE image_id = ?''',
                         (title, filename, isManga, imageId))
-            self.conn.commit()
         except BaseException:
             print('Error at updateImage():', str(sys.exc_info()))
             print('failed')
             raise
-        finally:
-            c.close()
 
     def deleteImage(self, imageId):
         try:
-            c = self.conn.cursor()
-            c.execute('''DELETE FROM pixiv_master_image
+            self._write('''DELETE FROM pixiv_master_image
                         WHERE image_id = ?''',
                         (imageId, ))
-            self.conn.commit()
         except BaseException:
             print('Error at deleteImage():', str(sys.exc_info()))
             print('failed')
             raise
+
+    def deleteImages(self, image_ids):
+        '''Delete the images in one transaction.'''
+        self.flush()
+        try:
+            c = self.conn.cursor()
+            with self.transaction():
+                c.executemany('''DELETE FROM pixiv_master_image
+                                 WHERE image_id = ?''',
+                              ((image_id, ) for image_id in image_ids))
+        except BaseException:
+            print('Error at deleteImages():', str(sys.exc_info()))
+            print('failed')
+            raise
+        finally:
+            c.close()
+
+##########################################
+## V-b. File Hash for dedupeMode        ##
+##########################################
+    def updateFileHash(self, filename, file_size, content_hash, url=None):
+        '''Save the content hash of the file, save_name is the absolute path.'''
+        try:
+            self._write('''INSERT OR REPLACE INTO pixiv_file_hash VALUES(?, ?, ?, ?, datetime('now'))''',
+                        (os.path.abspath(filename), file_size, content_hash, url))
+        except BaseException:
+            print('Error at updateFileHash():', str(sys.exc_info()))
+            print('failed')
+            raise
+
+    def selectFilesByUrl(self, url):
+        '''Return the (save_name, file_size, content_hash) of the files downloaded from the url.'''
+        self.flush()
+        try:
+            c = self.conn.cursor()
+            c.execute('''SELECT save_name, file_size, content_hash FROM pixiv_file_hash WHERE url = ?''', (url, ))
+            return c.fetchall()
+        except BaseException:
+            print('Error at selectFilesByUrl():', str(sys.exc_info()))
+            print('failed')
+            raise
+        finally:
+            c.close()
+
+    def selectFilesByHash(self, content_hash, file_size):
+        '''Return the (save_name, file_size, content_hash) of the files with the same content.'''
+        self.flush()
+        try:
+            c = self.conn.cursor()
+            c.execute('''SELECT save_name, file_size, content_hash FROM pixiv_file_hash WHERE content_hash = ? AND file_size = ?''',
+                      (content_hash, file_size))
+            return c.fetchall()
+        except BaseException:
+            print('Error at selectFilesByHash():', str(sys.exc_info()))
+            print('failed')
+            raise
+        finally:
+            c.close()
+
+    def findDuplicateFile(self, filename, url=None, content_hash=None, file_size=-1):
+        '''Return the (save_name, file_size, content_hash) of another file in the disk downloaded from the url,
+        or having the same content hash. None if not found.
+
+        The file is skipped if the size changed after it is hashed.
+        '''
+        if url is not None:
+            rows = self.selectFilesByUrl(url)
+        else:
+            rows = self.selectFilesByHash(content_hash, file_size)
+        filename = os.path.abspath(filename)
+        for row in rows:
+            if row[0] == filename or (file_size > 0 and row[1] != file_size):
+                continue
+            try:
+                if os.path.getsize(row[0]) != row[1]:
+                    continue
+                if os.path.exists(filename) and os.path.samefile(row[0], filename):
+                    continue
+            except OSError:
+                continue
+            return row
+        return None
+
+    @staticmethod
+    def _listDownloadedFiles(directory, recursive=True):
+        result = list()
+        for (dirpath, _, filenames) in os.walk(directory):
+            result.extend(os.path.join(dirpath, name) for name in filenames if os.path.splitext(name)[1].lower() in DOWNLOADED_FILE_EXT)
+            if not recursive:
+                break
+        return result
+
+    def hashDownloadedFiles(self, root_directory=None, workers=8, batch_size=1000):
+        '''Save the content hash of the downloaded files, so they can be used by dedupeMode.
+
+        The files already hashed with the same size are skipped. Files are hashed in a thread pool,
+        hashlib release the GIL while hashing. Return the number of hashed files.
+        '''
+        if root_directory is None:
+            root_directory = self.__config__.rootDirectory
+        root_directory = os.path.abspath(root_directory)
+
+        print("Scanning {0}".format(root_directory))
+        start = time.time()
+        files = self._listDownloadedFiles(root_directory, recursive=False)
+        directories = [entry.path for entry in os.scandir(root_directory) if entry.is_dir()]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for result in executor.map(self._listDownloadedFiles, directories):
+                files.extend(result)
+        print("Found {0} files in {1:.1f}s.".format(len(files), time.time() - start))
+
+        self.flush()
+        c = self.conn.cursor()
+        try:
+            c.execute('''SELECT save_name, file_size FROM pixiv_file_hash''')
+            known = dict(c.fetchall())
+
+            def hashChangedFile(filename):
+                try:
+                    if known.get(filename) == os.path.getsize(filename):
+                        return None
+                    return (filename, ) + PixivHelper.hashFile(filename)
+                except OSError:
+                    PixivHelper.print_and_log('error', 'Cannot hash {0}: {1}'.format(filename, sys.exc_info()[1]))
+                    return None
+
+            start = time.time()
+            rows = list()
+            count = 0
+            total_size = 0
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for (i, row) in enumerate(executor.map(hashChangedFile, files), 1):
+                    if row is not None:
+                        rows.append(row)
+                        total_size = total_size + row[1]
+                    if len(rows) >= batch_size or (i == len(files) and len(rows) > 0):
+                        with self.transaction():
+                            c.executemany('''INSERT OR REPLACE INTO pixiv_file_hash (save_name, file_size, content_hash, last_update_date)
+                                             VALUES(?, ?, ?, datetime('now'))''', rows)
+                        count = count + len(rows)
+                        rows = list()
+                    if i % 100 == 0 or i == len(files):
+                        elapsed = max(time.time() - start, 0.001)
+                        print("\rChecked {0}/{1} files, hashed {2} ({3})".format(i, len(files), count + len(rows),
+                                                                               PixivHelper.speedInStr(total_size, elapsed)), end=' ')
+            print('')
+
+            c.execute('''SELECT COUNT(*), file_size FROM pixiv_file_hash GROUP BY content_hash, file_size HAVING COUNT(*) > 1''')
+            duplicates = c.fetchall()
+        except BaseException:
+            print('Error at hashDownloadedFiles():', str(sys.exc_info()))
+            print('failed')
+            raise
         finally:
             c.close()
 
+        print("Hashed {0} files in {1:.1f}s.".format(count, time.time() - start))
+        print("{0} files have the same content as another file, {1} can be saved with dedupeMode.".format(
+              sum(row[0] - 1 for row in duplicates), PixivHelper.sizeInStr(sum((row[0] - 1) * row[1] for row in duplicates))))
+        return count
+
     def checkFilenames(self, base_filename, exts):
         for ext2 in exts:
             check_name = base_filename + ext2
@@ -628,35 +1010,82 @@ class PixivDBManager(object):
                         break
         return fileExists
 
-    def cleanUp(self):
+    @staticmethod
+    def _scanDirectory(directory):
+        '''Return the set of file names in the directory, None if it cannot be read.'''
+        try:
+            with os.scandir(directory) as it:
+                return set(os.path.normcase(entry.name) for entry in it)
+        except (FileNotFoundError, NotADirectoryError):
+            return set()
+        except OSError:
+            return None
+
+    def findMissingImages(self, rows, workers=8):
+        '''Return the rows of (image_id, save_name) which file is not in the disk.
+
+        Each folder is listed once using os.scandir() in a thread pool, instead of calling os.path.exists() for every row.
+        '''
         anim_ext = ['.zip', '.gif', '.apng', '.ugoira', '.webm']
+        paths = list()
+        for row in rows:
+            if row[1] is None or len(row[1]) == 0:
+                paths.append(None)
+            else:
+                paths.append(os.path.split(os.path.normcase(os.path.abspath(row[1]))))
+        directories = list(set(path[0] for path in paths if path is not None))
+
+        listing = dict()
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for (i, (directory, names)) in enumerate(zip(directories, executor.map(self._scanDirectory, directories)), 1):
+                listing[directory] = names
+                if i % 100 == 0 or i == len(directories):
+                    print("\rScanned {0}/{1} folders ({2:.1f} folders/s)".format(i, len(directories), i / max(time.time() - start, 0.001)), end=' ')
+        print('')
+
+        missing = list()
+        for (row, path) in zip(rows, paths):
+            # Issue 340
+            if path is None:
+                missing.append(row)
+                continue
+            (directory, name) = path
+            names = listing[directory]
+            if names is None:
+                # cannot list the folder, check the file directly
+                if not self.cleanupFileExists(row[1]):
+                    missing.append(row)
+                continue
+            if name in names:
+                continue
+            fileExists = False
+            for ext in anim_ext:
+                # check filename in db against all combination possible filename in disk
+                if name.endswith(ext):
+                    base_filename = name[:-len(ext)]
+                    fileExists = any(base_filename + ext2 in names for ext2 in anim_ext)
+                    break
+            if not fileExists:
+                missing.append(row)
+        print("Checked {0} images in {1:.1f}s, {2} missing.".format(len(rows), time.time() - start, len(missing)))
+        return missing
+
+    def cleanUp(self):
         try:
             print("Start clean-up operation.")
             print("Selecting all images, this may take some times.")
+            self.flush()
             c = self.conn.cursor()
             c.execute('''SELECT image_id, save_name from pixiv_master_image''')
-            print("Checking images.")
-            for row in c:
-                # Issue 340
-                filename = row[1]
-                fileExists = False
-
-                if filename is not None and len(filename) > 0:
-                    if os.path.exists(filename):
-                        continue
-
-                    for ext in anim_ext:
-                        # check filename in db against all combination possible filename in disk
-                        if filename.endswith(ext):
-                            base_filename = filename.rsplit(ext, 1)[0]
-                            if self.checkFilenames(base_filename, anim_ext):
-                                fileExists = True
-                                break
-
-                if not fileExists:
-                    PixivHelper.safePrint("Missing: {0} at {1}".format(row[0], row[1]))
-                    self.deleteImage(row[0])
-            self.conn.commit()
+            rows = c.fetchall()
+            print("Checking {0} images.".format(len(rows)))
+            missing = self.findMissingImages(rows)
+            for row in missing:
+                PixivHelper.safePrint("Missing: {0} at {1}".format(row[0], row[1]))
+            if len(missing) > 0:
+                print("Deleting {0} images from database.".format(len(missing)))
+                self.deleteImages([row[0] for row in missing])
         except BaseException:
             print('Error at cleanUp():', str(sys.exc_info()))
             print('failed')
@@ -669,16 +1098,13 @@ class PixivDBManager(object):
         try:
             print("Start clean-up operation.")
             print("Selecting all images, this may take some times.")
+            self.flush()
             c = self.conn.cursor()
             print("Collecting missing images.")
             c.execute('''SELECT image_id, save_name from pixiv_master_image''')
-            for row in c:
-                # Issue 340
-                filename = row[1]
-                fileExists = self.cleanupFileExists(filename)
-                if not fileExists:
-                    l.append(row)
-                    PixivHelper.safePrint("Missing: {0} at \n{1}".format(row[0], row[1]))
+            l = self.findMissingImages(c.fetchall())
+            for row in l:
+                PixivHelper.safePrint("Missing: {0} at \n{1}".format(row[0], row[1]))
 
             while not len(l) == 0:
                 # End scan
@@ -701,7 +1127,7 @@ class PixivDBManager(object):
                         ll.append(l)
                 l = ll
             c.close()
-            self.conn.commit()
+            self._commit()
         except BaseException:
             print('Error at interactiveCleanUp():', str(sys.exc_info()))
             print('failed')
@@ -710,7 +1136,94 @@ class PixivDBManager(object):
             c.close()
 
         # TODO check mangaimage
-        # TODO check for files which exist but don't have a DB entry
+        # files which exist but don't have a DB entry: see indexDownloadedFiles()
+
+    def _scanDownloadedFiles(self, directory, patterns, recursive=True):
+        result = list()
+        for (dirpath, _, filenames) in os.walk(directory):
+            for name in filenames:
+                if os.path.splitext(name)[1].lower() not in DOWNLOADED_FILE_EXT:
+                    continue
+                path = os.path.join(dirpath, name)
+                parsed = PixivHelper.parseDownloadedFilename(path, patterns)
+                if parsed is not None:
+                    result.append(parsed + (path, ))
+            if not recursive:
+                break
+        return result
+
+    def indexDownloadedFiles(self, root_directory=None, workers=8):
+        '''Add the downloaded files which are not in the database, so they are skipped without checking the server.
+
+        Image id, page and member id are parsed from the file path using filenameFormat and filenameMangaFormat.
+        Each folder under the root directory is scanned in a thread pool.
+        '''
+        if root_directory is None:
+            root_directory = self.__config__.rootDirectory
+        root_directory = os.path.abspath(root_directory)
+        patterns = [PixivHelper.makeFilenamePattern(self.__config__.filenameMangaFormat),
+                    PixivHelper.makeFilenamePattern(self.__config__.filenameFormat)]
+
+        print("Scanning {0}".format(root_directory))
+        start = time.time()
+        entries = self._scanDownloadedFiles(root_directory, patterns, recursive=False)
+        directories = [entry.path for entry in os.scandir(root_directory) if entry.is_dir()]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for (i, result) in enumerate(executor.map(lambda d: self._scanDownloadedFiles(d, patterns), directories), 1):
+                entries.extend(result)
+                if i % 100 == 0 or i == len(directories):
+                    print("\rScanned {0}/{1} folders, {2} files ({3:.1f} files/s)".format(i, len(directories), len(entries),
+                                                                                         len(entries) / max(time.time() - start, 0.001)), end=' ')
+        print('')
+
+        count = self.importDownloadedFiles(entries)
+        print("Added {0} images from {1} files in {2:.1f}s.".format(count, len(entries), time.time() - start))
+        return count
+
+    def importDownloadedFiles(self, entries):
+        '''Insert (image_id, page, member_id, filename) into pixiv_master_image and pixiv_manga_image,
+        the images already in the database are not changed. Return the number of added images.'''
+        images = dict()
+        for (image_id, page, member_id, filename) in entries:
+            if image_id not in images:
+                images[image_id] = (member_id, dict())
+            elif images[image_id][0] is None and member_id is not None:
+                images[image_id] = (member_id, images[image_id][1])
+            pages = images[image_id][1]
+            pages[page if page is not None else -1] = filename
+
+        known = self.selectExistingImageIds(list(images.keys()))
+        master_rows = list()
+        manga_rows = list()
+        for image_id in sorted(images.keys()):
+            if image_id in known:
+                continue
+            (member_id, pages) = images[image_id]
+            filenames = [pages[page] for page in sorted(pages.keys())]
+            ugoira = [f for f in filenames if os.path.splitext(f)[1].lower() in ('.zip', '.ugoira', '.apng', '.webm')]
+            if len(ugoira) > 0:
+                # the zip name is saved for ugoira, see handle_ugoira()
+                zips = [f for f in ugoira if f.lower().endswith('.zip')]
+                master_rows.append((image_id, member_id or 0, (zips or ugoira)[0], 'ugoira_view'))
+            elif len(pages) > 1 or max(pages.keys()) > 0:
+                master_rows.append((image_id, member_id or 0, filenames[-1], 'manga'))
+                manga_rows.extend((image_id, page, pages[page]) for page in sorted(pages.keys()) if page >= 0)
+            else:
+                master_rows.append((image_id, member_id or 0, filenames[0], 'big'))
+
+        try:
+            c = self.conn.cursor()
+            with self.transaction():
+                c.executemany('''INSERT OR REPLACE INTO pixiv_master_image (image_id, member_id, title, save_name, created_date, last_update_date, is_manga)
+                                 VALUES(?, ?, '', ?, datetime('now'), datetime('now'), ?)''', master_rows)
+                c.executemany('''INSERT OR IGNORE INTO pixiv_manga_image VALUES(?, ?, ?, datetime('now'), datetime('now'))''', manga_rows)
+        except BaseException:
+            print('Error at importDownloadedFiles():', str(sys.exc_info()))
+            print('failed')
+            raise
+        finally:
+            c.close()
+        return len(master_rows)
 
     def replaceRootPath(self):
         oldPath = input("Old Path to Replace = ")
@@ -724,6 +1237,7 @@ class PixivDBManager(object):
             print("Start replace Root Path operation.")
             print("Updating images, this may take some times.")
 
+            self.flush()
             c = self.conn.cursor()
             c.execute('''UPDATE pixiv_master_image
                          SET save_name = replace(save_name, ?, ?)
@@ -779,6 +1293,8 @@ class PixivDBManager(object):
         print('i. Interactive Clean Up Database')
         print('p. Compact Database')
         print('r. Replace Root Path')
+        print('f. Index Downloaded Files from Root Directory')
+        print('h. Hash Downloaded Files for dedupeMode')
         print('x. Exit')
         selection = input('Select one?')
         return selection
@@ -865,6 +1381,12 @@ class PixivDBManager(object):
                     self.compactDatabase()
                 elif selection == 'r':
                     self.replaceRootPath()
+                elif selection == 'f':
+                    root_directory = input("Root Directory [{0}]: ".format(self.__config__.rootDirectory)) or None
+                    self.indexDownloadedFiles(root_directory)
+                elif selection == 'h':
+                    root_directory = input("Root Directory [{0}]: ".format(self.__config__.rootDirectory)) or None
+                    self.hashDownloadedFiles(root_directory)
                 elif selection == 'x':
                     break
             print('end PixivDBManager.')
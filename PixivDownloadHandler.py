@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+# pylint: disable=W0603, C0325
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import urllib.parse
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+import PixivHelper
+
+
+class DownloadPool(object):
+    '''Run download jobs in a fixed number of worker threads.
+
+    - workers: number of worker threads, 1 means download in the caller thread.
+    - maxPerHost: maximum concurrent download to the same host.
+    - queueSize: maximum pending job, submit() will block when the queue is full.
+
+    The sqlite connection is not shared with the workers, they use callInSubmitter() for the DB access,
+    which is run while the submitting thread is waiting in submit(), DownloadJob.result() or cancel().
+    '''
+    workers = 1
+    maxPerHost = 2
+    queueSize = 16
+
+    _executor = None
+    _queueSlot = None
+    _hostSlot = None
+    _hostLock = None
+    _calls = None
+    _submitter = None
+    _futures = None
+    _futuresLock = None
+
+    def __init__(self, workers=1, maxPerHost=2, queueSize=16):
+        self.workers = max(1, int(workers))
+        self.maxPerHost = max(1, int(maxPerHost))
+        self.queueSize = max(self.workers, int(queueSize))
+
+        self._hostSlot = dict()
+        self._hostLock = threading.Lock()
+        self._queueSlot = threading.BoundedSemaphore(self.queueSize)
+        self._calls = queue.Queue()
+        self._futures = set()
+        self._futuresLock = threading.Lock()
+        if self.workers > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+            PixivHelper.GetLogger().info("Download pool started: %d workers, %d per host, queue size %d",
+                                         self.workers, self.maxPerHost, self.queueSize)
+
+    @property
+    def isParallel(self):
+        return self._executor is not None
+
+    def _get_host_slot(self, url):
+        host = urllib.parse.urlparse(url).hostname or ''
+        with self._hostLock:
+            if host not in self._hostSlot:
+                self._hostSlot[host] = threading.BoundedSemaphore(self.maxPerHost)
+            return self._hostSlot[host]
+
+    def _run(self, url, func, args, kwargs):
+        slot = self._get_host_slot(url)
+        slot.acquire()
+        try:
+            return func(url, *args, **kwargs)
+        finally:
+            slot.release()
+
+    def callInSubmitter(self, func, *args, **kwargs):
+        '''Run func(*args, **kwargs) in the thread which submitted the jobs and return its result.'''
+        if not self.isParallel or self._submitter is None or threading.current_thread() is self._submitter:
+            return func(*args, **kwargs)
+        future = Future()
+        self._calls.put((future, func, args, kwargs))
+        return future.result()
+
+    def _runCalls(self, timeout):
+        '''Run the pending callInSubmitter() from the submitting thread, wait up to timeout for the first one.'''
+        while True:
+            try:
+                (future, func, args, kwargs) = self._calls.get(timeout=timeout)
+            except queue.Empty:
+                return
+            timeout = 0
+            try:
+                future.set_result(func(*args, **kwargs))
+            except BaseException as ex:
+                future.set_exception(ex)
+
+    def _wait(self, future):
+        while not future.done():
+            self._runCalls(0.05)
+
+    def submit(self, func, url, *args, **kwargs):
+        '''Schedule func(url, *args, **kwargs), return a DownloadJob.'''
+        if not self.isParallel:
+            job = DownloadJob()
+            try:
+                job._result = func(url, *args, **kwargs)
+            except BaseException:
+                job._exc_info = sys.exc_info()
+            return job
+
+        self._submitter = threading.current_thread()
+        # the running workers may need the submitting thread while the queue is full
+        while not self._queueSlot.acquire(timeout=0.05):
+            self._runCalls(0)
+        try:
+            future = self._executor.submit(self._run, url, func, args, kwargs)
+        except BaseException:
+            self._queueSlot.release()
+            raise
+        with self._futuresLock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+        return DownloadJob(future, self)
+
+    def _done(self, future):
+        with self._futuresLock:
+            self._futures.discard(future)
+        self._queueSlot.release()
+
+    def cancel(self, jobs):
+        '''Cancel the jobs which are not started yet, and wait for the running ones to finish.'''
+        for job in jobs:
+            job.cancel()
+        for job in jobs:
+            if job._future is not None:
+                self._wait(job._future)
+
+    def shutdown(self, wait=True):
+        '''Cancel the jobs which are not started yet, and stop the workers.'''
+        if self._executor is not None:
+            with self._futuresLock:
+                futures = list(self._futures)
+            for future in futures:
+                future.cancel()
+            if wait:
+                # the running jobs may wait in callInSubmitter()
+                for future in futures:
+                    self._wait(future)
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+
+class DownloadJob(object):
+    '''Result holder for DownloadPool.submit()'''
+    _future = None
+    _pool = None
+    _result = None
+    _exc_info = None
+
+    def __init__(self, future=None, pool=None):
+        self._future = future
+        self._pool = pool
+
+    def cancel(self):
+        '''Cancel the job if it is not started yet, return True if cancelled.'''
+        if self._future is not None:
+            return self._future.cancel()
+        return False
+
+    def result(self):
+        '''Wait for the job and return its value, re-raise the worker exception if any.'''
+        if self._future is not None:
+            self._pool._wait(self._future)
+            return self._future.result()
+        if self._exc_info is not None:
+            raise self._exc_info[1].with_traceback(self._exc_info[2])
+        return self._result
+
+
+class ConversionPool(object):
+    '''Run the ugoira conversion in separate processes, so the download does not wait for the encoder.
+
+    - workers: number of processes, 0 means one per CPU core and negative means convert in the caller thread.
+
+    The processes send their log records to this process, so only one process writes the log file.
+    '''
+    workers = 0
+
+    _executor = None
+    _pending = None
+    _lock = None
+    _logQueue = None
+    _logListener = None
+
+    def __init__(self, workers=0):
+        self.workers = int(workers)
+        self._pending = dict()
+        self._lock = threading.Lock()
+
+    @property
+    def processes(self):
+        if self.workers == 0:
+            return os.cpu_count() or 1
+        return self.workers
+
+    @property
+    def queueDepth(self):
+        '''Number of conversion queued or running.'''
+        with self._lock:
+            return len(self._pending)
+
+    def submit(self, func, filename, *args):
+        '''Schedule func(filename, *args), the same filename is only queued once.'''
+        if self.workers < 0:
+            return func(filename, *args)
+
+        with self._lock:
+            if filename in self._pending:
+                PixivHelper.print_and_log('info', 'Ugoira conversion already queued: {0}'.format(filename))
+                return self._pending[filename]
+            if self._executor is None:
+                logger = PixivHelper.GetLogger()
+                self._logQueue = multiprocessing.Queue()
+                self._logListener = logging.handlers.QueueListener(self._logQueue, *logger.handlers, respect_handler_level=True)
+                self._logListener.start()
+                self._executor = ProcessPoolExecutor(max_workers=self.processes,
+                                                     initializer=PixivHelper.setLogQueue,
+                                                     initargs=(self._logQueue, logger.level))
+                PixivHelper.GetLogger().info("Ugoira conversion pool started: %d processes", self.processes)
+            future = self._executor.submit(func, filename, *args)
+            self._pending[filename] = future
+            depth = len(self._pending)
+        PixivHelper.print_and_log('info', 'Ugoira conversion queued: {0} ({1} in queue)'.format(filename, depth))
+        future.add_done_callback(lambda f: self._done(filename, f))
+        return future
+
+    def _done(self, filename, future):
+        with self._lock:
+            self._pending.pop(filename, None)
+            depth = len(self._pending)
+        if future.cancelled():
+            PixivHelper.print_and_log('info', 'Ugoira conversion cancelled: {0}'.format(filename))
+        elif future.exception() is not None:
+            PixivHelper.print_and_log('error', 'Failed to convert ugoira: {0} => {1} ({2} in queue)'.format(filename, future.exception(), depth))
+        else:
+            PixivHelper.print_and_log('info', 'Ugoira conversion done: {0} ({1} in queue)'.format(filename, depth))
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            depth = self.queueDepth
+            if wait and depth > 0:
+                PixivHelper.print_and_log('info', 'Waiting for {0} ugoira conversion to finish...'.format(depth))
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+            # write the remaining log records
+            self._logListener.stop()
+            self._logListener = None
+            self._logQueue.close()
+            self._logQueue = None
+
+
+class ResumeStatistics(object):
+    '''Counter for resumed partial download (.pixiv files)'''
+    resumed = 0
+    restarted = 0
+    savedBytes = 0
+    _lock = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def addResumed(self, saved_bytes):
+        with self._lock:
+            self.resumed = self.resumed + 1
+            self.savedBytes = self.savedBytes + saved_bytes
+
+    def addRestarted(self):
+        with self._lock:
+            self.restarted = self.restarted + 1
+
+    def __str__(self):
+        return "Resumed download: {0}, saved {1} ({2} Bytes), restarted from beginning: {3}".format(self.resumed,
+                                                                                                  PixivHelper.sizeInStr(self.savedBytes),
+                                                                                                  self.savedBytes,
+                                                                                                  self.restarted)
+
+
+resumeStatistics = ResumeStatistics()
+_pool = None
+_conversionPool = None
+
+
+def getDownloadPool(config=None):
+    '''Return the shared download pool, recreate it when the config changes.'''
+    global _pool
+    if config is None:
+        if _pool is None:
+            _pool = DownloadPool()
+        return _pool
+
+    if _pool is None or \
+       _pool.workers != max(1, config.downloadWorkers) or \
+       _pool.maxPerHost != max(1, config.downloadMaxPerHost) or \
+       _pool.queueSize != max(max(1, config.downloadWorkers), config.downloadQueueSize):
+        if _pool is not None:
+            _pool.shutdown(wait=True)
+        _pool = DownloadPool(config.downloadWorkers, config.downloadMaxPerHost, config.downloadQueueSize)
+    return _pool
+
+
+def shutdownDownloadPool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True)
+        _pool = None
+
+
+def getConversionPool(config=None):
+    '''Return the shared ugoira conversion pool, recreate it when the config changes.'''
+    global _conversionPool
+    if config is None:
+        if _conversionPool is None:
+            _conversionPool = ConversionPool()
+        return _conversionPool
+
+    workers = config.conversionWorkers
+    if _conversionPool is None or _conversionPool.workers != workers:
+        if _conversionPool is not None:
+            _conversionPool.shutdown(wait=True)
+        _conversionPool = ConversionPool(workers)
+    return _conversionPool
+
+
+def shutdownConversionPool():
+    '''Wait for the queued ugoira conversion.'''
+    global _conversionPool
+    if _conversionPool is not None:
+        _conversionPool.shutdown(wait=True)
+        _conversionPool = None
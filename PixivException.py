@@ -29,6 +29,7 @@ class PixivException(Exception):
     DOWNLOAD_FAILED_OTHER = 9000
     DOWNLOAD_FAILED_IO = 9001
     DOWNLOAD_FAILED_NETWORK = 9002
+    DOWNLOAD_PARTIAL_MISSING = 9003
     SERVER_ERROR  = 9005
 
     MISSING_CONFIG = 9901
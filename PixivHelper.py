@@ -2,17 +2,26 @@
 # pylint: disable=W0603
 
 
+import base64
 import codecs
+import collections
+import errno
+import functools
+import hashlib
+import html
+import io
 import json
 import logging
 import logging.handlers
+import mimetypes
 import os
+import queue
 import re
 import shlex
 import shutil
 import subprocess
 import sys
-import tempfile
+import threading
 import time
 import traceback
 import unicodedata
@@ -20,13 +29,25 @@ import urllib.request, urllib.parse, urllib.error
 import urllib.request, urllib.error, urllib.parse
 import zipfile
 from datetime import date, datetime, timedelta, tzinfo
-from html.parser import HTMLParser
 
-import imageio
+import demjson
+import mechanize
+from PIL import GifImagePlugin, Image, ImageChops
 
 import PixivConstant
 import PixivModel
-from apng import APNG
+from PixivException import PixivException
+from apng import APNGWriter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 Logger = None
 _config = None
@@ -53,19 +74,47 @@ def GetLogger(level=logging.DEBUG):
     return Logger
 
 
+def setLogQueue(logQueue, level=logging.DEBUG):
+    '''Send the log to logQueue instead of the log file, for the ugoira conversion processes.
+
+       Only the main process writes (and rotates) the log file, see ConversionPool.
+    '''
+    global Logger
+    Logger = logging.getLogger('PixivUtil' + PixivConstant.PIXIVUTIL_VERSION)
+    Logger.setLevel(level)
+    # inherited from the main process when forked
+    for handler in list(Logger.handlers):
+        Logger.removeHandler(handler)
+    Logger.addHandler(logging.handlers.QueueHandler(logQueue))
+
+
 def setLogLevel(level):
     Logger.info("Setting log level to: %s", level)
     GetLogger(level).setLevel(level)
 
 
 if os.sep == '/':
-    __badchars__ = re.compile(r'^\.|\.$|^ | $|^$|\?|:|<|>|\||\*|\"')
+    __badchars_class__ = re.compile(r'[?:<>|*"]')
 else:
-    __badchars__ = re.compile(r'^\.|\.$|^ | $|^$|\?|:|<|>|/|\||\*|\"')
+    __badchars_class__ = re.compile(r'[?:<>/|*"]')
+# the anchored part only matches when the name is empty, starts with '.' or ' ', or ends with '.', ' ' or new line.
+__badends__ = re.compile(r'^\.|\.$|^ | $|^$')
 __badnames__ = re.compile(r'(aux|com[1-9]|con|lpt[1-9]|prn)(\.|$)')
-
-__h__ = HTMLParser()
+# unicode control characters (category Cc)
+__controlchars__ = re.compile('[\x00-\x1f\x7f-\x9f]')
+__re_dot_dir = re.compile(r'\.+\\')
+__re_double_sep = re.compile(re.escape(os.sep) + '{2,}')
 __re_manga_index = re.compile(r'_p(\d+)')
+__re_filename_token = re.compile(r'(%[\w\-]+(?:\{[^}]*\})?%)')
+__re_downloaded_filename = re.compile(r'(?:^|\D)(\d+)_(?:p(\d+)|ugoira)')
+__re_manga_dir_filename = re.compile(r'(?:^|[\\/])(\d+)[\\/]_p(\d+)[^\\/]*$')
+__re_member_id_dir = re.compile(r'\((\d+)\)[\\/]')
+# regex with named group for the filename format token, see makeFilename()
+__filename_pattern_token = {'%image_id%': r'(?P<image_id>\d+)',
+                            '%member_id%': r'(?P<member_id>\d+)',
+                            '%page_index%': r'(?P<page_index>\d+)',
+                            '%page_number%': r'(?P<page_number>\d+)',
+                            '%urlFilename%': r'(?P<url_id>\d+)(?:_p(?P<url_page>\d+))?[^\\/]*?'}
 
 
 def sanitizeFilename(s, rootDir=None):
@@ -75,39 +124,33 @@ def sanitizeFilename(s, rootDir=None):
         rootDir = os.path.abspath(rootDir)
 
     # Unescape '&amp;', '&lt;', and '&gt;'
-    s = __h__.unescape(s)
+    if '&' in s:
+        s = html.unescape(s)
 
     # Replace badchars and badnames with _
-    name = __badchars__.sub('_', s)
+    name = __badchars_class__.sub('_', s)
+    if len(name) == 0 or name[0] in '. ' or name[-1] in '. \n':
+        name = __badends__.sub('_', name)
     if __badnames__.match(name.lower()):
         name = '_' + name
 
-    # Replace new line with space
-    name = name.replace("\r", '')
-    name = name.replace("\n", ' ')
+    # Replace new line and tab with space
+    name = name.replace('\r', '').replace('\n', ' ').replace('\t', ' ')
 
     # Yavos: when foldername ends with "." PixivUtil won't find it
-    while name.find('.\\') != -1:
-        name = name.replace('.\\', '\\')
+    if '.\\' in name:
+        name = __re_dot_dir.sub(r'\\', name)
 
     name = name.replace('\\', os.sep)
 
-    # Replace tab character with space
-    name = name.replace('\t', ' ')
-
     # Strip leading/trailing space for each directory
-    temp = name.split(os.sep)
-    temp2 = list()
-    for item in temp:
-        temp2.append(item.strip())
-    name = os.sep.join(temp2)
+    name = os.sep.join(item.strip() for item in name.split(os.sep))
 
     if rootDir is not None:
         name = rootDir + os.sep + name
 
     # replace double os.sep
-    while name.find(os.sep + os.sep) >= 0:
-        name = name.replace(os.sep + os.sep, os.sep)
+    name = __re_double_sep.sub(os.sep, name)
 
     # cut to 255 char
     if len(name) > 255:
@@ -115,19 +158,11 @@ def sanitizeFilename(s, rootDir=None):
         name = name[:newLen]
 
     # Remove unicode control character
-    if isinstance(name, str):
-        tempName = ""
-        for c in name:
-            if unicodedata.category(c) == 'Cc':
-                tempName = tempName + '_'
-            else:
-                tempName = tempName + c
-    else:
-        tempName = name
+    name = __controlchars__.sub('_', name).strip()
 
-    GetLogger().debug("Sanitized Filename: %s", tempName.strip())
+    GetLogger().debug("Sanitized Filename: %s", name)
 
-    return tempName.strip()
+    return name
 
 
 # Issue #277: always replace '/' and '\' with '_' for %artist%, %title%, %searchTags%, %tags%, %works_tools%, and %original_artist%.
@@ -135,6 +170,106 @@ def replacePathSeparator(s, replacement='_'):
     return s.replace(os.sep, replacement).replace('/', replacement).replace('\\', replacement)
 
 
+def _pageInfo(imageInfo, fileUrl):
+    # get the page index & big mode if manga
+    page_index = ''
+    page_number = ''
+    page_big = ''
+    if imageInfo.imageMode == 'manga':
+        idx = __re_manga_index.findall(fileUrl)
+        if len(idx) > 0:
+            page_index = idx[0]
+            page_number = str(int(page_index) + 1)
+            padding = len(str(imageInfo.imageCount)) or 1
+            page_number = page_number.zfill(padding)
+        if fileUrl.find('_big') > -1 or fileUrl.find('_m') <= -1:
+            page_big = 'big'
+    return (page_index, page_number, page_big)
+
+
+def _originalArtist(f, bookmark):
+    # from member bookmarks
+    return f['image'].originalArtist if bookmark else f['artist']
+
+
+def _bookmarkCount(imageInfo):
+    return str(imageInfo.bookmark_count) if imageInfo.bookmark_count > 0 else ''
+
+
+def _imageResponseCount(imageInfo):
+    return str(imageInfo.image_response_count) if imageInfo.image_response_count > 0 else ''
+
+
+def _r18Dir(tags):
+    if "R-18G" in tags:
+        return "R-18G"
+    elif "R-18" in tags:
+        return "R-18"
+    return ""
+
+
+# value of each filename format token, f is the dict of the fields for the current file.
+__filename_token_value = {
+    # artist related
+    '%artist%': lambda f, arg: replacePathSeparator(f['artist'].artistName),
+    '%member_id%': lambda f, arg: str(f['artist'].artistId),
+    '%member_token%': lambda f, arg: f['artist'].artistToken,
+    # image related
+    '%title%': lambda f, arg: replacePathSeparator(f['image'].imageTitle),
+    '%image_id%': lambda f, arg: str(f['image'].imageId),
+    '%works_date%': lambda f, arg: f['image'].worksDate,
+    '%works_date_only%': lambda f, arg: f['image'].worksDate.split(' ')[0],
+    # formatted works date/time, ex. %works_date_fmt{%Y-%m-%d}%
+    '%works_date_fmt%': lambda f, arg: f['image'].worksDateDateTime.strftime(arg),
+    '%works_res%': lambda f, arg: f['image'].worksResolution,
+    '%works_tools%': lambda f, arg: replacePathSeparator(f['image'].worksTools),
+    '%urlFilename%': lambda f, arg: f['imageFile'],
+    '%searchTags%': lambda f, arg: replacePathSeparator(f['searchTags']),
+    # date
+    '%date%': lambda f, arg: f['today'].strftime('%Y%m%d'),
+    # formatted date/time, ex. %date_fmt{%Y-%m-%d}%
+    '%date_fmt%': lambda f, arg: f['today'].strftime(arg),
+    '%page_index%': lambda f, arg: f['page'][0],
+    '%page_number%': lambda f, arg: f['page'][1],
+    '%page_big%': lambda f, arg: f['page'][2],
+    '%R-18%': lambda f, arg: _r18Dir(f['image'].imageTags),
+    '%tags%': lambda f, arg: replacePathSeparator(f['tagsSeparator'].join(f['image'].imageTags)),
+    '%bookmark%': lambda f, arg: 'Bookmarks' if f['bookmark'] else '',
+    '%original_member_id%': lambda f, arg: str(_originalArtist(f, f['bookmark']).artistId),
+    '%original_member_token%': lambda f, arg: _originalArtist(f, f['bookmark']).artistToken,
+    '%original_artist%': lambda f, arg: replacePathSeparator(_originalArtist(f, f['bookmark']).artistName),
+    '%bookmark_count%': lambda f, arg: _bookmarkCount(f['image']),
+    '%image_response_count%': lambda f, arg: _imageResponseCount(f['image']),
+}
+__re_filename_template = re.compile(r'%(works_date_fmt|date_fmt)\{(.*?)\}%|(' + '|'.join(
+    re.escape(token) for token in __filename_token_value if not token.endswith('_fmt%')) + ')')
+__re_double_space = re.compile(' {2,}')
+
+
+@functools.lru_cache(maxsize=64)
+def compileFilenameFormat(nameFormat):
+    '''Split the filename format once into the literal text and the (value function, argument, lazy field) parts.'''
+    parts = list()
+    pos = 0
+    for m in __re_filename_template.finditer(nameFormat):
+        if m.start() > pos:
+            parts.append(nameFormat[pos:m.start()])
+        if m.group(1) is not None:
+            (token, arg) = ('%' + m.group(1) + '%', m.group(2))
+        else:
+            (token, arg) = (m.group(3), None)
+        lazy_field = None
+        if token.startswith('%page_'):
+            lazy_field = 'page'
+        elif token.startswith('%date'):
+            lazy_field = 'today'
+        parts.append((__filename_token_value[token], arg, lazy_field))
+        pos = m.end()
+    if pos < len(nameFormat):
+        parts.append(nameFormat[pos:])
+    return tuple(parts)
+
+
 def makeFilename(nameFormat, imageInfo, artistInfo=None, tagsSeparator=' ', tagsLimit=-1, fileUrl='',
                  appendExtension=True, bookmark=False, searchTags=''):
     '''Build the filename from given info to the given format.'''
@@ -151,55 +286,6 @@ def makeFilename(nameFormat, imageInfo, artistInfo=None, tagsSeparator=' ', tags
         imageExtension = splittedUrl[1]
         imageExtension = imageExtension.split('?')[0]
 
-    # artist related
-    nameFormat = nameFormat.replace('%artist%', replacePathSeparator(artistInfo.artistName))
-    nameFormat = nameFormat.replace('%member_id%', str(artistInfo.artistId))
-    nameFormat = nameFormat.replace('%member_token%', artistInfo.artistToken)
-
-    # image related
-    nameFormat = nameFormat.replace('%title%', replacePathSeparator(imageInfo.imageTitle))
-    nameFormat = nameFormat.replace('%image_id%', str(imageInfo.imageId))
-    nameFormat = nameFormat.replace('%works_date%', imageInfo.worksDate)
-    nameFormat = nameFormat.replace('%works_date_only%', imageInfo.worksDate.split(' ')[0])
-
-    # formatted works date/time, ex. %works_date_fmt{%Y-%m-%d}%
-    if nameFormat.find("%works_date_fmt") > -1:
-        to_replace = re.findall("(%works_date_fmt{.*}%)", nameFormat)
-        date_format = re.findall("{(.*)}", to_replace[0])
-        nameFormat = nameFormat.replace(to_replace[0], imageInfo.worksDateDateTime.strftime(date_format[0]))
-
-    nameFormat = nameFormat.replace('%works_res%', imageInfo.worksResolution)
-    nameFormat = nameFormat.replace('%works_tools%', replacePathSeparator(imageInfo.worksTools))
-    nameFormat = nameFormat.replace('%urlFilename%', imageFile)
-    nameFormat = nameFormat.replace('%searchTags%', replacePathSeparator(searchTags))
-
-    # date
-    nameFormat = nameFormat.replace('%date%', date.today().strftime('%Y%m%d'))
-
-    # formatted date/time, ex. %date_fmt{%Y-%m-%d}%
-    if nameFormat.find("%date_fmt") > -1:
-        to_replace2 = re.findall("(%date_fmt{.*}%)", nameFormat)
-        date_format2 = re.findall("{(.*)}", to_replace2[0])
-        nameFormat = nameFormat.replace(to_replace2[0], datetime.today().strftime(date_format2[0]))
-
-    # get the page index & big mode if manga
-    page_index = ''
-    page_number = ''
-    page_big = ''
-    if imageInfo.imageMode == 'manga':
-        idx = __re_manga_index.findall(fileUrl)
-        if len(idx) > 0:
-            page_index = idx[0]
-            page_number = str(int(page_index) + 1)
-            padding = len(str(imageInfo.imageCount)) or 1
-            page_number = str(page_number)
-            page_number = page_number.zfill(padding)
-        if fileUrl.find('_big') > -1 or fileUrl.find('_m') <= -1:
-            page_big = 'big'
-    nameFormat = nameFormat.replace('%page_big%', page_big)
-    nameFormat = nameFormat.replace('%page_index%', page_index)
-    nameFormat = nameFormat.replace('%page_number%', page_number)
-
     if tagsSeparator == '%space%':
         tagsSeparator = ' '
     if tagsSeparator == '%ideo_space%':
@@ -208,40 +294,29 @@ def makeFilename(nameFormat, imageInfo, artistInfo=None, tagsSeparator=' ', tags
     if tagsLimit != -1:
         tagsLimit = tagsLimit if tagsLimit < len(imageInfo.imageTags) else len(imageInfo.imageTags)
         imageInfo.imageTags = imageInfo.imageTags[0:tagsLimit]
-    tags = tagsSeparator.join(imageInfo.imageTags)
-    r18Dir = ""
-    if "R-18G" in imageInfo.imageTags:
-        r18Dir = "R-18G"
-    elif "R-18" in imageInfo.imageTags:
-        r18Dir = "R-18"
-    nameFormat = nameFormat.replace('%R-18%', r18Dir)
-    nameFormat = nameFormat.replace('%tags%', replacePathSeparator(tags))
-    nameFormat = nameFormat.replace('&#039;', '\'')  # Yavos: added html-code for "'" - works only when ' is excluded from __badchars__
-
-    if bookmark:  # from member bookmarks
-        nameFormat = nameFormat.replace('%bookmark%', 'Bookmarks')
-        nameFormat = nameFormat.replace('%original_member_id%', str(imageInfo.originalArtist.artistId))
-        nameFormat = nameFormat.replace('%original_member_token%', imageInfo.originalArtist.artistToken)
-        nameFormat = nameFormat.replace('%original_artist%', replacePathSeparator(imageInfo.originalArtist.artistName))
-    else:
-        nameFormat = nameFormat.replace('%bookmark%', '')
-        nameFormat = nameFormat.replace('%original_member_id%', str(artistInfo.artistId))
-        nameFormat = nameFormat.replace('%original_member_token%', artistInfo.artistToken)
-        nameFormat = nameFormat.replace('%original_artist%', replacePathSeparator(artistInfo.artistName))
 
-    if imageInfo.bookmark_count > 0:
-        nameFormat = nameFormat.replace('%bookmark_count%', str(imageInfo.bookmark_count))
-    else:
-        nameFormat = nameFormat.replace('%bookmark_count%', '')
+    fields = {'image': imageInfo, 'artist': artistInfo, 'imageFile': imageFile, 'searchTags': searchTags,
+              'tagsSeparator': tagsSeparator, 'bookmark': bookmark}
+    result = list()
+    for part in compileFilenameFormat(nameFormat):
+        if isinstance(part, str):
+            result.append(part)
+            continue
+        (value, arg, lazy_field) = part
+        if lazy_field is not None and lazy_field not in fields:
+            if lazy_field == 'page':
+                fields['page'] = _pageInfo(imageInfo, fileUrl)
+            else:
+                fields['today'] = datetime.today()
+        result.append(value(fields, arg))
+    nameFormat = ''.join(result)
 
-    if imageInfo.image_response_count > 0:
-        nameFormat = nameFormat.replace('%image_response_count%', str(imageInfo.image_response_count))
-    else:
-        nameFormat = nameFormat.replace('%image_response_count%', '')
+    if '&#039;' in nameFormat:
+        nameFormat = nameFormat.replace('&#039;', '\'')  # Yavos: added html-code for "'" - works only when ' is excluded from __badchars_class__
 
     # clean up double space
-    while nameFormat.find('  ') > -1:
-        nameFormat = nameFormat.replace('  ', ' ')
+    if '  ' in nameFormat:
+        nameFormat = __re_double_space.sub(' ', nameFormat)
 
     if appendExtension:
         nameFormat = nameFormat.strip() + '.' + imageExtension
@@ -249,6 +324,68 @@ def makeFilename(nameFormat, imageInfo, artistInfo=None, tagsSeparator=' ', tags
     return nameFormat.strip()
 
 
+def makeFilenamePattern(nameFormat):
+    '''Build a regex from the filename format to get back the image id, page and member id from the downloaded file path.'''
+    pattern = ''
+    used = set()
+    for part in __re_filename_token.split(nameFormat):
+        if part in __filename_pattern_token and part not in used:
+            # group name can be used only once, the next one is matched as other token.
+            used.add(part)
+            pattern = pattern + __filename_pattern_token[part]
+        elif __re_filename_token.match(part):
+            pattern = pattern + '.*?'
+        else:
+            for c in part:
+                if c in '\\/':
+                    pattern = pattern + r'[\\/]'
+                elif c == ' ':
+                    # double space is removed by makeFilename()
+                    pattern = pattern + ' *'
+                else:
+                    pattern = pattern + re.escape(c)
+    return re.compile(r'(?:^|[\\/])' + pattern + '$')
+
+
+def parseDownloadedFilename(path, patterns=None):
+    '''Return (image_id, page, member_id) from the downloaded file path or None if not recognized.
+
+    The patterns from makeFilenamePattern() are tried first, then the url filename convention (12345_p0, 12345_ugoira...).
+    page and member_id can be None.'''
+    base = os.path.splitext(path)[0]
+    image_id = page = member_id = None
+    for pattern in patterns or []:
+        m = pattern.search(base)
+        if m is None:
+            continue
+        groups = m.groupdict()
+        image_id = groups.get('image_id') or groups.get('url_id')
+        if image_id is None:
+            continue
+        page = groups.get('url_page') or groups.get('page_index')
+        if page is None and groups.get('page_number'):
+            page = int(groups['page_number']) - 1
+        member_id = groups.get('member_id')
+        break
+
+    if image_id is None:
+        m = __re_manga_dir_filename.search(base)
+        if m is None:
+            m = __re_downloaded_filename.search(os.path.basename(base))
+        if m is None:
+            return None
+        (image_id, page) = m.groups()
+
+    if member_id is None:
+        m = __re_member_id_dir.findall(path)
+        if len(m) > 0:
+            member_id = m[-1]
+
+    return (int(image_id),
+            int(page) if page is not None else None,
+            int(member_id) if member_id is not None else None)
+
+
 def safePrint(msg, newline=True):
     """Print empty string if UnicodeError raised."""
     for msgToken in msg.split(' '):
@@ -515,6 +652,16 @@ def unescape_charref(data, encoding):
         return data
 
 
+def parseJson(data):
+    '''Decode json using orjson (if installed) or json, demjson is only used for non-strict input'''
+    try:
+        if orjson is not None:
+            return orjson.loads(data)
+        return json.loads(data)
+    except (ValueError, TypeError):
+        return demjson.decode(data)
+
+
 def getUgoiraSize(ugoName):
     size = 0
     try:
@@ -562,7 +709,8 @@ def create_custom_request(url, config, referer='https://www.pixiv.net', head=Fal
         proxy = urllib.request.ProxyHandler(config.proxy)
         opener = urllib.request.build_opener(proxy)
         urllib.request.install_opener(opener)
-    req = urllib.request.Request(url)
+    # opened by the mechanize browser, mechanize 0.4 cannot open urllib.request.Request (no get_type())
+    req = mechanize.Request(url)
 
     req.add_header('Referer', referer)
     print_and_log('info', "Using Referer: " + str(referer))
@@ -582,14 +730,138 @@ def makeSubdirs(filename):
         os.makedirs(directory)
 
 
-def downloadImage(url, filename, res, file_size, overwrite):
-    ''' Actual download, return the downloaded filesize and saved filename.'''
+def _rawResponse(res):
+    ''' Return the underlying stream of the response for readinto().
+
+        mechanize seek wrapper keeps a copy of everything read in memory,
+        so read from the wrapped response when nothing is read yet.
+    '''
+    while getattr(res, 'wrapped', None) is not None and res.tell() == 0:
+        res = res.wrapped
+    fp = getattr(res, 'fp', None)
+    if fp is not None and hasattr(fp, 'readinto'):
+        return fp
+    return res
+
+
+def _readInto(raw, view):
+    ''' readinto() with fallback to read() for stream not supporting it '''
+    if hasattr(raw, 'readinto'):
+        return raw.readinto(view)
+    data = raw.read(len(view))
+    view[:len(data)] = data
+    return len(data)
+
+
+def _preallocate(f, size):
+    ''' Reserve the disk space for the whole file, ignore if not supported by the filesystem. '''
+    try:
+        f.flush()
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(f.fileno(), 0, size)
+        else:
+            f.truncate(size)
+    except (OSError, io.UnsupportedOperation):
+        pass
+
+
+class DownloadSink(object):
+    ''' Write downloaded chunks to the file using reusable buffers.
+
+        The buffer starts at BUFFER_SIZE and is doubled up to MAX_BUFFER_SIZE
+        every time a read fills it, so fast connection use less read() call.
+
+        - writerThread: write from a separate thread, so a slow disk does not block the read.
+        - queueSize: maximum buffer waiting for the writer thread.
+        - hasher: hashlib object updated with the written data.
+    '''
+    bufferSize = PixivConstant.BUFFER_SIZE
+    written = 0
+    hasher = None
+
+    _file = None
+    _free = None
+    _queue = None
+    _thread = None
+    _error = None
+
+    def __init__(self, f, writerThread=False, queueSize=4, hasher=None):
+        self._file = f
+        self.hasher = hasher
+        self._free = collections.deque()
+        self.bufferSize = PixivConstant.BUFFER_SIZE
+        self.written = 0
+        if writerThread:
+            self._queue = queue.Queue(max(1, queueSize))
+            self._thread = threading.Thread(target=self._writer, name='DownloadSink')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def getBuffer(self):
+        ''' Return a free buffer of the current size. '''
+        while self._free:
+            buf = self._free.popleft()
+            if len(buf) == self.bufferSize:
+                return buf
+        return bytearray(self.bufferSize)
+
+    def write(self, buf, n):
+        ''' Write the first n bytes of buf, the buffer is reused after it is written. '''
+        if self._error is not None:
+            raise self._error
+        if n == len(buf) and self.bufferSize < PixivConstant.MAX_BUFFER_SIZE:
+            self.bufferSize = min(self.bufferSize * 2, PixivConstant.MAX_BUFFER_SIZE)
+        if self._thread is None:
+            self._write(buf, n)
+        else:
+            self._queue.put((buf, n))
+
+    def _write(self, buf, n):
+        with memoryview(buf) as view:
+            self._file.write(view[:n])
+            if self.hasher is not None:
+                self.hasher.update(view[:n])
+        self.written = self.written + n
+        self._free.append(buf)
+
+    def _writer(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is None:
+                try:
+                    self._write(*item)
+                except BaseException as ex:
+                    self._error = ex
+
+    def close(self, raiseError=True):
+        ''' Wait for the pending write. '''
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if raiseError and self._error is not None:
+            raise self._error
+
+
+def downloadImage(url, filename, res, file_size, overwrite, resume_from=0, keep_partial=False, writerThread=False, hasher=None):
+    ''' Actual download, return the downloaded filesize and saved filename.
+
+        resume_from: append to existing filename + '.pixiv' from this offset, res must be the 206 response.
+                     Raise PixivException(DOWNLOAD_PARTIAL_MISSING) if it is saved to the server filename without partial file.
+        keep_partial: keep the incomplete filename + '.pixiv' for resuming later.
+        writerThread: write to the disk from a separate thread, see DownloadSink.
+        hasher: hashlib object updated with the file content, including the resumed part.
+    '''
     start_time = datetime.now()
+    # not 'ab', the file is preallocated and written in place
+    mode = 'r+b' if resume_from > 0 else 'wb+'
 
     # try to save to the given filename + .pixiv extension if possible
     try:
         makeSubdirs(filename)
-        save = file(filename + '.pixiv', 'wb+', 4096)
+        save = open(filename + '.pixiv', mode)
     except IOError:
         print_and_log('error', "Error at download_image(): Cannot save {0} to {1}: {2}".format(url, filename, sys.exc_info()))
 
@@ -597,37 +869,65 @@ def downloadImage(url, filename, res, file_size, overwrite):
         filename = os.path.split(url)[1]
         filename = filename.split("?")[0]
         filename = sanitizeFilename(filename)
-        save = file(filename + '.pixiv', 'wb+', 4096)
+        if resume_from > 0 and (not os.path.isfile(filename + '.pixiv') or os.path.getsize(filename + '.pixiv') < resume_from):
+            # res start from resume_from, the caller must download again from the beginning
+            raise PixivException('Cannot resume, partial file is missing: {0}.pixiv'.format(filename),
+                                 errorCode=PixivException.DOWNLOAD_PARTIAL_MISSING)
+        # the same mode, append would write after the preallocated space
+        save = open(filename + '.pixiv', mode)
         print_and_log('info', 'File is saved to ' + filename)
 
     # download the file
-    prev = 0
-    curr = 0
+    if resume_from > 0:
+        if hasher is not None:
+            save.seek(0)
+            hashStream(save, hasher, resume_from)
+        save.seek(resume_from)
+        save.truncate()
+    curr = resume_from
     print('{0:22} Bytes'.format(curr), end=' ')
+    sink = DownloadSink(save, writerThread, hasher=hasher)
     try:
+        if file_size > resume_from:
+            _preallocate(save, file_size)
+
+        raw = _rawResponse(res)
+        last_progress = time.monotonic()
         while True:
-            save.write(res.read(PixivConstant.BUFFER_SIZE))
-            curr = save.tell()
-            print_progress(curr, file_size)
-
-            # check if downloaded file is complete
-            if file_size > 0 and curr == file_size:
-                total_time = (datetime.now() - start_time).total_seconds()
-                print(' Completed in {0}s ({1})'.format(total_time, speedInStr(file_size, total_time)))
+            buf = sink.getBuffer()
+            size = len(buf)
+            if file_size > 0:
+                # do not read past the file size
+                size = min(size, file_size - curr)
+                if size <= 0:
+                    break
+            with memoryview(buf) as view:
+                n = _readInto(raw, view[:size])
+            if not n:
                 break
+            sink.write(buf, n)
+            curr = curr + n
 
-            elif curr == prev:  # no file size info
-                total_time = (datetime.now() - start_time).total_seconds()
-                print(' Completed in {0}s ({1})'.format(total_time, speedInStr(curr, total_time)))
-                break
+            now = time.monotonic()
+            if now - last_progress >= PixivConstant.PROGRESS_INTERVAL:
+                print_progress(curr, file_size)
+                last_progress = now
 
-            prev = curr
+        sink.close()
+        print_progress(curr, file_size)
+        total_time = (datetime.now() - start_time).total_seconds()
+        print(' Completed in {0}s ({1})'.format(total_time, speedInStr(curr - resume_from, total_time)))
 
     except BaseException:
         raise
 
     finally:
+        sink.close(raiseError=False)
+        curr = resume_from + sink.written
         if save is not None:
+            if file_size > 0 and curr < file_size:
+                # remove the preallocated space, the file size is the resume offset
+                save.truncate(curr)
             save.close()
 
         completed = True
@@ -648,6 +948,8 @@ def downloadImage(url, filename, res, file_size, overwrite):
             if overwrite and os.path.exists(filename):
                 os.remove(filename)
             os.rename(filename + '.pixiv', filename)
+        elif keep_partial and file_size > 0 and curr > 0:
+            print_and_log('info', 'Keeping partial file for resume: {0}.pixiv ({1} Bytes)'.format(filename, curr))
         else:
             os.remove(filename + '.pixiv')
 
@@ -656,12 +958,83 @@ def downloadImage(url, filename, res, file_size, overwrite):
     return (curr, filename)
 
 
+def hashStream(f, hasher, size=-1):
+    ''' Update hasher with size bytes (-1 for all) from the current position of f. '''
+    buf = bytearray(PixivConstant.MAX_BUFFER_SIZE)
+    with memoryview(buf) as view:
+        while size != 0:
+            n = f.readinto(view if size < 0 else view[:min(size, len(buf))])
+            if not n:
+                break
+            hasher.update(view[:n])
+            if size > 0:
+                size = size - n
+
+
+def hashFile(filename):
+    ''' Return (file size, content hash) of the file, see PixivConstant.CONTENT_HASH. '''
+    hasher = hashlib.new(PixivConstant.CONTENT_HASH)
+    with open(filename, 'rb', buffering=0) as f:
+        hashStream(f, hasher)
+        return (f.tell(), hasher.hexdigest())
+
+
+# linux/ioctl.h _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+
+def reflinkFile(source, target):
+    ''' Copy-on-write clone of source to target, raise OSError if not supported. '''
+    if fcntl is None or not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, 'reflink is not supported on this platform')
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def linkFile(source, target, mode):
+    ''' Replace target with a hardlink or reflink to the source, mode is the dedupeMode config.
+
+        Return False if the link cannot be created, e.g. different drive or not supported by the filesystem.
+    '''
+    if os.path.exists(target) and os.path.samefile(source, target):
+        return True
+    temp_name = target + '.link'
+    try:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        if mode == 'hardlink':
+            os.link(source, temp_name)
+        elif mode == 'reflink':
+            reflinkFile(source, temp_name)
+        else:
+            return False
+        os.replace(temp_name, target)
+    except OSError:
+        GetLogger().info('Cannot %s %s to %s: %s', mode, source, target, sys.exc_info()[1])
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        return False
+    return True
+
+
+def parseContentRangeTotal(content_range):
+    ''' Return the total size from Content-Range header, e.g.: 'bytes 0-99/1234' or 'bytes */1234' '''
+    if content_range is not None:
+        total = content_range.rsplit('/', 1)[-1].strip()
+        if total.isdigit():
+            return int(total)
+    return -1
+
+
 def print_progress(curr, total):
     # [12345678901234567890]
     # [||||||||------------]
+    # the progress of the download pool workers would overwrite each other, only the completed line is printed.
+    if threading.current_thread() is not threading.main_thread():
+        return
 
     if total > 0:
-        complete = (curr * 20) / total
+        complete = (curr * 20) // total
         print('\r', end=' ')
         msg = '[{0:20}] {1} of {2}'.format('|' * complete, sizeInStr(curr), sizeInStr(total))
         print('{0}'.format(msg), end=' ')
@@ -736,31 +1109,97 @@ def writeUrlInDescription(image, blacklistRegex, filenamePattern):
         info.close()
 
 
-def ugoira2gif(ugoira_file, exportname, delete_ugoira, fmt='gif', image=None):
-    print_and_log('info', 'processing ugoira to animated gif...')
-    temp_folder = tempfile.mkdtemp()
-    # imageio cannot handle utf-8 filename
-    temp_name = temp_folder + os.sep + "temp.gif"
-
-    with zipfile.ZipFile(ugoira_file) as f:
-        f.extractall(temp_folder)
-
-    filenames = os.listdir(temp_folder)
-    filenames.remove('animation.json')
-    anim_info = json.load(open(temp_folder + '/animation.json'))
-
-    durations = []
-    images = []
-    for info in anim_info["frames"]:
-        images.append(imageio.imread(temp_folder + os.sep + info["file"]))
-        durations.append(float(info["delay"]) / 1000)
-
-    kargs = {'duration': durations}
-    imageio.mimsave(temp_name, images, fmt, **kargs)
-    shutil.move(temp_name, exportname)
+class UgoiraFrames(object):
+    '''Read the animation info and the frames directly from the ugoira zip, without extracting to a temp directory.
+
+       Iterate to get the (file, delay) of each frame, then read() or open() the frame file.
+    '''
+    frames = None
+    # the apng fcTL delay is unsigned short, the merged frames are split at this delay.
+    maxFrameDelay = 65535
+    _zip = None
+
+    def __init__(self, ugoira_file):
+        self._zip = zipfile.ZipFile(ugoira_file)
+        try:
+            self.frames = json.loads(self._zip.read('animation.json'))['frames']
+        except BaseException:
+            self._zip.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def __iter__(self):
+        for info in self.frames:
+            yield (info['file'], int(info['delay']))
+
+    def __len__(self):
+        return len(self.frames)
+
+    def read(self, name):
+        '''Return the frame file as bytes'''
+        return self._zip.read(name)
+
+    def open(self, name):
+        '''Return file object for the frame, the data is decompressed as it is read'''
+        return self._zip.open(name)
+
+    def collapseDuplicates(self):
+        '''Merge the identical consecutive frames by summing their delay, return the number of dropped frames.
+
+           The crc and size in the zip directory are compared first, the frames are only hashed when both match.
+           A merged frame is not longer than maxFrameDelay, the rest is kept as the next frame.
+           The merged delay is used as is by all the conversion, see _ffmpegFeedFrames() for webm.
+        '''
+        collapsed = list()
+        digests = dict()
+
+        def digest(name):
+            if name not in digests:
+                digests[name] = hashlib.sha1(self._zip.read(name)).digest()
+            return digests[name]
+
+        previous = None
+        for info in self.frames:
+            zinfo = self._zip.getinfo(info['file'])
+            if previous is not None and \
+               (zinfo.CRC, zinfo.file_size) == (previous.CRC, previous.file_size) and \
+               (zinfo.filename == previous.filename or digest(zinfo.filename) == digest(previous.filename)):
+                if int(collapsed[-1]['delay']) + int(info['delay']) <= self.maxFrameDelay:
+                    collapsed[-1]['delay'] = int(collapsed[-1]['delay']) + int(info['delay'])
+                    continue
+            collapsed.append(dict(info))
+            previous = zinfo
+
+        dropped = len(self.frames) - len(collapsed)
+        self.frames = collapsed
+        return dropped
+
+    def close(self):
+        self._zip.close()
+
+
+def openUgoiraFrames(ugoira_file):
+    '''UgoiraFrames with the identical consecutive frames merged, used by all the ugoira conversion'''
+    frames = UgoiraFrames(ugoira_file)
+    try:
+        dropped = frames.collapseDuplicates()
+    except BaseException:
+        frames.close()
+        raise
+    if dropped > 0:
+        print_and_log('info', 'Merged {0} duplicate frames, {1} frames to encode: {2}'.format(dropped, len(frames), ugoira_file))
+    return frames
+
+
+def _replaceExport(temp_name, exportname, delete_ugoira, ugoira_file, image):
+    os.replace(temp_name, exportname)
     print_and_log('info', 'ugoira exported to: ' + exportname)
 
-    shutil.rmtree(temp_folder)
     if delete_ugoira:
         print_and_log('info', 'deleting ugoira {0}'.format(ugoira_file))
         os.remove(ugoira_file)
@@ -771,40 +1210,149 @@ def ugoira2gif(ugoira_file, exportname, delete_ugoira, fmt='gif', image=None):
         os.utime(exportname, (ts, ts))
 
 
+class GifWriter(object):
+    '''Write animated gif frame by frame, only the current and the previous frame are kept in memory.
+
+       Each frame is cropped to the region changed from the previous frame before it is quantized.
+       - sharedPalette: quantize the first frame and map the other frames to its palette,
+         instead of calculating the palette for each frame.
+       The frames are converted to RGB, so the alpha channel is dropped (ugoira frames are jpg),
+       use ugoira2apng() to keep the transparency.
+       Require Pillow 6.0.0 for quantize(dither) and GifImagePlugin.getdata(include_color_table).
+    '''
+    loop = 0
+    sharedPalette = False
+    frameCount = 0
+    _file = None
+    _palette = None
+    _previous = None
+
+    def __init__(self, f, sharedPalette=False, loop=0):
+        self._file = f
+        self.sharedPalette = sharedPalette
+        self.loop = loop
+        self.frameCount = 0
+        self._palette = None
+        self._previous = None
+
+    def append(self, frame, delay):
+        '''Quantize and write PIL image frame, delay in ms'''
+        if frame.mode != 'RGB':
+            frame = frame.convert('RGB')
+        box = (0, 0) + frame.size
+        if self._previous is not None and self._previous.size == frame.size:
+            # a frame cannot be empty, keep one pixel for the same image
+            box = ImageChops.difference(self._previous, frame).getbbox() or (0, 0, 1, 1)
+        self._previous = frame
+        if box != (0, 0) + frame.size:
+            frame = frame.crop(box)
+
+        if self._palette is None:
+            frame = frame.quantize(colors=256)
+            if self.sharedPalette:
+                self._palette = frame
+        else:
+            # dithering noise is different for each frame and compress badly
+            frame = frame.quantize(palette=self._palette, dither=0)
+
+        if self.frameCount == 0:
+            # the palette of the first frame is the global color table
+            (header, _) = GifImagePlugin.getheader(frame, info={'loop': self.loop})
+            for data in header:
+                self._file.write(data)
+        # disposal 1: keep the previous frame, and draw the changed region over it
+        for data in GifImagePlugin.getdata(frame, offset=box[:2], duration=delay, disposal=1,
+                                           include_color_table=self.frameCount > 0 and not self.sharedPalette):
+            self._file.write(data)
+        self.frameCount = self.frameCount + 1
+
+    def close(self):
+        # trailer
+        self._file.write(b";")
+
+
+def ugoira2gif(ugoira_file, exportname, delete_ugoira, image=None, sharedPalette=False):
+    print_and_log('info', 'processing ugoira to animated gif...')
+    # written next to the export file, python handles the utf-8 filename
+    temp_name = exportname + ".tmp"
+
+    # decode, quantize and write one frame at a time
+    try:
+        with openUgoiraFrames(ugoira_file) as frames:
+            with open(temp_name, 'wb') as f:
+                writer = GifWriter(f, sharedPalette=sharedPalette)
+                for (name, delay) in frames:
+                    with Image.open(io.BytesIO(frames.read(name))) as frame:
+                        writer.append(frame, delay)
+                writer.close()
+    except BaseException:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+    _replaceExport(temp_name, exportname, delete_ugoira, ugoira_file, image)
+
+
 def ugoira2apng(ugoira_file, exportname, delete_ugoira, image=None):
     print_and_log('info', 'processing ugoira to apng...')
-    temp_folder = tempfile.mkdtemp()
-    temp_name = temp_folder + os.sep + "temp.png"
-
-    with zipfile.ZipFile(ugoira_file) as f:
-        f.extractall(temp_folder)
-
-    filenames = os.listdir(temp_folder)
-    filenames.remove('animation.json')
-    anim_info = json.load(open(temp_folder + '/animation.json'))
-
-    files = []
-    for info in anim_info["frames"]:
-        fImage = temp_folder + os.sep + info["file"]
-        delay = info["delay"]
-        files.append((fImage, delay))
-
-    im = APNG()
-    for fImage, delay in files:
-        im.append(fImage, delay=delay)
-    im.save(temp_name)
-    shutil.move(temp_name, exportname)
-    print_and_log('info', 'ugoira exported to: ' + exportname)
+    temp_name = exportname + ".tmp"
 
-    shutil.rmtree(temp_folder)
-    if delete_ugoira:
-        print_and_log('info', 'deleting ugoira {0}'.format(ugoira_file))
-        os.remove(ugoira_file)
+    # each frame is written as soon as it is decoded, and cropped to the changed region.
+    try:
+        with openUgoiraFrames(ugoira_file) as frames:
+            with APNGWriter(temp_name, num_frames=len(frames), optimize=True) as writer:
+                for (name, delay) in frames:
+                    writer.append(frames.read(name), delay=delay)
+    except BaseException:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+    _replaceExport(temp_name, exportname, delete_ugoira, ugoira_file, image)
+
+
+def _ffmpegProgress(p, exportname):
+    # progress report
+    chatter = b""
+    print_and_log('info', "Start encoding {0}".format(exportname))
+    while p.stderr:
+        buff = p.stderr.read(1)
+        chatter += buff
+        if buff.endswith(b"\r"):
+            chatter = chatter.decode('utf-8', 'replace')
+            if chatter.find("frame=") > 0:
+                print(chatter.strip(), os.linesep, end=' ')
+            chatter = b""
+        if len(buff) == 0:
+            break
+
+
+def _ffmpegFeedFrames(frames, stdin, errors):
+    '''Write the ffconcat to ffmpeg stdin, each frame is inlined as data: URI with its delay as the duration'''
+    try:
+        stdin.write(b"ffconcat version 1.0\n")
+        last = None
+        for (name, delay) in frames:
+            last = "file '{0}'\n".format(_dataUri(name, frames.read(name))).encode("ascii")
+            stdin.write(last)
+            stdin.write("duration {0}\n".format(float(delay) / 1000).encode("ascii"))
+        # Fix ffmpeg concat demuxer as described in issue #381
+        # this will increase the frame count, but will fix the last frame timestamp issue.
+        if last is not None:
+            stdin.write(last)
+    except (BrokenPipeError, OSError):
+        # ffmpeg exited, the return code is checked by the caller.
+        pass
+    except BaseException as ex:
+        errors.append(ex)
+    finally:
+        try:
+            stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
 
-    # set last-modified and last-accessed timestamp
-    if image is not None and _config.setLastModified and exportname is not None and os.path.isfile(exportname):
-        ts = time.mktime(image.worksDateDateTime.timetuple())
-        os.utime(exportname, (ts, ts))
+
+def _dataUri(name, data):
+    mime_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    return "data:{0};base64,{1}".format(mime_type, base64.b64encode(data).decode("ascii"))
 
 
 def ugoira2webm(ugoira_file,
@@ -815,70 +1363,124 @@ def ugoira2webm(ugoira_file,
                 param="-lossless 1 -vsync 2 -r 999 -pix_fmt yuv420p",
                 extension="webm",
                 image=None):
-    ''' modified based on https://github.com/tsudoko/ugoira-tools/blob/master/ugoira2webm/ugoira2webm.py '''
-    d = tempfile.mkdtemp(prefix="ugoira2webm")
-    d = d.replace(os.sep, '/')
-
-    try:
-        frames = {}
-        ffconcat = "ffconcat version 1.0\n"
-
-        if exportname is None or len(exportname) == 0:
-            name = '.'.join(ugoira_file.split('.')[:-1])
-            exportname = "{0}.{1}".format(os.path.basename(name), extension)
-
-        tempname = d + "/temp." + extension
-
-        with zipfile.ZipFile(ugoira_file) as f:
-            f.extractall(d)
-
-        with open(d + "/animation.json") as f:
-            frames = json.load(f)['frames']
-
-        for i in frames:
-            ffconcat += "file " + i['file'] + '\n'
-            ffconcat += "duration " + str(float(i['delay']) / 1000) + '\n'
-        # Fix ffmpeg concat demuxer as described in issue #381
-        # this will increase the frame count, but will fix the last frame timestamp issue.
-        ffconcat += "file " + frames[-1]['file'] + '\n'
-
-        with open(d + "/i.ffconcat", "w") as f:
-            f.write(ffconcat)
-
-        cmd = "{0} -y -i \"{1}/i.ffconcat\" -c:v {2} {3} \"{4}\""
-        cmd = cmd.format(ffmpeg, d, codec, param, tempname)
-        ffmpeg_args = shlex.split(cmd)
-        p = subprocess.Popen(ffmpeg_args, stderr=subprocess.PIPE)
-
-        # progress report
-        chatter = ""
-        print_and_log('info', "Start encoding {0}".format(exportname))
-        while p.stderr:
-            buff = p.stderr.read(1)
-            chatter += buff
-            if buff.endswith("\r"):
-                if chatter.find("frame=") > 0:
-                    print(chatter.strip(), os.linesep, end=' ')
-                chatter = ""
-            if len(buff) == 0:
-                break
-
+    ''' modified based on https://github.com/tsudoko/ugoira-tools/blob/master/ugoira2webm/ugoira2webm.py
+
+        The ffconcat is piped to ffmpeg stdin with the frames read from the zip as data: URI,
+        so every frame keep its own delay (including the merged duplicates) without extracting to temp directory.
+    '''
+    if exportname is None or len(exportname) == 0:
+        name = '.'.join(ugoira_file.split('.')[:-1])
+        exportname = "{0}.{1}".format(os.path.basename(name), extension)
+
+    # keep the extension for ffmpeg output format detection
+    tempname = exportname + ".tmp." + extension
+    cmd = "{0} -y -f concat -safe 0 -protocol_whitelist pipe,data -i pipe:0 -c:v {1} {2}"
+    cmd = cmd.format(ffmpeg, codec, param)
+    ffmpeg_args = shlex.split(cmd) + [tempname]
+
+    with openUgoiraFrames(ugoira_file) as frames:
+        p = subprocess.Popen(ffmpeg_args, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        errors = list()
+        feeder = threading.Thread(target=_ffmpegFeedFrames, args=(frames, p.stdin, errors))
+        feeder.start()
+        try:
+            _ffmpegProgress(p, exportname)
+        finally:
+            feeder.join()
         ret = p.wait()
-        shutil.move(tempname, exportname)
-
-        if delete_ugoira:
-            print_and_log('info', 'deleting ugoira {0}'.format(ugoira_file))
-            os.remove(ugoira_file)
-
-        if ret is not None:
-            print("done with status= {0}".format(ret))
-        # set last-modified and last-accessed timestamp
-        if image is not None and _config.setLastModified and exportname is not None and os.path.isfile(exportname):
-            ts = time.mktime(image.worksDateDateTime.timetuple())
-            os.utime(exportname, (ts, ts))
+        if len(errors) > 0:
+            if os.path.exists(tempname):
+                os.remove(tempname)
+            raise errors[0]
+
+    _ffmpegDone(ret, ffmpeg_args, tempname, exportname, delete_ugoira, ugoira_file, image)
+
+
+def _ffmpegDone(ret, ffmpeg_args, tempname, exportname, delete_ugoira, ugoira_file, image):
+    print("done with status= {0}".format(ret))
+    if ret != 0:
+        if os.path.exists(tempname):
+            os.remove(tempname)
+        raise subprocess.CalledProcessError(ret, ffmpeg_args)
+    _replaceExport(tempname, exportname, delete_ugoira, ugoira_file, image)
+
+
+def createUgoira(filename, ugoiraData):
+    '''Create the .ugoira archive from the downloaded zip and the animation info'''
+    zipTarget = filename[:-4] + ".ugoira"
+    if os.path.exists(zipTarget):
+        os.remove(zipTarget)
+
+    shutil.copyfile(filename, zipTarget)
+    zipSize = os.stat(filename).st_size
+    jsStr = ugoiraData[:-1] + r',"zipSize":' + str(zipSize) + r'}'
+    with zipfile.ZipFile(zipTarget, mode="a") as z:
+        z.writestr("animation.json", jsStr)
+    return zipTarget
+
+
+def convertUgoira(filename, ugoiraData, config, timestamp=None):
+    '''Create the .ugoira from the downloaded zip and convert it to the enabled formats.
+
+       This is run in the ugoira conversion process, so only take picklable parameters.
+       Return the list of the created files.
+    '''
+    setConfig(config)
+    if filename.endswith(".zip"):
+        ugo_name = filename[:-4] + ".ugoira"
+    else:
+        ugo_name = filename
+
+    created = list()
+    if not os.path.exists(ugo_name):
+        print_and_log('info', "Creating ugoira archive => " + ugo_name)
+        createUgoira(filename, ugoiraData)
+        created.append(ugo_name)
+
+    if config.deleteZipFile and os.path.exists(filename):
+        print_and_log('info', "Deleting zip file => " + filename)
+        os.remove(filename)
+
+    if config.createGif:
+        gif_filename = ugo_name[:-7] + ".gif"
+        if not os.path.exists(gif_filename):
+            ugoira2gif(ugo_name, gif_filename, config.deleteUgoira, sharedPalette=config.gifSharedPalette)
+            created.append(gif_filename)
+    if config.createApng:
+        gif_filename = ugo_name[:-7] + ".png"
+        if not os.path.exists(gif_filename):
+            ugoira2apng(ugo_name, gif_filename, config.deleteUgoira)
+            created.append(gif_filename)
+    if config.createWebm:
+        gif_filename = ugo_name[:-7] + ".webm"
+        if not os.path.exists(gif_filename):
+            ugoira2webm(ugo_name,
+                        gif_filename,
+                        config.deleteUgoira,
+                        config.ffmpeg,
+                        config.ffmpegCodec,
+                        config.ffmpegParam,
+                        "webm")
+            created.append(gif_filename)
+    if config.createWebp:
+        gif_filename = ugo_name[:-7] + ".webp"
+        if not os.path.exists(gif_filename):
+            ugoira2webm(ugo_name,
+                        gif_filename,
+                        config.deleteUgoira,
+                        config.ffmpeg,
+                        config.webpCodec,
+                        config.webpParam,
+                        "webp")
+            created.append(gif_filename)
 
-    finally:
-        shutil.rmtree(d)
+    # set last-modified and last-accessed timestamp
+    if timestamp is not None:
+        for created_file in created:
+            if os.path.isfile(created_file):
+                os.utime(created_file, (timestamp, timestamp))
+    return created
 
 
 def ParseDateTime(worksDate, dateFormat):
@@ -0,0 +1,163 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import html
+import json
+import re
+
+from bs4 import BeautifulSoup
+
+try:
+    import lxml  # noqa: F401
+    HAVE_LXML = True
+except ImportError:
+    HAVE_LXML = False
+
+HTML_PARSERS = ('fast', 'lxml', 'html.parser')
+
+
+def getFeatures(parser='fast'):
+    '''BeautifulSoup tree builder for the htmlParser config'''
+    if parser == 'html.parser' or not HAVE_LXML:
+        return 'html.parser'
+    return 'lxml'
+
+
+def parseHtml(page, parser='fast'):
+    '''Return FastPage for 'fast', otherwise the full BeautifulSoup tree'''
+    if parser == 'fast':
+        return FastPage(page)
+    return BeautifulSoup(page, features=getFeatures(parser))
+
+
+def unescapeAttribute(value):
+    '''html.unescape() with str.replace() for the common entities, json in data-items have a lot of &quot;'''
+    if '&' not in value:
+        return value
+    result = value.replace('&quot;', '"').replace('&#39;', "'").replace('&lt;', '<').replace('&gt;', '>')
+    if result.count('&') != result.count('&amp;'):
+        return html.unescape(value)
+    return result.replace('&amp;', '&')
+
+
+def asSoup(page):
+    '''Get the BeautifulSoup tree for page from parseHtml()'''
+    if isinstance(page, FastPage):
+        return page.soup()
+    return page
+
+
+class FastPage(object):
+    '''Targeted extraction from the raw html without building the DOM tree.
+
+       Only the nodes used by the search and bookmark pages are supported,
+       the full tree is built by soup() when a page does not have them.
+    '''
+    __re_illust_href = re.compile(r'''href=["'][^"']*member_illust\.php\?[^"']*illust_id=(\d+)''')
+    __re_count_badge = re.compile(r'''<span[^>]*class=["']count-badge["'][^>]*>([^<]*)''')
+    __re_ul_image_items = re.compile(r'''<ul\b[^>]*class=["'](?:[^"']*\s)?_image-items(?:\s[^"']*)?["']''')
+    __re_ul_tag = re.compile(r'<(/?)ul\b', re.IGNORECASE)
+    __re_start_tag = re.compile(r'''<[a-zA-Z](?:[^>"']|"[^"]*"|'[^']*')*>''')
+
+    html = None
+    _soup = None
+
+    def __init__(self, page):
+        if isinstance(page, bytes):
+            page = page.decode('utf-8', 'replace')
+        elif not isinstance(page, str):
+            page = page.read()
+            if isinstance(page, bytes):
+                page = page.decode('utf-8', 'replace')
+        self.html = page
+        self._soup = None
+
+    def soup(self):
+        if self._soup is None:
+            self._soup = BeautifulSoup(self.html, features=getFeatures())
+        return self._soup
+
+    def decompose(self):
+        if self._soup is not None:
+            self._soup.decompose()
+            self._soup = None
+
+    def getTag(self, tag_id):
+        '''Return the start tag having the given id attribute'''
+        for quote in ('"', "'"):
+            index = self.html.find('id=' + quote + tag_id + quote)
+            if index > 0:
+                break
+        else:
+            return None
+        m = self.__re_start_tag.match(self.html, self.html.rfind('<', 0, index))
+        if m is None:
+            return None
+        return m.group(0)
+
+    def getAttribute(self, tag, name):
+        # not data-class= for class=
+        m = re.search(r'''(?<![\w-])''' + re.escape(name) + r'''=(?:"([^"]*)"|'([^']*)')''', tag)
+        if m is None:
+            return None
+        value = m.group(1) if m.group(1) is not None else m.group(2)
+        return unescapeAttribute(value)
+
+    def getDataItems(self, tag_id):
+        '''Return the parsed data-items json of the given element, None if not found'''
+        tag = self.getTag(tag_id)
+        if tag is None:
+            return None
+        value = self.getAttribute(tag, 'data-items')
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def hasTag(self, name, cls, rel=None):
+        '''Check for a tag with the class (and rel), matched like the multi-valued attributes of BeautifulSoup'''
+        for m in re.finditer(r'''<''' + name + r'''\b(?:[^>"']|"[^"]*"|'[^']*')*>''', self.html):
+            tag = m.group(0)
+            if self._matchValues(self.getAttribute(tag, 'class'), cls) and \
+               (rel is None or self._matchValues(self.getAttribute(tag, 'rel'), rel)):
+                return True
+        return False
+
+    @staticmethod
+    def _matchValues(attribute, value):
+        '''value is one of the space separated values, or all of them'''
+        if attribute is None:
+            return False
+        values = attribute.split()
+        return value in values or value == ' '.join(values)
+
+    def getCountBadge(self):
+        m = self.__re_count_badge.search(self.html)
+        if m is None:
+            return 0
+        temp_count = re.findall(r'\d+', m.group(1))
+        if temp_count:
+            return int(temp_count[0])
+        return 0
+
+    def getImageItemIds(self):
+        '''Return the illust ids linked from the first _image-items list, None if not found'''
+        m = self.__re_ul_image_items.search(self.html)
+        if m is None:
+            return None
+        # find the matching </ul>
+        depth = 0
+        end = len(self.html)
+        for tag in self.__re_ul_tag.finditer(self.html, m.start()):
+            if tag.group(1) == '':
+                depth = depth + 1
+            else:
+                depth = depth - 1
+                if depth == 0:
+                    end = tag.start()
+                    break
+
+        image_ids = list()
+        for href in self.__re_illust_href.findall(self.html, m.start(), end):
+            image_id = int(href)
+            if image_id not in image_ids:
+                image_ids.append(image_id)
+        return image_ids
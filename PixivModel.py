@@ -5,12 +5,13 @@
 import os
 import re
 import sys
-import shutil
-import zipfile
+import threading
 import codecs
 import collections
+from concurrent.futures import ThreadPoolExecutor
 import urllib.request, urllib.parse, urllib.error
 import PixivHelper
+import PixivHtmlParser
 import urllib.parse
 from PixivException import PixivException
 from datetime import datetime
@@ -518,7 +519,8 @@ class PixivImage:
             self.imageUrls = self.CheckMangaType(page, _br)
         elif mode == 'ugoira_view':
             self.imageUrls.append(self.ParseUgoira(page))
-        if len(self.imageUrls) == 0:
+        # don't use len(), PixivMangaPageUrls is still resolving the pages.
+        if not self.imageUrls:
             raise PixivException('No images found for: ' + str(self.imageId), errorCode=PixivException.NO_IMAGES, htmlPage=page)
         return self.imageUrls
 
@@ -607,7 +609,6 @@ class PixivImage:
         return urls
 
     def ParseMangaImagesNew(self, page, _br):
-        urls = []
         # mangaSection = page.find("section", attrs={'class': 'manga'})
         # links = mangaSection.findAll('a')
         # pattern /member_illust.php?mode=manga_big&illust_id=46279245&page=0
@@ -619,31 +620,40 @@ class PixivImage:
         if total is not None:
             self.imageCount = int(total.string)
 
-        for currPage in range(0, self.imageCount):
-            expected_url = '/member_illust.php?mode=manga_big&illust_id=' + str(self.imageId) + '&page=' + str(currPage)
-            try:
-                href = _br.fixUrl(expected_url)
-                msg = "\rFetching big image page: {0}".format(href)
-                print("{0:79}".format(msg), end=' ')
-                bigPage = _br.getPixivPage(url=href,
-                                           referer="https://www.pixiv.net/member_illust.php?mode=manga&illust_id=" + str(
-                                               self.imageId))
-
-                bigImg = bigPage.find('img')
-                imgUrl = bigImg["src"]
-                # http://i2.pixiv.net/img-original/img/2013/12/27/01/51/37/40538869_p7.jpg
-                msg = "\rFound: {0}".format(imgUrl)
-                print("{0:79}".format(msg), end=' ')
-                urls.append(imgUrl)
-                bigImg.decompose()
-                bigPage.decompose()
-                del bigImg
-                del bigPage
-            except Exception as ex:
-                print(ex)
-        print("\r{0:120}".format("Manga pages parsed."))
+        # the big pages are fetched in parallel up to downloadMaxPerHost,
+        # the downloader get the first page url while the rest still fetched.
+        # With 1 worker, the pages are fetched in the caller thread using _br.
+        workers = 1
+        if _br._config is not None:
+            workers = max(1, _br._config.downloadMaxPerHost)
+        return PixivMangaPageUrls(lambda currPage: self.ParseMangaBigPage(currPage, _br, workers > 1), self.imageCount, workers)
+
+    def ParseMangaBigPage(self, currPage, _br, useThreadBrowser=False):
+        if useThreadBrowser:
+            # mechanize.Browser is not thread safe, use the browser of the resolver thread
+            import PixivBrowserFactory
+            _br = PixivBrowserFactory.getDownloadBrowser()
 
-        return urls
+        expected_url = '/member_illust.php?mode=manga_big&illust_id=' + str(self.imageId) + '&page=' + str(currPage)
+        try:
+            href = _br.fixUrl(expected_url)
+            PixivHelper.GetLogger().debug("Fetching big image page: %s", href)
+            bigPage = _br.getPixivPage(url=href,
+                                       referer="https://www.pixiv.net/member_illust.php?mode=manga&illust_id=" + str(
+                                           self.imageId))
+
+            bigImg = bigPage.find('img')
+            imgUrl = bigImg["src"]
+            # http://i2.pixiv.net/img-original/img/2013/12/27/01/51/37/40538869_p7.jpg
+            PixivHelper.GetLogger().debug("Found: %s", imgUrl)
+            bigImg.decompose()
+            bigPage.decompose()
+            del bigImg
+            del bigPage
+            return imgUrl
+        except Exception as ex:
+            print(ex)
+        return None
 
     def ParseBookmarkDetails(self, page):
         if page is None:
@@ -748,15 +758,75 @@ class PixivImage:
         if len(self.ugoira_data) == 0:
             PixivHelper.GetLogger().exception("Missing ugoira animation info for image: " + str(self.imageId))
 
-        zipTarget = filename[:-4] + ".ugoira"
-        if os.path.exists(zipTarget):
-            os.remove(zipTarget)
+        PixivHelper.createUgoira(filename, self.ugoira_data)
+
+
+_resolverExecutor = None
+_resolverWorkers = 0
+_resolverLock = threading.Lock()
+
+
+def getResolverExecutor(workers):
+    '''Shared thread pool for PixivMangaPageUrls, the threads (and their browser) are reused for the next manga.'''
+    global _resolverExecutor
+    global _resolverWorkers
+    with _resolverLock:
+        if _resolverExecutor is None or _resolverWorkers != workers:
+            if _resolverExecutor is not None:
+                _resolverExecutor.shutdown(wait=False)
+            _resolverExecutor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='MangaPageResolver')
+            _resolverWorkers = workers
+        return _resolverExecutor
+
+
+class PixivMangaPageUrls(object):
+    '''Manga page urls resolved by a thread pool, iterate in page order and yield each url as soon as it is resolved.
+
+    With 1 worker, each page is resolved in the iterating thread when it is needed.
+    '''
+    _urls = None
+
+    def __init__(self, resolve, count, workers=1):
+        self._count = count
+        self._resolve = resolve
+        self._futures = None
+        self._urls = None
+        if count > 0 and workers > 1:
+            executor = getResolverExecutor(workers)
+            self._futures = [executor.submit(resolve, page) for page in range(count)]
+
+    def __iter__(self):
+        if self._urls is not None:
+            return iter(self._urls)
+        return self._iterResolved()
+
+    def _iterResolved(self):
+        urls = list()
+        for page in range(self._count):
+            if self._futures is not None:
+                url = self._futures[page].result()
+            else:
+                url = self._resolve(page)
+            if url is not None:
+                urls.append(url)
+                yield url
+        self._urls = urls
+        print("\r{0:120}".format("Manga pages parsed."))
+
+    def __bool__(self):
+        return self._count > 0
+
+    def __len__(self):
+        return len(self.toList())
 
-        shutil.copyfile(filename, zipTarget)
-        zipSize = os.stat(filename).st_size
-        jsStr = self.ugoira_data[:-1] + r',"zipSize":' + str(zipSize) + r'}'
-        with zipfile.ZipFile(zipTarget, mode="a") as z:
-            z.writestr("animation.json", jsStr)
+    def __getitem__(self, index):
+        return self.toList()[index]
+
+    def toList(self):
+        '''Wait for all the pages'''
+        if self._urls is None:
+            self._urls = list(self._iterResolved())
+        return self._urls
 
 
 class PixivListItem:
@@ -776,8 +846,11 @@ class PixivListItem:
     @staticmethod
     def parseList(filename, rootDir=None):
         '''read list.txt and return the list of PixivListItem'''
-        l = list()
+        return list(PixivListItem.iterList(filename, rootDir))
 
+    @staticmethod
+    def iterList(filename, rootDir=None):
+        '''read list.txt and yield PixivListItem line by line'''
         if not os.path.exists(filename):
             raise PixivException("File doesn't exists or no permission to read: " + filename,
                                  errorCode=PixivException.FILE_NOT_EXISTS_OR_NO_WRITE_PERMISSION)
@@ -840,9 +913,12 @@ class PixivListItem:
 
                 list_item = PixivListItem(member_id, path)
                 # PixivHelper.safePrint(u"- {0} ==> {1} ".format(member_id, path))
-                l.append(list_item)
                 line_no = line_no + 1
                 original_line = ""
+                yield list_item
+        except GeneratorExit:
+            # consumer stopped iterating
+            pass
         except UnicodeDecodeError:
             PixivHelper.GetLogger().exception("PixivListItem.parseList(): Invalid value when parsing list")
             PixivHelper.print_and_log('error',
@@ -851,9 +927,8 @@ class PixivListItem:
         except BaseException:
             PixivHelper.GetLogger().exception("PixivListItem.parseList(): Invalid value when parsing list")
             PixivHelper.print_and_log('error', 'Invalid value: {0} at line {1}'.format(original_line, line_no))
-
-        reader.close()
-        return l
+        finally:
+            reader.close()
 
 
 class PixivNewIllustBookmark:
@@ -871,10 +946,14 @@ class PixivNewIllustBookmark:
         self.imageList = list()
 
         # Fix Issue#290
-        jsBookmarkItem = page.find(id='js-mount-point-latest-following')
-        if jsBookmarkItem is not None:
-            js = jsBookmarkItem["data-items"]
-            items = json.loads(js)
+        items = None
+        if isinstance(page, PixivHtmlParser.FastPage):
+            items = page.getDataItems('js-mount-point-latest-following')
+        else:
+            jsBookmarkItem = page.find(id='js-mount-point-latest-following')
+            if jsBookmarkItem is not None:
+                items = json.loads(jsBookmarkItem["data-items"])
+        if items is not None:
             for item in items:
                 image_id = item["illustId"]
                 # bookmarkCount = item["bookmarkCount"]
@@ -882,6 +961,7 @@ class PixivNewIllustBookmark:
                 self.imageList.append(int(image_id))
         else:
             try:
+                page = PixivHtmlParser.asSoup(page)
                 result = page.find(attrs={'class': '_image-items autopagerize_page_element'}).findAll('a')
                 for r in result:
                     href = re.search(r'member_illust.php?.*illust_id=(\d+)', r['href'])
@@ -896,7 +976,10 @@ class PixivNewIllustBookmark:
         return self.imageList
 
     def __CheckLastPage(self, page):
-        check = page.findAll('a', attrs={'class': '_button', 'rel': 'next'})
+        if isinstance(page, PixivHtmlParser.FastPage):
+            check = [1] if page.hasTag('a', '_button', rel='next') else []
+        else:
+            check = page.findAll('a', attrs={'class': '_button', 'rel': 'next'})
         if len(check) > 0:
             self.isLastPage = False
         else:
@@ -916,6 +999,7 @@ class PixivBookmark:
         db = PixivDBManager.PixivDBManager()
         __re_member = re.compile(r'member\.php\?id=(\d*)')
         try:
+            page = PixivHtmlParser.asSoup(page)
             result = page.find(attrs={'class': 'members'}).findAll('a')
 
             # filter duplicated member_id
@@ -937,6 +1021,12 @@ class PixivBookmark:
     def parseImageBookmark(page):
         imageList = list()
 
+        if isinstance(page, PixivHtmlParser.FastPage):
+            fast_result = page.getImageItemIds()
+            if fast_result is not None:
+                return fast_result
+            page = page.soup()
+
         temp = page.find('ul', attrs={'class': PixivBookmark.__re_imageULItemsClass})
         temp = temp.findAll('a')
         if temp is None or len(temp) == 0:
@@ -952,18 +1042,31 @@ class PixivBookmark:
 
     @staticmethod
     def exportList(l, filename):
+        '''Write the items to filename, l can be a generator fetching the bookmark pages.
+
+           The existing file is only replaced when all the items are written.
+        '''
         if not filename.endswith('.txt'):
             filename = filename + '.txt'
-        writer = codecs.open(filename, 'wb', encoding='utf-8')
-        writer.write('###Export date: ' + str(datetime.today()) + '###\n')
-        for item in l:
-            data = str(str(item.memberId))
-            if len(item.path) > 0:
-                data = data + str(' ' + item.path)
-            writer.write(data)
-            writer.write('\r\n')
-        writer.write('###END-OF-FILE###')
-        writer.close()
+        temp_name = filename + '.tmp'
+        count = 0
+        try:
+            with codecs.open(temp_name, 'wb', encoding='utf-8') as writer:
+                writer.write('###Export date: ' + str(datetime.today()) + '###\n')
+                for item in l:
+                    count = count + 1
+                    data = str(str(item.memberId))
+                    if len(item.path) > 0:
+                        data = data + str(' ' + item.path)
+                    writer.write(data)
+                    writer.write('\r\n')
+                writer.write('###END-OF-FILE###')
+            os.replace(temp_name, filename)
+        except BaseException:
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+            raise
+        return count
 
 
 PixivTagsItem = collections.namedtuple('PixivTagsItem', ['imageId', 'bookmarkCount', 'imageResponse'])
@@ -1003,10 +1106,16 @@ class PixivTags:
 
         # new format for tag list, fix issue #252
         # fix issue #270, changed to search based on id only
-        js_tags_item = page.find(id="js-mount-point-search-result-list")
-        if js_tags_item is not None:
-            js = js_tags_item["data-items"]
-            items = json.loads(js)
+        items = None
+        if isinstance(page, PixivHtmlParser.FastPage):
+            items = page.getDataItems("js-mount-point-search-result-list")
+            if items is None:
+                page = page.soup()
+        else:
+            js_tags_item = page.find(id="js-mount-point-search-result-list")
+            if js_tags_item is not None:
+                items = json.loads(js_tags_item["data-items"])
+        if items is not None:
             for item in items:
                 image_id = item["illustId"]
                 if image_id is not None:  # Fix #472 skip if no illustId
@@ -1060,13 +1169,14 @@ class PixivTags:
         self.memberId = memberId
         self.query = query
 
-        linkList = page.findAll('a')
+        linkList = PixivHtmlParser.asSoup(page).findAll('a')
         for link in linkList:
             if 'href' in link:
                 result = self.__re_illust.findall(link['href'])
                 if len(result) > 0:
                     image_id = int(result[0])
                     self.itemList.append(PixivTagsItem(int(image_id), 0, 0))
+        # still FastPage, the next page links do not need the tree
         self.checkLastPage(page, fromMember=True)
         self.availableImages = SharedParser.parseCountBadge(page)
         return self.itemList
@@ -1079,6 +1189,11 @@ class PixivTags:
             self.haveImage = False
 
         # check if the last page
+        if isinstance(page, PixivHtmlParser.FastPage):
+            self.isLastPage = not page.hasTag('i', '_icon sprites-next-linked')
+            if fromMember and self.isLastPage:
+                self.isLastPage = not page.hasTag('a', 'button', rel='next')
+            return
         check = page.findAll('i', attrs={'class': '_icon sprites-next-linked'})
         self.isLastPage = not bool(len(check) > 0)
 
@@ -1202,6 +1317,8 @@ class SharedParser:
     @staticmethod
     def parseCountBadge(page):
         # parse image count from count-badge
+        if isinstance(page, PixivHtmlParser.FastPage):
+            return page.getCountBadge()
         total_images = 0
         count_badge_span = page.find('span', attrs={'class': 'count-badge'})
         if count_badge_span is not None:
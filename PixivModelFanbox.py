@@ -3,7 +3,6 @@
 import codecs
 import os
 
-import demjson
 import datetime_z
 
 from PixivException import PixivException
@@ -14,7 +13,7 @@ class Fanbox(object):
     supportedArtist = None
 
     def __init__(self, page):
-        js = demjson.decode(page)
+        js = PixivHelper.parseJson(page)
 
         if js["error"]:
             raise PixivException("Error when requesting Fanbox", 9999, page)
@@ -45,7 +44,7 @@ class FanboxArtist(object):
     def __init__(self, artist_id, page, tzInfo=None):
         self.artistId = int(artist_id)
         self._tzInfo = tzInfo
-        js = demjson.decode(page)
+        js = PixivHelper.parseJson(page)
 
         if "error" in js and js["error"]:
             raise PixivException("Error when requesting Fanbox artist: {0}".format(self.artistId), 9999, page)
@@ -205,7 +204,8 @@ class FanboxPost(object):
                                   errorCode=PixivException.MISSING_CONFIG,
                                   htmlPage=None)
 
-        cfg = demjson.decode_file("content_provider.json")
+        with open("content_provider.json", encoding="utf-8") as reader:
+            cfg = PixivHelper.parseJson(reader.read())
         embed_cfg = cfg["embedConfig"]
         current_provider = embedData["serviceProvider"]
 
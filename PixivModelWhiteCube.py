@@ -7,10 +7,10 @@ import re
 import urllib.request, urllib.parse, urllib.error
 from collections import OrderedDict
 
-import demjson
 from bs4 import BeautifulSoup
 
 import datetime_z
+import PixivHelper
 import PixivModel
 from PixivException import PixivException
 
@@ -21,24 +21,25 @@ class PixivArtist(PixivModel.PixivArtist):
     offset = None
     limit = None
     reference_image_id = 0
+    lastImageId = 0
 
-    def __init__(self, mid=0, page=None, fromImage=False, offset=None, limit=None):
+    def __init__(self, mid=0, page=None, fromImage=False, offset=None, limit=None, lastImageId=0):
         self.offset = offset
         self.limit = limit
+        self.lastImageId = lastImageId
         self.artistId = mid
 
         if page is not None:
-            payload = parseJs(page)
-
             # detect if image count != 0
             if not fromImage:
-                payload = demjson.decode(page)
+                payload = PixivHelper.parseJson(page)
                 if payload["error"]:
                     raise PixivException(payload["message"], errorCode=PixivException.OTHER_MEMBER_ERROR, htmlPage=page)
                 if payload["body"] is None:
                     raise PixivException("Missing body content, possible artist id doesn't exists.", errorCode=PixivException.USER_ID_NOT_EXISTS, htmlPage=page)
                 self.ParseImages(payload["body"])
             else:
+                payload = parseJs(page)
                 self.isLastPage = True
                 self.haveImages = True
 
@@ -131,6 +132,7 @@ class PixivArtist(PixivModel.PixivArtist):
         self.imageList = list()
 
         if "works" in payload:  # filter by tags
+            # lastImageId is not used, the tags/R-18 list is not the whole profile.
             for image in payload["works"]:
                 self.imageList.append(image["id"])
             self.totalImages = int(payload["total"])
@@ -152,6 +154,12 @@ class PixivArtist(PixivModel.PixivArtist):
                 for image in payload["manga"]:
                     self.imageList.append(image)
             self.imageList = sorted(self.imageList, reverse=True, key=int)
+            if self.lastImageId > 0:
+                # incremental update, only the images newer than the last downloaded image.
+                for (i, image_id) in enumerate(self.imageList):
+                    if int(image_id) <= self.lastImageId:
+                        self.imageList = self.imageList[:i]
+                        break
             self.totalImages = len(self.imageList)
             # print("{0} {1} {2}".format(self.offset, self.limit, self.totalImages))
 
@@ -387,8 +395,8 @@ def parseJs(page):
     if len(jss) == 0:
         return None  # Possibly error page
 
-    # Fix issue #364, switch to demjson
-    return demjson.decode(jss[0])
+    # Fix issue #364, switch to demjson, only used if not strict json
+    return PixivHelper.parseJson(jss[0])
 ##
 ##
 ##    js = jss[0]
@@ -7,11 +7,15 @@ import codecs
 import datetime
 import gc
 import getpass
+import hashlib
 import http.client
+import itertools
 import mechanize
+import multiprocessing
 import os
 import random
 import re
+import shutil
 import subprocess
 import sys
 import time
@@ -21,11 +25,15 @@ from bs4 import BeautifulSoup
 from optparse import OptionParser
 
 import datetime_z
+import PixivAsyncBrowser
 import PixivBrowserFactory
+import PixivCache
 import PixivConfig
 import PixivConstant
 import PixivDBManager
+import PixivDownloadHandler
 import PixivHelper
+import PixivHtmlParser
 import PixivModelFanbox
 from PixivException import PixivException
 from PixivModel import (PixivBookmark, PixivGroup, PixivImage, PixivListItem,
@@ -126,6 +134,7 @@ __suppressTags = list()
 __log__ = PixivHelper.GetLogger()
 __errorList = list()
 __blacklistMembers = list()
+__partialEtag = dict()
 __valid_options = ()
 
 start_iv = False
@@ -142,7 +151,7 @@ def get_remote_filesize(url, referer):
     # open with HEAD method, might be expensive
     req = PixivHelper.create_custom_request(url, __config__, referer, head=True)
     try:
-        res = __br__.open_novisit(req)
+        res = PixivBrowserFactory.getDownloadBrowser().open_novisit(req)
         file_size = int(res.info()['Content-Length'])
     except KeyError:
         file_size = -1
@@ -160,6 +169,55 @@ def get_remote_filesize(url, referer):
     return file_size
 
 
+def get_local_filesize(filename):
+    if os.path.exists(filename) and os.path.isfile(filename):
+        return os.path.getsize(filename)
+    if filename.endswith(".zip"):
+        ugo_name = filename[:-4] + ".ugoira"
+        if os.path.exists(ugo_name) and os.path.isfile(ugo_name):
+            return PixivHelper.getUgoiraSize(ugo_name)
+    return -1
+
+
+def open_remote_file(url, referer, local_size=-1):
+    '''Replace HEAD + GET with single GET, return the opened response and the remote filesize.
+
+    If local file exists, only request the bytes after local_size, so identical file
+    will not transfer the body (HTTP 416). The response is None if it is not the full content.
+    '''
+    print('Getting remote file...')
+    req = PixivHelper.create_custom_request(url, __config__, referer)
+    if local_size > 0:
+        req.add_header('Range', 'bytes={0}-'.format(local_size))
+
+    res = None
+    try:
+        res = PixivBrowserFactory.getDownloadBrowser().open_novisit(req)
+        if res.code == 206:
+            file_size = PixivHelper.parseContentRangeTotal(res.info()['Content-Range'])
+            res.close()
+            res = None
+        else:
+            file_size = int(res.info()['Content-Length'])
+    except (KeyError, TypeError):
+        file_size = -1
+        PixivHelper.print_and_log('info', "\tNo file size information!")
+    except mechanize.HTTPError as e:
+        if int(e.code) == 416:
+            # Range Not Satisfiable, the local file is not smaller than remote.
+            file_size = PixivHelper.parseContentRangeTotal(e.info()['Content-Range'])
+        else:
+            raise
+
+    print("Remote filesize = {0} ({1} Bytes)".format(PixivHelper.sizeInStr(file_size), file_size))
+    return (res, file_size)
+
+
+def db_call(func, *args, **kwargs):
+    '''DB access from download_image(), which can be run in the download pool workers.'''
+    return PixivDownloadHandler.getDownloadPool().callInSubmitter(func, *args, **kwargs)
+
+
 # -T04------For download file
 def download_image(url, filename, referer, overwrite, max_retry, backup_old_file=False, image=None, page=None):
     '''return download result and filename if ok'''
@@ -177,7 +235,10 @@ def download_image(url, filename, referer, overwrite, max_retry, backup_old_file
                         PixivHelper.print_and_log('info', "\rLocal file exists: {0}".format(filename.encode('utf-8')))
                         return (PixivConstant.PIXIVUTIL_SKIP_DUPLICATE, filename)
 
-                file_size = get_remote_filesize(url, referer)
+                if __config__.conditionalDownload:
+                    (res, file_size) = open_remote_file(url, referer, get_local_filesize(filename))
+                else:
+                    file_size = get_remote_filesize(url, referer)
 
                 # check if existing ugoira file exists
                 if filename.endswith(".zip"):
@@ -210,11 +271,11 @@ def download_image(url, filename, referer, overwrite, max_retry, backup_old_file
                 if image is not None:
                     db_filename = None
                     if page is not None:
-                        row = __dbManager__.selectImageByImageIdAndPage(image.imageId, page)
+                        row = db_call(__dbManager__.selectImageByImageIdAndPage, image.imageId, page)
                         if row is not None:
                             db_filename = row[2]
                     else:
-                        row = __dbManager__.selectImageByImageId(image.imageId)
+                        row = db_call(__dbManager__.selectImageByImageId, image.imageId)
                         if row is not None:
                             db_filename = row[3]
                     if db_filename is not None and os.path.exists(db_filename) and os.path.isfile(db_filename):
@@ -234,8 +295,14 @@ def download_image(url, filename, referer, overwrite, max_retry, backup_old_file
 
                             return (check_result, db_filename)
 
+                # the same url saved to another filename, e.g. from the bookmark and the member gallery
+                if can_dedupe(filename) and not overwrite and get_local_filesize(filename) < 0:
+                    dedupe_result = dedupe_url(url, filename)
+                    if dedupe_result is not None:
+                        return dedupe_result
+
                 # actual download
-                (downloadedSize, filename) = perform_download(url, file_size, filename, overwrite, referer)
+                (downloadedSize, filename, content_hash) = perform_download(url, file_size, filename, overwrite, referer, res)
                 # set last-modified and last-accessed timestamp
                 if image is not None and __config__.setLastModified and filename is not None and os.path.isfile(filename):
                     ts = time.mktime(image.worksDateDateTime.timetuple())
@@ -279,6 +346,10 @@ def download_image(url, filename, referer, overwrite, max_retry, backup_old_file
                 else:
                     PixivHelper.print_and_log('info', ' done.')
 
+                # after the timestamp and verification, so they are only applied to the downloaded file
+                if downloadedSize > 0 and os.path.isfile(filename):
+                    filename = dedupe_downloaded_file(url, filename, downloadedSize, content_hash)
+
                 # write to downloaded lists
                 if start_iv or __config__.createDownloadLists:
                     dfile = codecs.open(dfilename, 'a+', encoding='utf-8')
@@ -309,6 +380,7 @@ def download_image(url, filename, referer, overwrite, max_retry, backup_old_file
                 return (PixivConstant.PIXIVUTIL_ABORTED, None)
             finally:
                 if res is not None:
+                    res.close()
                     del res
                 if req is not None:
                     del req
@@ -329,22 +401,145 @@ def download_image(url, filename, referer, overwrite, max_retry, backup_old_file
                 raise
 
 
-def perform_download(url, file_size, filename, overwrite, referer=None):
+def perform_download(url, file_size, filename, overwrite, referer=None, res=None):
     if referer is None:
         referer = __config__, referer
     # actual download
     print('\rStart downloading...', end=' ')
-    # fetch filesize
-    req = PixivHelper.create_custom_request(url, __config__, referer)
-    res = __br__.open_novisit(req)
+
+    # check for partial download from previous attempt, only resume if the remote size is known
+    resume_from = 0
+    partial_filename = filename + '.pixiv'
+    if __config__.resumeDownload and os.path.isfile(partial_filename):
+        resume_from = os.path.getsize(partial_filename)
+        if file_size <= 0 or resume_from >= file_size:
+            # cannot be verified or stale
+            resume_from = 0
+
+    if resume_from > 0:
+        if res is not None:
+            res.close()
+        req = PixivHelper.create_custom_request(url, __config__, referer)
+        req.add_header('Range', 'bytes={0}-'.format(resume_from))
+        if url in __partialEtag:
+            req.add_header('If-Range', __partialEtag[url])
+        res = PixivBrowserFactory.getDownloadBrowser().open_novisit(req)
+        content_range = res.info()['Content-Range'] if res.code == 206 else None
+        if content_range is not None and \
+           content_range.startswith('bytes {0}-'.format(resume_from)) and \
+           PixivHelper.parseContentRangeTotal(content_range) == file_size:
+            PixivHelper.print_and_log('info', 'Resuming download from {0} of {1} Bytes.'.format(resume_from, file_size))
+        else:
+            # server send different content or ignore the range, start from beginning.
+            PixivHelper.print_and_log('info', 'Cannot resume partial download, restarting: {0}'.format(partial_filename))
+            PixivDownloadHandler.resumeStatistics.addRestarted()
+            resume_from = 0
+            if res.code == 206:
+                res.close()
+                res = None
+
+    if res is None:
+        req = PixivHelper.create_custom_request(url, __config__, referer)
+        res = PixivBrowserFactory.getDownloadBrowser().open_novisit(req)
+
     if file_size < 0:
         try:
             file_size = int(res.info()['Content-Length'])
         except KeyError:
             file_size = -1
             PixivHelper.print_and_log('info', "\tNo file size information!")
-    (downloadedSize, filename) = PixivHelper.downloadImage(url, filename, res, file_size, overwrite)
-    return (downloadedSize, filename)
+
+    if resume_from == 0 and res.info()['ETag'] is not None:
+        __partialEtag[url] = res.info()['ETag']
+
+    # the content hash is computed while writing, see dedupeMode
+    hasher = hashlib.new(PixivConstant.CONTENT_HASH)
+    try:
+        (downloadedSize, filename) = PixivHelper.downloadImage(url, filename, res, file_size, overwrite,
+                                                               resume_from=resume_from,
+                                                               keep_partial=__config__.resumeDownload,
+                                                               writerThread=__config__.downloadWriterThread,
+                                                               hasher=hasher)
+    except PixivException as ex:
+        if ex.errorCode != PixivException.DOWNLOAD_PARTIAL_MISSING:
+            raise
+        # cannot write to the partial file, download again from beginning to the server filename.
+        PixivHelper.print_and_log('info', 'Cannot resume partial download, restarting: {0}'.format(ex.value))
+        PixivDownloadHandler.resumeStatistics.addRestarted()
+        resume_from = 0
+        res.close()
+        req = PixivHelper.create_custom_request(url, __config__, referer)
+        res = PixivBrowserFactory.getDownloadBrowser().open_novisit(req)
+        if res.info()['ETag'] is not None:
+            __partialEtag[url] = res.info()['ETag']
+        hasher = hashlib.new(PixivConstant.CONTENT_HASH)
+        (downloadedSize, filename) = PixivHelper.downloadImage(url, filename, res, file_size, overwrite,
+                                                               keep_partial=__config__.resumeDownload,
+                                                               writerThread=__config__.downloadWriterThread,
+                                                               hasher=hasher)
+    if resume_from > 0:
+        PixivDownloadHandler.resumeStatistics.addResumed(resume_from)
+    if file_size > 0 and downloadedSize == file_size:
+        __partialEtag.pop(url, None)
+    return (downloadedSize, filename, hasher.hexdigest())
+
+
+def can_dedupe(filename):
+    '''The ugoira zip is not skipped, the .js and converted files are created from its filename.'''
+    if __config__.dedupeMode == 'skip':
+        return not filename.endswith('.zip')
+    return __config__.dedupeMode != 'none'
+
+
+def dedupe_url(url, filename):
+    '''Reuse the file already downloaded from the url instead of downloading it again.
+
+    Return the download result, None if the url is not downloaded before.'''
+    row = db_call(__dbManager__.findDuplicateFile, filename, url=url)
+    if row is None:
+        return None
+    if __config__.dedupeMode == 'skip':
+        PixivHelper.print_and_log('info', '\rSame url already downloaded: {0}'.format(row[0]))
+        return (PixivConstant.PIXIVUTIL_SKIP_DUPLICATE, row[0])
+
+    PixivHelper.makeSubdirs(filename)
+    if PixivHelper.linkFile(row[0], filename, __config__.dedupeMode):
+        PixivHelper.print_and_log('info', '\rSame url already downloaded, {0} from: {1}'.format(__config__.dedupeMode, row[0]))
+    else:
+        # still faster than downloading it again
+        shutil.copyfile(row[0], filename)
+        PixivHelper.print_and_log('info', '\rSame url already downloaded, cannot {0}, copied from: {1}'.format(__config__.dedupeMode, row[0]))
+    db_call(__dbManager__.updateFileHash, filename, row[1], row[2], url)
+    return (PixivConstant.PIXIVUTIL_OK, filename)
+
+
+def dedupe_downloaded_file(url, filename, file_size, content_hash):
+    '''Save the content hash of the downloaded file, and link it to the existing file with the same content.
+
+    Return the filename to be saved to the database, the existing file for dedupeMode = skip.'''
+    if can_dedupe(filename):
+        row = db_call(__dbManager__.findDuplicateFile, filename, content_hash=content_hash, file_size=file_size)
+        if row is not None:
+            if __config__.dedupeMode == 'skip':
+                PixivHelper.print_and_log('info', 'Same content already downloaded, using: {0}'.format(row[0]))
+                os.remove(filename)
+                return row[0]
+            if PixivHelper.linkFile(row[0], filename, __config__.dedupeMode):
+                PixivHelper.print_and_log('info', 'Same content already downloaded, {0} to: {1}'.format(__config__.dedupeMode, row[0]))
+    db_call(__dbManager__.updateFileHash, filename, file_size, content_hash, url)
+    return filename
+
+
+def get_downloaded_image_ids(image_ids, member_id=None, check_file_exists=True):
+    '''Return the set of image ids which can be skipped without calling process_image().
+
+    Empty if overwrite/alwaysCheckFileSize is enabled, or alwaysCheckFileExists when check_file_exists is True,
+    as process_image() need to check each image individually.'''
+    if __config__.overwrite or __config__.alwaysCheckFileSize:
+        return set()
+    if check_file_exists and __config__.alwaysCheckFileExists:
+        return set()
+    return __dbManager__.selectExistingImageIds(image_ids, member_id)
 
 
 #  Start of main processing logic
@@ -363,24 +558,30 @@ def process_list(list_file_name=None, tags=None):
                 result = __dbManager__.selectMembersByLastDownloadDate(__config__.dayLastUpdated)
         else:
             PixivHelper.print_and_log('info', 'Processing from list file: {0}'.format(list_file_name))
-            result = PixivListItem.parseList(list_file_name, __config__.rootDirectory)
+            # read the list file while processing instead of loading it first.
+            result = PixivListItem.iterList(list_file_name, __config__.rootDirectory)
 
+        ignore_ids = set()
         if os.path.exists("ignore_list.txt"):
             PixivHelper.print_and_log('info', 'Processing ignore list for member: {0}'.format("ignore_list.txt"))
-            ignore_list = PixivListItem.parseList("ignore_list.txt", __config__.rootDirectory)
-            for ignore in ignore_list:
-                for item in result:
-                    if item.memberId == ignore.memberId:
-                        result.remove(item)
-                        break
+            ignore_ids = set(ignore.memberId for ignore in PixivListItem.iterList("ignore_list.txt", __config__.rootDirectory))
 
-        print("Found " + str(len(result)) + " items.")
+        total = None
+        if isinstance(result, list):
+            result = [item for item in result if item.memberId not in ignore_ids]
+            total = len(result)
+            print("Found " + str(total) + " items.")
         current_member = 1
         for item in result:
+            if item.memberId in ignore_ids:
+                continue
             retry_count = 0
             while True:
                 try:
-                    prefix = "[{0} of {1}] ".format(current_member, len(result))
+                    if total is None:
+                        prefix = "[{0}] ".format(current_member)
+                    else:
+                        prefix = "[{0} of {1}] ".format(current_member, total)
                     process_member(item.memberId, item.path, tags=tags, title_prefix=prefix)
                     current_member = current_member + 1
                     break
@@ -422,8 +623,6 @@ def process_member(member_id, user_dir='', page=1, end_page=0, bookmark=False, t
     elif __config__.numberOfPage != 0:
         PixivHelper.print_and_log('info', 'End Page from config: ' + str(__config__.numberOfPage))
 
-    __config__.loadConfig(path=configfile)
-
     # calculate the offset for display properties
     offset = 24  # new offset for AJAX call
     if __br__._isWhitecube:
@@ -438,13 +637,25 @@ def process_member(member_id, user_dir='', page=1, end_page=0, bookmark=False, t
         updated_limit_count = 0
         image_id = -1
 
+        # the newest image id which all the older images are already processed.
+        # Only for profile/all, bookmark/tags/r18mode list other images.
+        profile_run = not bookmark and not tags and not __config__.r18mode
+        last_image_id = __dbManager__.selectIncrementalImageId(member_id) if profile_run else 0
+        incremental_image_id = 0
+        if __config__.incrementalMemberUpdate and not __config__.overwrite and last_image_id > 0:
+            PixivHelper.print_and_log('info', 'Incremental update, only process image id newer than: {0}'.format(last_image_id))
+            incremental_image_id = last_image_id
+        newest_image_id = 0
+        reached_end = False
+        has_error = False
+
         while flag:
             print('Page ', page)
             set_console_title("{0}MemberId: {1} Page: {2}".format(title_prefix, member_id, page))
             # Try to get the member page
             while True:
                 try:
-                    (artist, list_page) = PixivBrowserFactory.getBrowser().getMemberPage(member_id, page, bookmark, tags)
+                    (artist, list_page) = PixivBrowserFactory.getBrowser().getMemberPage(member_id, page, bookmark, tags, incremental_image_id)
                     break
                 except PixivException as ex:
                     ERROR_CODE = ex.errorCode
@@ -509,27 +720,37 @@ def process_member(member_id, user_dir='', page=1, end_page=0, bookmark=False, t
 
             if not artist.haveImages:
                 PixivHelper.print_and_log('info', "No image found for: " + str(member_id))
+                reached_end = True
                 flag = False
                 continue
 
+            # check all images of the page in one go instead of one query per image.
+            downloaded_ids = get_downloaded_image_ids(artist.imageList, member_id, check_file_exists=False)
+
+            async_browser = PixivAsyncBrowser.getAsyncBrowser(__config__)
+            if async_browser is not None and not DEBUG_SKIP_PROCESS_IMAGE:
+                prefetch_list = [image_id for image_id in artist.imageList if int(image_id) not in downloaded_ids]
+                PixivHelper.print_and_log('info', 'Prefetching {0} image page(s).'.format(len(prefetch_list)))
+                async_browser.prefetchImagePages(prefetch_list)
+
             result = PixivConstant.PIXIVUTIL_NOT_OK
             for image_id in artist.imageList:
                 print('#' + str(no_of_images))
-                if not __config__.overwrite:
-                    r = __dbManager__.selectImageByMemberIdAndImageId(member_id, image_id)
-                    if r is not None and not __config__.alwaysCheckFileSize:
-                        print('Already downloaded:', image_id)
-                        updated_limit_count = updated_limit_count + 1
-                        if updated_limit_count > __config__.checkUpdatedLimit:
-                            if __config__.checkUpdatedLimit != 0 and not __config__.alwaysCheckFileExists:
-                                print('Skipping member:', member_id)
-                                __dbManager__.updateLastDownloadedImage(member_id, image_id)
-
-                                del list_page
-                                __br__.clear_history()
-                                return
-                        gc.collect()
-                        continue
+                if int(image_id) in downloaded_ids:
+                    print('Already downloaded:', image_id)
+                    newest_image_id = max(newest_image_id, int(image_id))
+                    updated_limit_count = updated_limit_count + 1
+                    if updated_limit_count > __config__.checkUpdatedLimit:
+                        if __config__.checkUpdatedLimit != 0 and not __config__.alwaysCheckFileExists:
+                            print('Skipping member:', member_id)
+                            # the rest is not checked, so the incremental image id is not moved.
+                            __dbManager__.updateLastDownloadedImage(member_id, image_id)
+
+                            del list_page
+                            __br__.clear_history()
+                            return
+                    gc.collect()
+                    continue
 
                 retry_count = 0
                 while True:
@@ -570,6 +791,11 @@ def process_member(member_id, user_dir='', page=1, end_page=0, bookmark=False, t
 
                 no_of_images = no_of_images + 1
 
+                if result in (PixivConstant.PIXIVUTIL_NOT_OK, PixivConstant.PIXIVUTIL_KEYBOARD_INTERRUPT, PixivConstant.PIXIVUTIL_ABORTED):
+                    has_error = True
+                else:
+                    newest_image_id = max(newest_image_id, int(image_id))
+
                 if result == PixivConstant.PIXIVUTIL_KEYBOARD_INTERRUPT:
                     choice = input("Keyboard Interrupt detected, continue to next image (Y/N)")
                     if choice.upper() == 'N':
@@ -585,8 +811,9 @@ def process_member(member_id, user_dir='', page=1, end_page=0, bookmark=False, t
                     flag = False
                     break
 
-            if artist.isLastPage:
+            if artist.isLastPage and flag:
                 print("Last Page")
+                reached_end = True
                 flag = False
 
             page = page + 1
@@ -609,7 +836,10 @@ def process_member(member_id, user_dir='', page=1, end_page=0, bookmark=False, t
             __br__.clear_history()
             gc.collect()
 
-        if image_id > 0:
+        # only move the incremental image id if all the images are processed.
+        if profile_run and reached_end and not has_error and newest_image_id > last_image_id:
+            __dbManager__.updateIncrementalImageId(member_id, newest_image_id)
+        if int(image_id) > 0:
             __dbManager__.updateLastDownloadedImage(member_id, image_id)
             log_message = 'last image_id: ' + str(image_id)
         else:
@@ -750,8 +980,8 @@ def process_image(artist=None, image_id=None, user_dir='', bookmark=False, searc
                     if item in image.imageTags:
                         image.imageTags.remove(item)
 
-            # get manga page
-            if image.imageMode == 'manga' or image.imageMode == 'big':
+            # get manga page, the new layout already have the image urls from the ajax data.
+            if (image.imageMode == 'manga' or image.imageMode == 'big') and len(image.imageUrls) == 0:
                 while True:
                     try:
                         big_url = 'https://www.pixiv.net/member_illust.php?mode={0}&illust_id={1}'.format(image.imageMode, image_id)
@@ -784,31 +1014,41 @@ def process_image(artist=None, image_id=None, user_dir='', bookmark=False, searc
             result = PixivConstant.PIXIVUTIL_OK
             manga_files = dict()
             page = 0
-            for img in image.imageUrls:
-                print('Image URL :', img)
-                url = os.path.basename(img)
-                split_url = url.split('.')
-                if split_url[0].startswith(str(image_id)):
-                    # Yavos: filename will be added here if given in list
-                    filename_format = __config__.filenameFormat
-                    if image.imageMode == 'manga':
-                        filename_format = __config__.filenameMangaFormat
-
-                    filename = PixivHelper.makeFilename(filename_format, image, tagsSeparator=__config__.tagsSeparator, tagsLimit=__config__.tagsLimit, fileUrl=url, bookmark=bookmark, searchTags=search_tags)
-                    filename = PixivHelper.sanitizeFilename(filename, target_dir)
-
-                    if image.imageMode == 'manga' and __config__.createMangaDir:
-                        manga_page = __re_manga_page.findall(filename)
-                        if len(manga_page) > 0:
-                            splitted_filename = filename.split(manga_page[0][0], 1)
-                            splitted_manga_page = manga_page[0][0].split("_p", 1)
-                            filename = splitted_filename[0] + splitted_manga_page[0] + os.sep + "_p" + splitted_manga_page[1] + splitted_filename[1]
-
-                    PixivHelper.print_and_log('info', 'Filename  : {0}'.format(filename))
+            download_pool = PixivDownloadHandler.getDownloadPool(__config__)
+            download_jobs = list()
+            try:
+                for img in image.imageUrls:
+                    print('Image URL :', img)
+                    url = os.path.basename(img)
+                    split_url = url.split('.')
+                    if split_url[0].startswith(str(image_id)):
+                        # Yavos: filename will be added here if given in list
+                        filename_format = __config__.filenameFormat
+                        if image.imageMode == 'manga':
+                            filename_format = __config__.filenameMangaFormat
+
+                        filename = PixivHelper.makeFilename(filename_format, image, tagsSeparator=__config__.tagsSeparator, tagsLimit=__config__.tagsLimit, fileUrl=url, bookmark=bookmark, searchTags=search_tags)
+                        filename = PixivHelper.sanitizeFilename(filename, target_dir)
+
+                        if image.imageMode == 'manga' and __config__.createMangaDir:
+                            manga_page = __re_manga_page.findall(filename)
+                            if len(manga_page) > 0:
+                                splitted_filename = filename.split(manga_page[0][0], 1)
+                                splitted_manga_page = manga_page[0][0].split("_p", 1)
+                                filename = splitted_filename[0] + splitted_manga_page[0] + os.sep + "_p" + splitted_manga_page[1] + splitted_filename[1]
+
+                        PixivHelper.print_and_log('info', 'Filename  : {0}'.format(filename))
+
+                        # with downloadWorkers = 1 the job is run immediately in this thread.
+                        job = download_pool.submit(download_image, img, filename, referer, __config__.overwrite, __config__.retry, __config__.backupOldFile, image, page)
+                        download_jobs.append((img, page, job))
+                        page = page + 1
 
+                # collect the result in page order, so the DB rows are the same as serial download.
+                for (img, page, job) in download_jobs:
                     result = PixivConstant.PIXIVUTIL_NOT_OK
                     try:
-                        (result, filename) = download_image(img, filename, referer, __config__.overwrite, __config__.retry, __config__.backupOldFile, image, page)
+                        (result, filename) = job.result()
 
                         if result == PixivConstant.PIXIVUTIL_NOT_OK:
                             PixivHelper.print_and_log('error', 'Image url not found/failed to download: ' + str(image.imageId))
@@ -816,11 +1056,14 @@ def process_image(artist=None, image_id=None, user_dir='', bookmark=False, searc
                             raise KeyboardInterrupt()
 
                         manga_files[page] = filename
-                        page = page + 1
 
                     except urllib.error.URLError:
                         PixivHelper.print_and_log('error', 'Error when download_image(), giving up url: {0}'.format(img))
                     print('')
+            except BaseException:
+                # do not leave the submitted pages downloading in the background
+                download_pool.cancel([job for (_, _, job) in download_jobs])
+                raise
 
             if __config__.writeImageInfo or __config__.writeImageJSON:
                 filename_info_format = __config__.filenameInfoFormat or __config__.filenameFormat
@@ -850,16 +1093,18 @@ def process_image(artist=None, image_id=None, user_dir='', bookmark=False, searc
 
         # Only save to db if all images is downloaded completely
         if result == PixivConstant.PIXIVUTIL_OK or result == PixivConstant.PIXIVUTIL_SKIP_DUPLICATE or result == PixivConstant.PIXIVUTIL_SKIP_LOCAL_LARGER:
-            try:
-                __dbManager__.insertImage(image.artist.artistId, image.imageId, image.imageMode)
-            except BaseException:
-                PixivHelper.print_and_log('error', 'Failed to insert image id:{0} to DB'.format(image.imageId))
+            # single commit for the image and all the manga pages
+            with __dbManager__.transaction():
+                try:
+                    __dbManager__.insertImage(image.artist.artistId, image.imageId, image.imageMode)
+                except BaseException:
+                    PixivHelper.print_and_log('error', 'Failed to insert image id:{0} to DB'.format(image.imageId))
 
-            __dbManager__.updateImage(image.imageId, image.imageTitle, filename, image.imageMode)
+                __dbManager__.updateImage(image.imageId, image.imageTitle, filename, image.imageMode)
 
-            if len(manga_files) > 0:
-                for page in manga_files:
-                    __dbManager__.insertMangaImage(image_id, page, manga_files[page])
+                if len(manga_files) > 0:
+                    for page in manga_files:
+                        __dbManager__.insertMangaImage(image_id, page, manga_files[page])
 
             # map back to PIXIVUTIL_OK (because of ugoira file check)
             result = 0
@@ -888,52 +1133,20 @@ def process_image(artist=None, image_id=None, user_dir='', bookmark=False, searc
 
 
 def handle_ugoira(image, filename):
-    if filename.endswith(".zip"):
-        ugo_name = filename[:-4] + ".ugoira"
-    else:
-        ugo_name = filename
-    if not os.path.exists(ugo_name):
-        PixivHelper.print_and_log('info', "Creating ugoira archive => " + ugo_name)
-        image.CreateUgoira(filename)
-        # set last-modified and last-accessed timestamp
-        if __config__.setLastModified and ugo_name is not None and os.path.isfile(ugo_name):
-            ts = time.mktime(image.worksDateDateTime.timetuple())
-            os.utime(ugo_name, (ts, ts))
-
-    if __config__.deleteZipFile and os.path.exists(filename):
-        PixivHelper.print_and_log('info', "Deleting zip file => " + filename)
-        os.remove(filename)
-
-    if __config__.createGif:
-        gif_filename = ugo_name[:-7] + ".gif"
-        if not os.path.exists(gif_filename):
-            PixivHelper.ugoira2gif(ugo_name, gif_filename, __config__.deleteUgoira, image=image)
-    if __config__.createApng:
-        gif_filename = ugo_name[:-7] + ".png"
-        if not os.path.exists(gif_filename):
-            PixivHelper.ugoira2apng(ugo_name, gif_filename, __config__.deleteUgoira, image=image)
-    if __config__.createWebm:
-        gif_filename = ugo_name[:-7] + ".webm"
-        if not os.path.exists(gif_filename):
-            PixivHelper.ugoira2webm(ugo_name,
-                                gif_filename,
-                                __config__.deleteUgoira,
-                                __config__.ffmpeg,
-                                __config__.ffmpegCodec,
-                                __config__.ffmpegParam,
-                                "webm",
-                                image)
-    if __config__.createWebp:
-        gif_filename = ugo_name[:-7] + ".webp"
-        if not os.path.exists(gif_filename):
-            PixivHelper.ugoira2webm(ugo_name,
-                                gif_filename,
-                                __config__.deleteUgoira,
-                                __config__.ffmpeg,
-                                __config__.webpCodec,
-                                __config__.webpParam,
-                                "webp",
-                                image)
+    '''Queue the ugoira conversion, return PIXIVUTIL_NOT_OK if the .ugoira cannot be created.'''
+    ugo_name = filename[:-4] + ".ugoira" if filename.endswith(".zip") else filename
+    # the existing .ugoira already has the animation.json
+    if len(image.ugoira_data) == 0 and not os.path.exists(ugo_name):
+        PixivHelper.print_and_log('error', "Missing ugoira animation info for image: " + str(image.imageId))
+        return PixivConstant.PIXIVUTIL_NOT_OK
+
+    timestamp = None
+    if __config__.setLastModified:
+        timestamp = time.mktime(image.worksDateDateTime.timetuple())
+    # the conversion is queued to the process pool, continue downloading while it is encoding.
+    conversion_pool = PixivDownloadHandler.getConversionPool(__config__)
+    conversion_pool.submit(PixivHelper.convertUgoira, filename, image.ugoira_data, __config__, timestamp)
+    return PixivConstant.PIXIVUTIL_OK
 
 
 def process_tags(tags, page=1, end_page=0, wild_card=True, title_caption=False,
@@ -945,13 +1158,13 @@ def process_tags(tags, page=1, end_page=0, wild_card=True, title_caption=False,
     updated_limit_count = 0
 
     try:
-        __config__.loadConfig(path=configfile)  # Reset the config for root directory
-
         search_tags = PixivHelper.decode_tags(tags)
 
+        # use the user_dir of process_image() instead of changing the rootDirectory in the shared config.
+        tags_dir = ''
         if use_tags_as_dir:
             print("Save to each directory using query tags.")
-            __config__.rootDirectory += os.sep + PixivHelper.sanitizeFilename(search_tags)
+            tags_dir = __config__.rootDirectory + os.sep + PixivHelper.sanitizeFilename(search_tags)
 
         tags = PixivHelper.encode_tags(tags)
 
@@ -980,6 +1193,7 @@ def process_tags(tags, page=1, end_page=0, wild_card=True, title_caption=False,
                 print('No more images')
                 flag = False
             else:
+                downloaded_ids = get_downloaded_image_ids([item.imageId for item in t.itemList])
                 for item in t.itemList:
                     last_image_id = item.imageId
                     print('Image #' + str(images))
@@ -1009,8 +1223,11 @@ def process_tags(tags, page=1, end_page=0, wild_card=True, title_caption=False,
                                                                                                               skipped_count,
                                                                                                               total_image)
                             result = PixivConstant.PIXIVUTIL_OK
-                            if not DEBUG_SKIP_PROCESS_IMAGE:
-                                result = process_image(None, item.imageId, search_tags=search_tags, title_prefix=title_prefix, bookmark_count=item.bookmarkCount, image_response_count=item.imageResponse)
+                            if int(item.imageId) in downloaded_ids:
+                                print('Already downloaded:', item.imageId)
+                                result = PixivConstant.PIXIVUTIL_SKIP_DUPLICATE
+                            elif not DEBUG_SKIP_PROCESS_IMAGE:
+                                result = process_image(None, item.imageId, user_dir=tags_dir, search_tags=search_tags, title_prefix=title_prefix, bookmark_count=item.bookmarkCount, image_response_count=item.imageResponse)
                                 wait()
                             break
                         except KeyboardInterrupt:
@@ -1110,25 +1327,32 @@ def process_image_bookmark(hide='n', start_page=1, end_page=0, tag='', sorting=N
     global np
     try:
         print("Importing image bookmarks...")
-        totalList = list()
         image_count = 1
+        found_count = 0
+        skipped_count = 0
 
-        if hide == 'n':
-            totalList.extend(get_image_bookmark(False, start_page, end_page, tag, sorting))
-        elif hide == 'y':
-            # public and private image bookmarks
-            totalList.extend(get_image_bookmark(False, start_page, end_page, tag, sorting))
-            totalList.extend(get_image_bookmark(True, start_page, end_page, tag, sorting))
-        else:
-            totalList.extend(get_image_bookmark(True, start_page, end_page, tag, sorting))
-
-        PixivHelper.print_and_log('info', "Found " + str(len(totalList)) + " image(s).")
-        for item in totalList:
-            print("Image #" + str(image_count))
-            process_image(artist=None, image_id=item)
-            image_count = image_count + 1
-            wait()
+        pages = list()
+        if hide in ('n', 'y'):
+            pages.append(get_image_bookmark(False, start_page, end_page, tag, sorting))
+        if hide != 'n':
+            # public and private image bookmarks for 'y'
+            pages.append(get_image_bookmark(True, start_page, end_page, tag, sorting))
+
+        # download each page while the next bookmark pages are not fetched yet.
+        for page_list in itertools.chain(*pages):
+            found_count = found_count + len(page_list)
+            downloaded_ids = get_downloaded_image_ids(page_list)
+            if len(downloaded_ids) > 0:
+                page_list = [item for item in page_list if int(item) not in downloaded_ids]
+                skipped_count = skipped_count + len(downloaded_ids)
+                PixivHelper.print_and_log('info', "Skipping " + str(len(downloaded_ids)) + " already downloaded image(s).")
+            for item in page_list:
+                print("Image #" + str(image_count))
+                process_image(artist=None, image_id=item)
+                image_count = image_count + 1
+                wait()
 
+        PixivHelper.print_and_log('info', "Found {0} image(s), {1} already downloaded.".format(found_count, skipped_count))
         print("Done.\n")
     except KeyboardInterrupt:
         raise
@@ -1138,8 +1362,7 @@ def process_image_bookmark(hide='n', start_page=1, end_page=0, tag='', sorting=N
 
 
 def get_image_bookmark(hide, start_page=1, end_page=0, tag='', sorting=None):
-    """Get user's image bookmark"""
-    total_list = list()
+    """Get user's image bookmark, yield the image ids for each page"""
     i = start_page
     while True:
         if end_page != 0 and i > end_page:
@@ -1158,26 +1381,23 @@ def get_image_bookmark(hide, start_page=1, end_page=0, tag='', sorting=None):
         PixivHelper.print_and_log('info', "Source URL: " + url)
 
         page = __br__.open(url)
-        parse_page = BeautifulSoup(page.read())
+        parse_page = PixivHtmlParser.parseHtml(page.read(), __config__.htmlParser)
         l = PixivBookmark.parseImageBookmark(parse_page)
-        total_list.extend(l)
+        parse_page.decompose()
+        del parse_page
+
         if len(l) == 0:
             print("No more images.")
             break
         else:
             print(" found " + str(len(l)) + " images.")
 
+        yield l
         i = i + 1
 
-        parse_page.decompose()
-        del parse_page
-
-    return total_list
-
 
 def get_bookmarks(hide, start_page=1, end_page=0, member_id=None):
-    """Get User's bookmarked artists """
-    total_list = list()
+    """Get User's bookmarked artists, yield the members for each page"""
     i = start_page
     while True:
         if end_page != 0 and i > end_page:
@@ -1192,36 +1412,29 @@ def get_bookmarks(hide, start_page=1, end_page=0, member_id=None):
         PixivHelper.print_and_log('info', "Source URL: " + url)
 
         page = __br__.open_with_retry(url)
-        parse_page = BeautifulSoup(page.read())
+        parse_page = BeautifulSoup(page.read(), features=PixivHtmlParser.getFeatures(__config__.htmlParser))
         l = PixivBookmark.parseBookmark(parse_page)
+        parse_page.decompose()
+        del parse_page
+
         if len(l) == 0:
             print('No more data')
             break
-        total_list.extend(l)
-        i = i + 1
         print(str(len(l)), 'items')
-    return total_list
+        yield l
+        i = i + 1
 
 
 def process_bookmark(hide='n', start_page=1, end_page=0):
     try:
-        total_list = list()
+        current_member = 1
         if hide != 'o':
             print("Importing Bookmarks...")
-            total_list.extend(get_bookmarks(False, start_page, end_page))
+            current_member = process_bookmark_pages(get_bookmarks(False, start_page, end_page), current_member)
         if hide != 'n':
             print("Importing Private Bookmarks...")
-            total_list.extend(get_bookmarks(True, start_page, end_page))
-        print("Result: ", str(len(total_list)), "items.")
-        i = 0
-        current_member = 1
-        for item in total_list:
-            print("%d/%d\t%f %%" % (i, len(total_list), 100.0 * i / float(len(total_list))))
-            i += 1
-            prefix = "[{0} of {1}]".format(current_member, len(total_list))
-            process_member(item.memberId, item.path, title_prefix=prefix)
-            current_member = current_member + 1
-        print("%d/%d\t%f %%" % (i, len(total_list), 100.0 * i / float(len(total_list))))
+            current_member = process_bookmark_pages(get_bookmarks(True, start_page, end_page), current_member)
+        print("Result: ", str(current_member - 1), "items.")
     except KeyboardInterrupt:
         raise
     except BaseException:
@@ -1229,17 +1442,27 @@ def process_bookmark(hide='n', start_page=1, end_page=0):
         raise
 
 
+def process_bookmark_pages(pages, current_member=1):
+    '''process the members from each bookmark page as soon as the page is parsed'''
+    for page_list in pages:
+        for item in page_list:
+            prefix = "[{0}]".format(current_member)
+            process_member(item.memberId, item.path, title_prefix=prefix)
+            current_member = current_member + 1
+    return current_member
+
+
 def export_bookmark(filename, hide='n', start_page=1, end_page=0, member_id=None):
     try:
-        total_list = list()
+        pages = list()
         if hide != 'o':
-            print("Importing Bookmarks...")
-            total_list.extend(get_bookmarks(False, start_page, end_page, member_id))
+            pages.append(get_bookmarks(False, start_page, end_page, member_id))
         if hide != 'n':
-            print("Importing Private Bookmarks...")
-            total_list.extend(get_bookmarks(True, start_page, end_page, member_id))
-        print("Result: ", str(len(total_list)), "items.")
-        PixivBookmark.exportList(total_list, filename)
+            pages.append(get_bookmarks(True, start_page, end_page, member_id))
+        # write the file while walking the pages
+        print("Importing Bookmarks...")
+        count = PixivBookmark.exportList(itertools.chain.from_iterable(itertools.chain(*pages)), filename)
+        print("Result: ", str(count), "items.")
     except KeyboardInterrupt:
         raise
     except BaseException:
@@ -1261,13 +1484,17 @@ def process_new_illust_from_bookmark(page_num=1, end_page_num=0):
 
             PixivHelper.print_and_log('info', "Source URL: " + url)
             page = __br__.open(url)
-            parsed_page = BeautifulSoup(page.read())
+            parsed_page = PixivHtmlParser.parseHtml(page.read(), __config__.htmlParser)
             pb = PixivNewIllustBookmark(parsed_page)
             if not pb.haveImages:
                 print("No images!")
                 break
 
+            downloaded_ids = get_downloaded_image_ids(pb.imageList)
             for image_id in pb.imageList:
+                if int(image_id) in downloaded_ids:
+                    print('Already downloaded:', image_id)
+                    continue
                 print("Image #" + str(image_count))
                 result = process_image(artist=None, image_id=int(image_id))
                 image_count = image_count + 1
@@ -2014,8 +2241,11 @@ def menu_fanbox_download_by_artist_id(op_is_valid, args):
 
 
 def menu_reload_config():
+    # the config is only read at start up and from here, not for each member/tags.
     __log__.info('Manual Reload Config.')
     __config__.loadConfig(path=configfile)
+    PixivHelper.setConfig(__config__)
+    print('Configuration reloaded from: {0}'.format(configfile))
 
 
 def menu_print_config():
@@ -2381,6 +2611,11 @@ def main():
         __log__.exception('Unknown Error: %s', str(exc_value))
         ERROR_CODE = getattr(ex, 'errorCode', -1)
     finally:
+        PixivDownloadHandler.shutdownDownloadPool()
+        PixivDownloadHandler.shutdownConversionPool()
+        PixivCache.closeCache()
+        if PixivDownloadHandler.resumeStatistics.resumed > 0 or PixivDownloadHandler.resumeStatistics.restarted > 0:
+            PixivHelper.print_and_log('info', str(PixivDownloadHandler.resumeStatistics))
         __dbManager__.close()
         if not ewd:  # Yavos: prevent input on exitwhendone
             if selection is None or selection != 'x':
@@ -2392,4 +2627,6 @@ def main():
 
 
 if __name__ == '__main__':
+    # the ugoira conversion pool start new processes
+    multiprocessing.freeze_support()
     main()
@@ -18,11 +18,12 @@ __version__ = "0.1.0"
 
 try:
     import PIL.Image
+    import PIL.ImageChops
 except ImportError:
     # Without Pillow, apng can only handle PNG images
     pass
 
-PNG_SIGN = "\x89\x50\x4E\x47\x0D\x0A\x1A\x0A"
+PNG_SIGN = b"\x89\x50\x4E\x47\x0D\x0A\x1A\x0A"
 
 
 def is_png(png):
@@ -63,7 +64,7 @@ def chunks(png):
     """
     if not is_png(png):
         # convert to png
-        if isinstance(png, str):
+        if isinstance(png, bytes):
             with io.BytesIO(png) as f:
                 with io.BytesIO() as f2:
                     PIL.Image.open(f).save(f2, "PNG", optimize=True)
@@ -95,7 +96,7 @@ def make_chunk(type, data):
     out = struct.pack("!I", len(data))
     data = type.encode("latin-1") + data
     crc32 = binascii.crc32(data)
-    out += data + struct.pack("!i", crc32)
+    out += data + struct.pack("!I", crc32 & 0xffffffff)
     return out
 
 
@@ -144,7 +145,7 @@ class PNG(object):
         """Get bytes"""
         chunks = [PNG_SIGN]
         chunks.extend(c[1] for c in self.chunks)
-        return "".join(chunks)
+        return b"".join(chunks)
 
     def save(self, file):
         """Save to file. @file can be a str of filename or a file-like object.
@@ -182,6 +183,157 @@ class FrameControl(object):
         return cls(*struct.unpack("!IIIIHHbb", b))
 
 
+def _open_image(png):
+    """Open @png with Pillow. See chunks() for the type of @png."""
+    if isinstance(png, bytes):
+        return PIL.Image.open(io.BytesIO(png))
+    return PIL.Image.open(png)
+
+
+def _changed_box(prev, image):
+    """Return the bounding box of the pixels different from @prev, None if they are the same."""
+    diff = PIL.ImageChops.difference(prev, image)
+    # check every band, getbbox() of RGBA image only use the alpha band.
+    boxes = [b for b in (band.getbbox() for band in diff.split()) if b is not None]
+    if not boxes:
+        return None
+    return (min(b[0] for b in boxes), min(b[1] for b in boxes),
+            max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+
+class APNGWriter(object):
+    """Write APNG to a file frame by frame.
+
+    Unlike APNG, only the current frame (and the previous one when optimizing)
+    is kept in memory, the chunks are written as soon as the frame is appended:
+      with APNGWriter(out_file_name, num_frames=len(files)) as writer:
+          for file in files:
+              writer.append(file, delay=100)
+
+    @file       a str of filename or a file-like object.
+    @num_frames written to acTL. If None or different from the appended frames,
+                acTL is rewritten on close(), so @file must be seekable.
+    @num_plays  0 for infinite loop.
+    @optimize   crop each frame to the region changed from the previous frame,
+                need Pillow.
+    """
+
+    def __init__(self, file, num_frames=None, num_plays=0, optimize=False):
+        if isinstance(file, str):
+            self.file = open(file, "wb")
+            self._close_file = True
+        else:
+            self.file = file
+            self._close_file = False
+        self.num_frames = num_frames
+        self.num_plays = num_plays
+        self.optimize = optimize
+        self.frame_count = 0
+        self._seq = 0
+        self._actl_pos = None
+        self._mode = None
+        self._prev = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is None:
+            self.close()
+        elif self._close_file:
+            self.file.close()
+
+    def append(self, png, **options):
+        """Append one frame.
+
+        @png      See PNG.open.
+        @options  See FrameControl. With optimize, the size, offset, depose_op
+                  and blend_op are calculated.
+        """
+        if not self.optimize:
+            png = PNG.open(png)
+            control = FrameControl(**options)
+            if control.width is None:
+                control.width = png.width
+            if control.height is None:
+                control.height = png.height
+            self.write_frame(png, control)
+            return
+
+        image = _open_image(png)
+        # all frames must have the same color type as the IHDR
+        if self._mode is None:
+            self._mode = image.mode if image.mode in ("RGB", "RGBA", "L", "LA") else "RGBA"
+        if image.mode != self._mode:
+            image = image.convert(self._mode)
+        image.load()
+
+        box = (0, 0) + image.size
+        if self._prev is not None and self._prev.size == image.size:
+            # a frame cannot be empty, keep one pixel for the same image
+            box = _changed_box(self._prev, image) or (0, 0, 1, 1)
+        self._prev = image
+        if box != (0, 0) + image.size:
+            image = image.crop(box)
+
+        with io.BytesIO() as f:
+            image.save(f, "PNG")
+            png = PNG.open(f.getvalue())
+
+        # keep the previous frame and draw the changed region over it
+        options.update(width=png.width, height=png.height, x_offset=box[0], y_offset=box[1], depose_op=0, blend_op=0)
+        self.write_frame(png, FrameControl(**options))
+
+    def write_frame(self, png, control=None):
+        """Write PNG instance @png as the next frame with FrameControl @control."""
+        if control is None:
+            control = FrameControl(width=png.width, height=png.height)
+
+        if self.frame_count == 0:
+            self.file.write(PNG_SIGN)
+            self.file.write(png.hdr)
+            if getattr(self.file, "seekable", lambda: False)():
+                self._actl_pos = self.file.tell()
+            self.file.write(self._actl(self.num_frames or 0))
+
+        self.file.write(make_chunk("fcTL", struct.pack("!I", self._seq) + control.to_bytes()))
+        self._seq += 1
+
+        for type, data in png.chunks:
+            if type in ("IHDR", "IEND"):
+                continue
+            if self.frame_count == 0:
+                # the first frame is the default image
+                self.file.write(data)
+            elif type == "IDAT":
+                # convert IDAT to fdAT
+                self.file.write(make_chunk("fdAT", struct.pack("!I", self._seq) + data[8:-4]))
+                self._seq += 1
+        self.frame_count += 1
+
+    def _actl(self, num_frames):
+        return make_chunk("acTL", struct.pack("!II", num_frames, self.num_plays))
+
+    def close(self):
+        """Write IEND and fix the frame count in acTL."""
+        try:
+            if self.frame_count == 0:
+                raise ValueError("APNG need at least one frame")
+            self.file.write(make_chunk("IEND", b""))
+
+            if self.num_frames != self.frame_count:
+                if self._actl_pos is None:
+                    raise ValueError("cannot fix acTL frame count {0} => {1}, file is not seekable".format(self.num_frames, self.frame_count))
+                end = self.file.tell()
+                self.file.seek(self._actl_pos)
+                self.file.write(self._actl(self.frame_count))
+                self.file.seek(end)
+                self.num_frames = self.frame_count
+        finally:
+            if self._close_file:
+                self.file.close()
+
+
 class APNG(object):
     """Construct APNG image"""
 
@@ -204,63 +356,9 @@ class APNG(object):
 
     def to_bytes(self):
         """Return binary."""
-
-        # grab the chunks we needs
-        out = [PNG_SIGN]
-        seq = 0
-
-        # for first frame
-        png, control = self.frames[0]
-
-        # header
-        out.append(png.hdr)
-
-        # acTL
-        out.append(make_chunk("acTL", struct.pack("!II", len(self.frames), 0)))
-
-        # tRNS.
-        # FIXME: HoneyView need this chunk to render animation, but why?
-        # HoneyView 5.16 #4750, 2016/02/05
-        out.append(make_chunk("tRNS", str(6)))
-
-        # fcTL
-        if control:
-            out.append(make_chunk("fcTL", struct.pack("!I", seq) + control.to_bytes()))
-            seq += 1
-
-        # and others...
-        for type, data in png.chunks:
-            if type in ("IHDR", "IEND"):
-                continue
-            out.append(data)
-
-        # FIXME: we should do some optimization to frames...
-        # for other frames
-        for png, control in self.frames[1:]:
-            # fcTL
-            out.append(
-                make_chunk("fcTL", struct.pack("!I", seq) + control.to_bytes())
-            )
-            seq += 1
-
-            # and others...
-            for type, data in png.chunks:
-                if type in ("IHDR", "IEND"):
-                    continue
-
-                # convert IDAT to fdAT
-                if type == "IDAT":
-                    out.append(
-                        make_chunk("fdAT", struct.pack("!I", seq) + data[8:-4])
-                    )
-                    seq += 1
-                else:
-                    out.append(data)
-
-        # end
-        out.append(png.end)
-
-        return "".join(out)
+        with io.BytesIO() as f:
+            self.save(f)
+            return f.getvalue()
 
     @classmethod
     def from_files(cls, files, **options):
@@ -287,7 +385,7 @@ class APNG(object):
         @file can be a str of filename, a file-like object, or a bytes object.
         """
         hdr = None
-        end = ("IEND", make_chunk("IEND", ""))
+        end = ("IEND", make_chunk("IEND", b""))
 
         frame_chunks = []
         frames = []
@@ -328,9 +426,9 @@ class APNG(object):
 
     def save(self, file):
         """Save to file. @file can be a str of filename or a file-like object.
+
+        The chunks are written frame by frame, see APNGWriter.
         """
-        if isinstance(file, str) or isinstance(file, str):
-            with open(file, "wb") as f:
-                f.write(self.to_bytes())
-        else:
-            file.write(self.to_bytes())
+        with APNGWriter(file, num_frames=len(self.frames)) as writer:
+            for png, control in self.frames:
+                writer.write_frame(png, control)
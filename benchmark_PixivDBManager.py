@@ -0,0 +1,79 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Query latency before/after the schema indexes (DB_MIGRATIONS version 3) on a synthetic database.
+# usage: python benchmark_PixivDBManager.py [number of images] [db file]
+import os
+import random
+import sys
+import time
+
+import PixivConfig
+from PixivDBManager import PixivDBManager
+
+ROOT = 'D:\\Pixiv\\'
+
+
+def populate(db, total_images, images_per_member=200):
+    members = total_images // images_per_member
+    print('Creating {0} members and {1} images...'.format(members, total_images))
+    c = db.conn.cursor()
+    c.executemany('''INSERT INTO pixiv_master_member VALUES(?, ?, ?, datetime('now'), datetime('now', ?), ?, 0)''',
+                  ((i, 'member {0}'.format(i), ROOT + str(i), '-{0} days'.format(i % 30), i * images_per_member) for i in range(members)))
+    c.executemany('''INSERT INTO pixiv_master_image VALUES(?, ?, ?, ?, datetime('now'), datetime('now'), '')''',
+                  ((i, i // images_per_member, 'title', '{0}{1}\\{2}_p0.jpg'.format(ROOT, i // images_per_member, i))
+                   for i in range(total_images)))
+    db.conn.commit()
+    c.close()
+    return members
+
+
+def timeit(label, func, repeat=20):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = (time.perf_counter() - start) / repeat
+    print('  {0:45} {1:10.3f} ms'.format(label, elapsed * 1000))
+
+
+def run_queries(db, members):
+    member_ids = [random.randrange(members) for _ in range(20)]
+    timeit('selectImageByMemberId', lambda: [db.selectImageByMemberId(m) for m in member_ids])
+    timeit('selectImageByMemberIdAndImageId', lambda: [db.selectImageByMemberIdAndImageId(m, m * 200 + 1) for m in member_ids])
+    timeit('selectMembersByLastDownloadDate', lambda: db.selectMembersByLastDownloadDate(7), repeat=5)
+    # same WHERE clause as replaceRootPath(), without the update
+    timeit('save_name LIKE (replaceRootPath)',
+           lambda: db.conn.execute('''SELECT COUNT(*) FROM pixiv_master_image WHERE save_name like ?''',
+                                   (ROOT + str(members // 2) + '\\%',)).fetchone(), repeat=5)
+
+
+def main():
+    total_images = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+    target = sys.argv[2] if len(sys.argv) > 2 else 'benchmark.db.sqlite'
+    if os.path.exists(target):
+        os.remove(target)
+
+    config = PixivConfig.PixivConfig()
+    db = PixivDBManager(target=target, config=config)
+    db.createDatabase()
+    # back to the schema before the indexes
+    for name in ('pixiv_master_image_member_id', 'pixiv_master_image_save_name',
+                 'pixiv_manga_image_save_name', 'pixiv_master_member_last_update_date'):
+        db.conn.execute('''DROP INDEX IF EXISTS {0}'''.format(name))
+    db.conn.execute('''PRAGMA user_version = 2''')
+    members = populate(db, total_images)
+
+    print('Before (schema version {0}):'.format(db.getSchemaVersion()))
+    run_queries(db, members)
+
+    start = time.perf_counter()
+    db.upgradeDatabase()
+    print('Migration took {0:.1f} s'.format(time.perf_counter() - start))
+
+    print('After (schema version {0}):'.format(db.getSchemaVersion()))
+    run_queries(db, members)
+    db.close()
+    os.remove(target)
+
+
+if __name__ == '__main__':
+    main()
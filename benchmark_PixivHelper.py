@@ -0,0 +1,169 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Microbenchmark for PixivHelper.parseJson() against demjson on the AJAX fixtures in test/,
+# makeFilename() + sanitizeFilename() over synthetic images,
+# and the peak memory of ugoira2gif() on a synthetic ugoira (each case in a new process).
+# imageio is not in requirements.txt, the imageio.mimsave case is skipped when it is not installed.
+# usage: python benchmark_PixivHelper.py [repeat] [number of images] [ugoira frames] [ugoira width]
+import datetime
+import io
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+from types import SimpleNamespace
+
+import demjson
+import numpy
+from PIL import Image
+
+import PixivHelper
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import imageio
+except ImportError:
+    imageio = None
+
+JSON_FIXTURES = ['test/all-14095911.json',
+                 'test/Fanbox_supported_artist.json',
+                 'test/Fanbox_artist_posts.json',
+                 'test/creator_with_filemap.json']
+
+
+def timeit(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def benchmark_json(repeat):
+    decoders = [('demjson', demjson.decode), ('json', json.loads), ('parseJson', PixivHelper.parseJson)]
+    print('parseJson uses orjson: {0}'.format(PixivHelper.orjson is not None))
+    print('{0:40}{1:>10}'.format('file', 'size') + ''.join('{0:>14}'.format(name) for (name, _) in decoders))
+    for filename in JSON_FIXTURES:
+        with open(filename, 'rb') as reader:
+            data = reader.read()
+        timings = [timeit(lambda: decode(data), repeat) for (_, decode) in decoders]
+        print('{0:40}{1:>10}'.format(filename, len(data)) + ''.join('{0:11.3f} ms'.format(t) for t in timings))
+
+
+FILENAME_FORMATS = ['%artist% (%member_id%)' + os.sep + '%urlFilename% - %title%',
+                    '%artist% (%member_id%)' + os.sep + '%R-18%' + os.sep + '%image_id% - %title% - %tags% %works_date_fmt{%Y-%m-%d}%',
+                    '%member_token% (%member_id%)' + os.sep + '%image_id%' + os.sep + '%page_number% %works_res% %works_tools% %date%']
+
+
+def synthetic_images(count):
+    artist = SimpleNamespace(artistName='artist &amp; <name>', artistId=1234, artistToken='token')
+    for i in range(count):
+        yield SimpleNamespace(artist=artist, originalArtist=artist, imageTitle='title: {0}?'.format(i), imageId=70000000 + i,
+                              worksDate='2019-01-02 10:00', worksDateDateTime=datetime.datetime(2019, 1, 2, 10, 0),
+                              worksResolution='1200x1600', worksTools='SAI', imageMode='manga', imageCount=120,
+                              imageTags=['tag{0}'.format(x) for x in range(10)] + ['R-18'],
+                              bookmark_count=i % 100, image_response_count=0)
+
+
+def benchmark_filename(count):
+    # the debug log in sanitizeFilename() writes every filename to the log file
+    PixivHelper.GetLogger().setLevel(logging.INFO)
+    images = list(synthetic_images(count))
+    root_dir = os.path.abspath('.')
+    for nameFormat in FILENAME_FORMATS:
+        start = time.perf_counter()
+        for image in images:
+            url = 'https://i.pximg.net/img-original/img/2019/01/02/10/00/00/{0}_p{1}.jpg'.format(image.imageId, image.imageId % 120)
+            filename = PixivHelper.makeFilename(nameFormat, image, tagsSeparator=' ', tagsLimit=-1, fileUrl=url)
+            PixivHelper.sanitizeFilename(filename, root_dir)
+        elapsed = time.perf_counter() - start
+        print('{0:100} {1:8.2f} s {2:8.2f} us/file'.format(nameFormat, elapsed, elapsed / count * 1000000))
+
+
+def synthetic_ugoira(filename, frames, width):
+    '''16:9 jpg frames, a square moving over a gradient'''
+    height = width * 9 // 16
+    background = numpy.zeros((height, width, 3), dtype=numpy.uint8)
+    background[:, :, 0] = numpy.linspace(0, 255, width, dtype=numpy.uint8)
+    background[:, :, 1] = numpy.linspace(0, 255, height, dtype=numpy.uint8)[:, None]
+    animation = list()
+    with zipfile.ZipFile(filename, 'w') as z:
+        for i in range(frames):
+            frame = background.copy()
+            x = (i * 7) % (width - 64)
+            frame[height // 3:height // 3 + 64, x:x + 64] = (255, 255, 255)
+            name = '{0:06}.jpg'.format(i)
+            data = io.BytesIO()
+            Image.fromarray(frame).save(data, format='jpeg')
+            z.writestr(name, data.getvalue())
+            animation.append({'file': name, 'delay': 40 + (i % 3) * 20})
+        z.writestr('animation.json', json.dumps({'frames': animation}))
+
+
+def ugoira2gif_imageio(ugoira_file, exportname):
+    '''the previous ugoira2gif(): decode every frame, then imageio.mimsave()'''
+    with zipfile.ZipFile(ugoira_file) as z:
+        frames = json.loads(z.read('animation.json'))['frames']
+        images = [imageio.imread(z.read(info['file'])) for info in frames]
+    with open(exportname, 'wb') as f:
+        imageio.mimsave(f, images, 'gif', duration=[info['delay'] for info in frames])
+
+
+def run_gif_case(case, ugoira_file, exportname, queue):
+    start = time.perf_counter()
+    if case == 'imageio.mimsave':
+        ugoira2gif_imageio(ugoira_file, exportname)
+    else:
+        PixivHelper.ugoira2gif(ugoira_file, exportname, False, sharedPalette=(case == 'GifWriter shared palette'))
+    elapsed = time.perf_counter() - start
+    # KB on linux, Bytes on mac
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else -1
+    if sys.platform == 'darwin':
+        peak = peak // 1024
+    queue.put((elapsed, peak))
+
+
+def benchmark_gif(frames, width):
+    PixivHelper.GetLogger().setLevel(logging.INFO)
+    target = tempfile.mkdtemp()
+    try:
+        ugoira_file = os.path.join(target, 'synthetic.ugoira')
+        synthetic_ugoira(ugoira_file, frames, width)
+        print('ugoira: {0} frames {1}x{2}, {3}'.format(frames, width, width * 9 // 16, PixivHelper.sizeInStr(os.path.getsize(ugoira_file))))
+        # new process for each case, so the peak rss is not shared
+        context = multiprocessing.get_context('spawn')
+        for case in ('imageio.mimsave', 'GifWriter', 'GifWriter shared palette'):
+            if imageio is None and case == 'imageio.mimsave':
+                continue
+            exportname = os.path.join(target, case + '.gif')
+            queue = context.Queue()
+            p = context.Process(target=run_gif_case, args=(case, ugoira_file, exportname, queue))
+            p.start()
+            (elapsed, peak) = queue.get()
+            p.join()
+            print('{0:30} {1:8.2f} s  peak rss {2:8.1f} MB  {3:>10}'.format(case, elapsed, peak / 1024.0,
+                                                                         PixivHelper.sizeInStr(os.path.getsize(exportname))))
+    finally:
+        shutil.rmtree(target)
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    frames = int(sys.argv[3]) if len(sys.argv) > 3 else 300
+    width = int(sys.argv[4]) if len(sys.argv) > 4 else 1280
+    benchmark_json(repeat)
+    benchmark_filename(count)
+    benchmark_gif(frames, width)
+
+
+if __name__ == '__main__':
+    main()
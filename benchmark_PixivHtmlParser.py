@@ -0,0 +1,42 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# Per page parse time of the search/bookmark fixtures in test/ for each htmlParser value.
+# usage: python benchmark_PixivHtmlParser.py [repeat]
+import sys
+import time
+
+import PixivHtmlParser
+from PixivModel import PixivBookmark, PixivNewIllustBookmark, PixivTags
+
+
+def parse_tags(page):
+    PixivTags().parseTags(page)
+
+
+FIXTURES = [('test/test-tags-search-exact.htm', parse_tags),
+            ('test/test-tags-search-exact2.htm', parse_tags),
+            ('test/test-tags-search-exact-last.htm', parse_tags),
+            ('test/test-tags-search-partial.htm', parse_tags),
+            ('test/test-tags-search-skip-showcase.htm', parse_tags),
+            ('test/test-bookmarks_new_ilust.htm', PixivNewIllustBookmark),
+            ('test/test-image-bookmark.htm', PixivBookmark.parseImageBookmark)]
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    parsers = [p for p in PixivHtmlParser.HTML_PARSERS if p != 'lxml' or PixivHtmlParser.HAVE_LXML]
+    print('{0:45}'.format('page') + ''.join('{0:>14}'.format(p) for p in parsers))
+    for (filename, func) in FIXTURES:
+        with open(filename, 'r', encoding='utf-8') as reader:
+            html = reader.read()
+        timings = list()
+        for parser in parsers:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                func(PixivHtmlParser.parseHtml(html, parser))
+            timings.append((time.perf_counter() - start) / repeat * 1000)
+        print('{0:45}'.format(filename) + ''.join('{0:11.2f} ms'.format(t) for t in timings))
+
+
+if __name__ == '__main__':
+    main()